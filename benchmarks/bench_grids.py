@@ -0,0 +1,222 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmarks of grid construction, nearest neighbour search, lookup tables
+and point selections.
+"""
+
+import numpy as np
+
+from pygeogrids.grids import CellGrid
+from pygeogrids.polygon import points_in_polygons
+from pygeogrids.shapefile import ogr_installed, subgrid_for_shp
+
+from .common import RESOLUTIONS, make_grid, query_points
+
+
+class GridConstruction:
+    """
+    Building a cell grid from coordinate arrays and its kdTree.
+    """
+    params = RESOLUTIONS
+    param_names = ["resolution"]
+    timeout = 300
+    number = 1
+    repeat = (1, 5, 60.0)
+
+    def setup(self, resolution):
+        grid = make_grid(resolution)
+        self.lon, self.lat = grid.arrlon, grid.arrlat
+        self.cells = grid.arrcell
+
+    def time_cell_grid(self, resolution):
+        CellGrid(self.lon, self.lat, self.cells)
+
+    def time_kdtree(self, resolution):
+        grid = CellGrid(self.lon, self.lat, self.cells)
+        grid._setup_kdtree()
+
+    def peakmem_kdtree(self, resolution):
+        grid = CellGrid(self.lon, self.lat, self.cells)
+        grid._setup_kdtree()
+
+
+class NearestNeighbour:
+    """
+    Nearest neighbour queries of 10000 random points with a built kdTree.
+    """
+    params = RESOLUTIONS
+    param_names = ["resolution"]
+    timeout = 300
+
+    def setup(self, resolution):
+        self.grid = make_grid(resolution)
+        # build the kdTree, regular grids only need it for k > 1
+        self.grid.find_k_nearest_gpi(0, 0, k=2)
+        self.lon, self.lat = query_points(10000)
+        self.mask = np.zeros(self.grid.n_gpi, dtype=bool)
+        self.mask[::2] = True
+
+    def time_find_nearest_gpi(self, resolution):
+        self.grid.find_nearest_gpi(self.lon, self.lat)
+
+    def time_find_nearest_gpi_max_dist(self, resolution):
+        self.grid.find_nearest_gpi(self.lon, self.lat, max_dist=25000)
+
+    def time_find_nearest_gpi_great_circle(self, resolution):
+        self.grid.find_nearest_gpi(self.lon, self.lat, metric="great_circle")
+
+    def time_find_k_nearest_gpi(self, resolution):
+        self.grid.find_k_nearest_gpi(self.lon, self.lat, k=4)
+
+    def time_find_nearest_gpi_mask(self, resolution):
+        self.grid.find_nearest_gpi(self.lon, self.lat, mask=self.mask)
+
+    def time_find_nearest_gpi_single(self, resolution):
+        for lon, lat in zip(self.lon[:100], self.lat[:100]):
+            self.grid.find_nearest_gpi(lon, lat)
+
+    def time_query_session(self, resolution):
+        session = self.grid.query_session(100)
+        for start in range(0, self.lon.size, 100):
+            session.find_nearest_gpi(self.lon[start:start + 100],
+                                     self.lat[start:start + 100])
+
+    def time_find_nearest_gpi_batches(self, resolution):
+        for start in range(0, self.lon.size, 100):
+            self.grid.find_nearest_gpi(self.lon[start:start + 100],
+                                       self.lat[start:start + 100])
+
+
+class CalcLut:
+    """
+    Lookup table from each grid to the 12.5 km grid and to the 1 degree
+    grid.
+    """
+    params = RESOLUTIONS
+    param_names = ["resolution"]
+    timeout = 600
+    number = 1
+    repeat = (1, 3, 60.0)
+
+    def setup(self, resolution):
+        self.grid = make_grid(resolution)
+        self.irregular = make_grid("12.5km")
+        self.irregular._setup_kdtree()
+        self.regular = make_grid("1deg")
+
+    def time_calc_lut_irregular(self, resolution):
+        self.grid.calc_lut(self.irregular)
+
+    def peakmem_calc_lut_irregular(self, resolution):
+        self.grid.calc_lut(self.irregular)
+
+    def time_calc_lut_regular(self, resolution):
+        self.grid.calc_lut(self.regular)
+
+
+class GpiLookup:
+    """
+    Lookups by gpi, cell and bounding box.
+    """
+    params = RESOLUTIONS
+    param_names = ["resolution"]
+    timeout = 300
+
+    def setup(self, resolution):
+        self.grid = make_grid(resolution)
+        rng = np.random.default_rng(0)
+        self.gpis = rng.choice(self.grid.gpis, 100000)
+        self.cells = self.grid.get_cells()
+        # build the lookup structures that are reused between calls
+        self.grid.gpi2lonlat(self.gpis[:1])
+        self.grid.grid_points_for_cell(self.cells[0])
+        self.grid.get_bbox_grid_points(0, 1, 0, 1)
+
+    def time_gpi2lonlat(self, resolution):
+        self.grid.gpi2lonlat(self.gpis)
+
+    def time_gpi2cell(self, resolution):
+        self.grid.gpi2cell(self.gpis)
+
+    def time_grid_points_for_cell(self, resolution):
+        for cell in self.cells[:100]:
+            self.grid.grid_points_for_cell(cell)
+
+    def time_grid_points_for_cells(self, resolution):
+        self.grid.grid_points_for_cell(self.cells)
+
+    def time_get_bbox_grid_points(self, resolution):
+        # Europe
+        self.grid.get_bbox_grid_points(35, 72, -25, 45)
+
+    def time_get_bbox_grid_points_small(self, resolution):
+        for lat in range(-80, 80, 2):
+            self.grid.get_bbox_grid_points(lat, lat + 1, 10, 11)
+
+    def time_subgrid_from_cells(self, resolution):
+        self.grid.subgrid_from_cells(self.cells[::10])
+
+
+class PolygonSubset:
+    """
+    Selection of the grid points in a synthetic polygon.
+    """
+    params = RESOLUTIONS
+    param_names = ["resolution"]
+    timeout = 300
+
+    def setup(self, resolution):
+        self.grid = make_grid(resolution)
+        # star shaped polygon with 2000 vertices around central Europe
+        angle = np.linspace(0, 2 * np.pi, 2000, endpoint=False)
+        radius = 10 + 5 * np.sin(7 * angle)
+        ring = np.column_stack((15 + radius * np.cos(angle),
+                                50 + radius * np.sin(angle)))
+        self.polygons = [[ring]]
+
+    def time_points_in_polygons(self, resolution):
+        points_in_polygons(self.grid.arrlon, self.grid.arrlat, self.polygons)
+
+
+class ShapefileSubgrid:
+    """
+    Subgrid for countries of the shapefile included in the package, needs
+    OGR.
+    """
+    params = RESOLUTIONS
+    param_names = ["resolution"]
+    timeout = 300
+
+    def setup(self, resolution):
+        if not ogr_installed:
+            raise NotImplementedError("OGR is not installed")
+        self.grid = make_grid(resolution)
+
+    def time_subgrid_for_shp(self, resolution):
+        subgrid_for_shp(self.grid, ["Austria", "Peru"], field="NAME")
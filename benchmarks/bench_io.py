@@ -0,0 +1,96 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmarks of storing and loading grid files.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+
+import pygeogrids.binary as binary
+import pygeogrids.netcdf as netcdf
+
+from .common import RESOLUTIONS, make_grid
+
+
+class GridFiles:
+    """
+    netCDF and binary grid files of each grid, written to a temporary
+    directory.
+    """
+    params = RESOLUTIONS
+    param_names = ["resolution"]
+    timeout = 600
+    number = 1
+    repeat = (1, 5, 60.0)
+
+    def setup(self, resolution):
+        self.grid = make_grid(resolution)
+        self.path = tempfile.mkdtemp()
+        self.nc_file = os.path.join(self.path, "grid.nc")
+        self.binary_file = os.path.join(self.path, "grid.bin")
+        netcdf.save_grid(self.nc_file, self.grid)
+        binary.save_grid(self.binary_file, self.grid)
+        self.cells = self.grid.get_cells()[:10]
+
+    def teardown(self, resolution):
+        shutil.rmtree(self.path)
+
+    def time_save_grid(self, resolution):
+        netcdf.save_grid(os.path.join(self.path, "saved.nc"), self.grid)
+
+    def time_load_grid(self, resolution):
+        netcdf.load_grid(self.nc_file)
+
+    def peakmem_load_grid(self, resolution):
+        netcdf.load_grid(self.nc_file)
+
+    def time_load_grid_cells(self, resolution):
+        netcdf.load_grid(self.nc_file, cells=self.cells)
+
+    def time_load_grid_lazy(self, resolution):
+        netcdf.load_grid(self.nc_file, lazy=True)
+
+    def time_save_binary(self, resolution):
+        binary.save_grid(os.path.join(self.path, "saved.bin"), self.grid)
+
+    def time_load_binary(self, resolution):
+        binary.load_grid(self.binary_file)
+
+    def peakmem_load_binary(self, resolution):
+        binary.load_grid(self.binary_file)
+
+    def time_pickle(self, resolution):
+        pickle.loads(pickle.dumps(self.grid, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def track_pickle_size(self, resolution):
+        return len(pickle.dumps(self.grid, protocol=pickle.HIGHEST_PROTOCOL))
+
+    track_pickle_size.unit = "bytes"
@@ -0,0 +1,114 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Synthetic global grids used by the benchmarks. They are generated, so the
+benchmarks run without any data files or network access.
+"""
+
+import functools
+
+import numpy as np
+
+from pygeogrids.grids import CellGrid, genreg_grid, lonlat2cell
+
+# regular grids in degrees and an irregular grid with about 12.5 km spacing,
+# similar to the discrete global grids of scatterometer products
+RESOLUTIONS = ["1deg", "0.25deg", "0.1deg", "12.5km"]
+
+EARTH_RADIUS = 6371.0
+
+
+def fibonacci_lonlat(spacing_km):
+    """
+    Quasi-uniform irregular points on the sphere (Fibonacci lattice).
+
+    Parameters
+    ----------
+    spacing_km : float
+        Approximate distance between neighbouring points in km.
+
+    Returns
+    -------
+    lon : numpy.ndarray
+        Longitudes.
+    lat : numpy.ndarray
+        Latitudes.
+    """
+    n = int(round(4 * np.pi * EARTH_RADIUS ** 2 / spacing_km ** 2))
+    i = np.arange(n) + 0.5
+    lat = np.rad2deg(np.arcsin(1 - 2 * i / n))
+    lon = np.rad2deg(np.pi * (1 + 5 ** 0.5) * i) % 360 - 180
+    return lon, lat
+
+
+@functools.lru_cache(maxsize=None)
+def make_grid(resolution):
+    """
+    Global cell grid (5 degree cells) of the given resolution, built once
+    per process.
+
+    Parameters
+    ----------
+    resolution : str
+        One of RESOLUTIONS.
+
+    Returns
+    -------
+    grid : CellGrid
+        Grid with all points active.
+    """
+    if resolution.endswith("deg"):
+        res = float(resolution[:-3])
+        return genreg_grid(res, res).to_cell_grid(cellsize=5.0)
+
+    lon, lat = fibonacci_lonlat(float(resolution[:-2]))
+    return CellGrid(lon, lat, lonlat2cell(lon, lat, cellsize=5.0))
+
+
+def query_points(n, seed=0):
+    """
+    Random query locations distributed uniformly on the sphere.
+
+    Parameters
+    ----------
+    n : int
+        Number of points.
+    seed : int, optional (default: 0)
+        Seed of the random number generator.
+
+    Returns
+    -------
+    lon : numpy.ndarray
+        Longitudes.
+    lat : numpy.ndarray
+        Latitudes.
+    """
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(-180, 180, n)
+    lat = np.rad2deg(np.arcsin(rng.uniform(-1, 1, n)))
+    return lon, lat
@@ -1,18 +1,24 @@
-import sys
+from pygeogrids.grids import (BasicGrid, CellGrid, RegularGrid, genreg_grid,
+                              lonlat2cell, reorder_to_cellsize)
 
-if sys.version_info[:2] >= (3, 8):
-    # TODO: Import directly (no need for conditional) when `python_requires = >= 3.8`
-    from importlib.metadata import PackageNotFoundError, version  # pragma: no cover
-else:
-    from importlib_metadata import PackageNotFoundError, version  # pragma: no cover
+__all__ = ["BasicGrid", "CellGrid", "RegularGrid", "genreg_grid",
+           "lonlat2cell", "reorder_to_cellsize"]
 
-try:
-    # Change here if project is renamed and does not equal the package name
-    dist_name = __name__
-    __version__ = version(dist_name)
-except PackageNotFoundError:  # pragma: no cover
-    __version__ = "unknown"
-finally:
-    del version, PackageNotFoundError
 
-from pygeogrids.grids import BasicGrid, CellGrid, genreg_grid, lonlat2cell, reorder_to_cellsize
+def __getattr__(name):
+    # the version is looked up when it is used, importing importlib.metadata
+    # takes about as long as importing pygeogrids itself
+    if name != "__version__":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        # Change here if project is renamed and does not equal the package
+        # name
+        dist_name = __name__
+        __version__ = version(dist_name)
+    except PackageNotFoundError:  # pragma: no cover
+        __version__ = "unknown"
+    globals()["__version__"] = __version__
+    return __version__
@@ -0,0 +1,353 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Native binary grid file format.
+
+A grid file starts with a fixed magic string, the length of a JSON header
+and the header itself. The header describes the grid (class, geodetic
+datum, shape) and the location, dtype and shape of the raw arrays that
+follow it. All arrays are aligned to 64 bytes so that they can be
+memory-mapped without copying.
+"""
+
+import json
+import pickle
+
+import numpy as np
+
+from pygeogrids.grids import BasicGrid, CellGrid, RegularGrid
+import pygeogrids.nearest_neighbor as NN
+from pygeogrids.nearest_neighbor import _write_atomic
+from pygeogrids.instrumentation import timed
+
+MAGIC = b"PYGEOGRD"
+VERSION = 1
+ALIGNMENT = 64
+
+
+@timed()
+def save_grid(filename, grid, kdtree=False):
+    """
+    Save a BasicGrid, CellGrid or RegularGrid to a binary grid file.
+
+    Parameters
+    ----------
+    filename : str
+        name of file
+    grid : BasicGrid, CellGrid or RegularGrid
+        grid to save
+    kdtree : boolean, optional (default: False)
+        If True, the cartesian coordinates of the kdTree are stored as well
+        and, for kd_tree_name 'scipy', the built tree. The kdTree is set up
+        if it does not exist yet.
+    """
+    header_bytes, data_start, _, arrays = grid_layout(grid, kdtree)
+
+    def write(f):
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for offset, arr in arrays:
+            f.seek(data_start + offset)
+            f.write(arr.tobytes())
+
+    _write_atomic(filename, write)
+
+
+def grid_layout(grid, kdtree=False):
+    """
+    Layout of a grid in the binary format, shared by grid files and
+    shared memory blocks.
+
+    Parameters
+    ----------
+    grid : BasicGrid, CellGrid or RegularGrid
+        grid to save
+    kdtree : boolean, optional (default: False)
+        include the kdTree, see save_grid
+
+    Returns
+    -------
+    header_bytes : bytes
+        encoded header
+    data_start : int
+        offset of the data block from the start of the file
+    data_size : int
+        size of the data block in bytes
+    arrays : list of tuple
+        (offset, array) of the contiguous arrays, relative to data_start
+    """
+    header = {
+        "version": VERSION,
+        "class": type(grid).__name__,
+        "geodatum": grid.geodatum.name,
+        "shape": list(grid.shape),
+        "kd_tree_name": grid.kd_tree_name,
+    }
+
+    if isinstance(grid, RegularGrid):
+        # undo the transformation to (-180, 180] to get an equally spaced
+        # axis again
+        londim = grid.londim.copy()
+        londim[1:] += 360 * np.cumsum(np.diff(grid.londim) < 0)
+        header["transform_lon"] = bool(np.any(londim != grid.londim))
+        arrays = {"londim": londim, "latdim": grid.latdim}
+    elif isinstance(grid, (BasicGrid, CellGrid)):
+        arrays = {"lon": grid.arrlon, "lat": grid.arrlat}
+        if not grid.gpidirect:
+            arrays["gpi"] = grid.gpis
+        if isinstance(grid, CellGrid):
+            arrays["cell"] = grid.arrcell
+        if grid.subset is not None:
+            arrays["subset"] = grid.subset
+    else:
+        raise ValueError(f"Unsupported grid type {type(grid).__name__}")
+
+    if kdtree:
+        grid._setup_kdtree()
+        header["kd_tree_name"] = grid.kdTree.kd_tree_name
+        arrays["kdtree_coords"] = grid.kdTree.coords
+        if (grid.kdTree.kd_tree_name != "pykdtree"
+                or not NN.pykdtree_installed):
+            # pykdtree objects can not be serialized and are rebuilt
+            arrays["kdtree"] = np.frombuffer(
+                pickle.dumps(grid.kdTree.kdtree,
+                             protocol=pickle.HIGHEST_PROTOCOL),
+                dtype=np.uint8)
+
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+
+    # the header length depends on the offsets, so they are computed
+    # relative to the start of the data block, which is aligned
+    offset = 0
+    header["arrays"] = {}
+    for name, arr in arrays.items():
+        header["arrays"][name] = {
+            "dtype": arr.dtype.str,
+            "shape": list(arr.shape),
+            "offset": offset,
+        }
+        offset = _align(offset + arr.nbytes)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+    arrays = [(header["arrays"][name]["offset"], arr)
+              for name, arr in arrays.items()]
+
+    return header_bytes, data_start, offset, arrays
+
+
+@timed()
+def load_grid(filename, mmap=True, **grid_kwargs):
+    """
+    Load a grid from a binary grid file.
+
+    The kdTree is unpickled if it was stored, so only load files from
+    trusted sources.
+
+    Parameters
+    ----------
+    filename : str
+        name of file
+    mmap : boolean, optional (default: True)
+        If True, the arrays are memory-mapped read-only, otherwise they are
+        read into memory.
+    **grid_kwargs
+        additional kwargs that are passed to BasicGrid, CellGrid or
+        RegularGrid
+
+    Returns
+    -------
+    grid : BasicGrid, CellGrid or RegularGrid
+        grid instance initialized with the loaded data
+    """
+    header, data_start = read_header(filename)
+
+    arrays = {}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        shape = tuple(info["shape"])
+        offset = data_start + info["offset"]
+        if not mmap or np.prod(shape) == 0:
+            with open(filename, "rb") as f:
+                f.seek(offset)
+                arrays[name] = np.fromfile(
+                    f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        else:
+            arrays[name] = np.memmap(filename, dtype=dtype, mode="r",
+                                     offset=offset, shape=shape)
+
+    return grid_from_arrays(header, arrays, **grid_kwargs)
+
+
+def grid_from_arrays(header, arrays, **grid_kwargs):
+    """
+    Create a grid from the header and arrays of the binary format.
+
+    Parameters
+    ----------
+    header : dict
+        grid description
+    arrays : dict
+        arrays described in the header
+    **grid_kwargs
+        additional kwargs that are passed to BasicGrid, CellGrid or
+        RegularGrid
+
+    Returns
+    -------
+    grid : BasicGrid, CellGrid or RegularGrid
+        grid instance using the given arrays
+    """
+    has_kdtree = "kdtree_coords" in arrays
+    grid_kwargs.setdefault("kd_tree_name", header["kd_tree_name"])
+    if has_kdtree:
+        grid_kwargs["setup_kdTree"] = False
+
+    if header["class"] == "RegularGrid":
+        grid_kwargs.setdefault("transform_lon", header["transform_lon"])
+        grid = RegularGrid(arrays["londim"], arrays["latdim"],
+                           geodatum=header["geodatum"], **grid_kwargs)
+    else:
+        # the stored coordinates were already transformed
+        grid_kwargs.setdefault("transform_lon", False)
+        kwargs = dict(gpis=arrays.get("gpi"), geodatum=header["geodatum"],
+                      subset=arrays.get("subset"),
+                      shape=tuple(header["shape"]), **grid_kwargs)
+        if header["class"] == "CellGrid":
+            grid = CellGrid(arrays["lon"], arrays["lat"], arrays["cell"],
+                            **kwargs)
+        else:
+            grid = BasicGrid(arrays["lon"], arrays["lat"], **kwargs)
+
+    if has_kdtree:
+        grid.kdTree = NN.findGeoNN(
+            grid.activearrlon, grid.activearrlat, grid.geodatum,
+            kd_tree_name=grid.kd_tree_name,
+            cache_dir=grid.kd_tree_cache_dir,
+            coords=arrays["kdtree_coords"])
+        if "kdtree" in arrays and grid.kd_tree_name == header["kd_tree_name"]:
+            grid.kdTree.kdtree = pickle.loads(arrays["kdtree"].tobytes())
+        else:
+            grid.kdTree._build_kdtree()
+
+    return grid
+
+
+def read_header(filename):
+    """
+    Read the header of a binary grid file.
+
+    Parameters
+    ----------
+    filename : str
+        name of file
+
+    Returns
+    -------
+    header : dict
+        grid description and array locations
+    data_start : int
+        file offset of the first array
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a binary grid file")
+        length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = parse_header(f.read(length))
+
+    return header, _align(len(MAGIC) + 8 + length)
+
+
+def parse_header(header_bytes):
+    """
+    Decode the header of the binary format and check its version.
+
+    Parameters
+    ----------
+    header_bytes : bytes
+        encoded header
+
+    Returns
+    -------
+    header : dict
+        grid description and array locations
+    """
+    header = json.loads(bytes(header_bytes).decode("utf-8"))
+    if header["version"] > VERSION:
+        raise ValueError(
+            f"Unsupported grid file version {header['version']}")
+    return header
+
+
+def netcdf_to_binary(nc_filename, filename, kdtree=False, **load_kwargs):
+    """
+    Convert a netCDF grid file to a binary grid file.
+
+    Parameters
+    ----------
+    nc_filename : str
+        name of the netCDF grid file
+    filename : str
+        name of the binary grid file
+    kdtree : boolean, optional (default: False)
+        store the kdTree as well, see save_grid
+    **load_kwargs
+        additional kwargs passed to pygeogrids.netcdf.load_grid
+    """
+    from pygeogrids.netcdf import load_grid as load_nc_grid
+
+    load_kwargs.setdefault("setup_kdTree", False)
+    save_grid(filename, load_nc_grid(nc_filename, **load_kwargs),
+              kdtree=kdtree)
+
+
+def binary_to_netcdf(filename, nc_filename, **save_kwargs):
+    """
+    Convert a binary grid file to a netCDF grid file.
+
+    Parameters
+    ----------
+    filename : str
+        name of the binary grid file
+    nc_filename : str
+        name of the netCDF grid file
+    **save_kwargs
+        additional kwargs passed to pygeogrids.netcdf.save_grid
+    """
+    from pygeogrids.netcdf import save_grid as save_nc_grid
+
+    save_nc_grid(nc_filename, load_grid(filename, setup_kdTree=False),
+                 **save_kwargs)
+
+
+def _align(offset):
+    """
+    Round an offset up to the next multiple of ALIGNMENT.
+    """
+    return -(-offset // ALIGNMENT) * ALIGNMENT
@@ -27,7 +27,8 @@
 
 
 import numpy as np
-import pyproj
+
+from pygeogrids.instrumentation import timed
 
 
 class GeodeticDatum:
@@ -44,10 +45,34 @@ class GeodeticDatum:
 
     def __init__(self, ellps, **kwargs):
         kwargs["ellps"] = ellps
-        self.geod = pyproj.Geod(**kwargs)
-        self.geod.e = np.sqrt(self.geod.es)
+        self._geod_kwargs = kwargs
+        self._geod = None
         self.name = ellps
 
+    def __setstate__(self, state):
+        # pickled before the ellipsoid was created on first use, the
+        # pickled Geod has lost the eccentricity attribute, so it is
+        # created again
+        if "geod" in state:
+            state = dict(state)
+            geod = state.pop("geod")
+            state["_geod"] = None
+            state["_geod_kwargs"] = {"a": geod.a, "b": geod.b}
+        self.__dict__.update(state)
+
+    @property
+    def geod(self):
+        """
+        pyproj.Geod of the ellipsoid with the eccentricity as additional
+        attribute e. pyproj is imported when it is used first.
+        """
+        if self._geod is None:
+            import pyproj
+            geod = pyproj.Geod(**self._geod_kwargs)
+            geod.e = np.sqrt(geod.es)
+            self._geod = geod
+        return self._geod
+
     def getParameter(self):
         """
         Method to transform lon/lat to ECEF (Earth-Centered, Earth-Fixed)
@@ -67,6 +92,7 @@ class GeodeticDatum:
         """
         return self.geod.a, self.geod.b, self.geod.f, self.geod.e
 
+    @timed()
     def toECEF(self, lon, lat):
         """
         Method to transform lon/lat to ECEF (Earth-Centered, Earth-Fixed)
@@ -88,15 +114,114 @@ class GeodeticDatum:
             lat = np.array(lat, dtype=np.float64)
             lon = np.array(lon, dtype=np.float64)
 
-        N = self.EllN(lat)
+        xy, z = self._meridian_terms(lat)
         lon = np.deg2rad(lon)
-        lat = np.deg2rad(lat)
 
-        x = N * np.cos(lat) * np.cos(lon)
-        y = N * np.cos(lat) * np.sin(lon)
-        z = N * (1 - self.geod.es) * np.sin(lat)
+        return xy * np.cos(lon), xy * np.sin(lon), z
+
+    @timed()
+    def toECEFArray(self, lon, lat, out=None, dtype=np.float64, work=None):
+        """
+        Transform lon/lat to ECEF coordinates stored in one (n, 3) array.
+
+        The latitude terms are computed once for each run of equal
+        consecutive latitudes, e.g. once per row of a regular grid.
+
+        Parameters
+        ----------
+        lon : numpy.array, list or float
+            longitudes of the points
+        lat : numpy.array, list or float
+            geodatic latitudes of the points
+        out : numpy.array, optional
+            (n, 3) array the coordinates are written to, can have a
+            different float type than dtype.
+        dtype : numpy.dtype, optional (default: np.float64)
+            Float type the coordinates are computed in, np.float32 is
+            faster but only accurate to a few meters.
+        work : numpy.array, optional
+            (3, m) array with m >= n used for the intermediate results
+            instead of allocating temporary arrays, e.g. for many small
+            batches. The coordinates are computed in its float type and
+            latitude terms are not reused between points.
 
-        return x, y, z
+        Returns
+        -------
+        coords : np.array
+            (n, 3) array of x, y, z coordinates, out if it was given
+        """
+        lon = np.asarray(lon).ravel()
+        lat = np.asarray(lat).ravel()
+        if lon.size != lat.size:
+            raise ValueError("lon and lat must have the same size")
+        if out is None:
+            out = np.empty((lon.size, 3), dtype=dtype)
+        elif out.shape != (lon.size, 3):
+            raise ValueError(
+                f"out must have shape {(lon.size, 3)}, not {out.shape}")
+        if work is not None:
+            if (work.ndim != 2 or work.shape[0] != 3
+                    or work.shape[1] < lon.size):
+                raise ValueError(
+                    f"work must have shape (3, m) with m >= {lon.size}, "
+                    f"not {work.shape}")
+            self._toECEF_work(lon, lat, out, work[:, :lon.size])
+            return out
+
+        starts = np.flatnonzero(lat[1:] != lat[:-1]) + 1
+        if starts.size < lat.size // 4:
+            starts = np.concatenate(([0], starts))
+            counts = np.diff(np.append(starts, lat.size))
+            xy, z = self._meridian_terms(lat[starts], dtype)
+            xy = np.repeat(xy, counts)
+            out[:, 2] = np.repeat(z, counts)
+        else:
+            xy, z = self._meridian_terms(lat, dtype)
+            out[:, 2] = z
+
+        lon = np.deg2rad(lon, dtype=dtype)
+        trig = np.cos(lon)
+        np.multiply(xy, trig, out=out[:, 0])
+        np.sin(lon, out=trig)
+        np.multiply(xy, trig, out=out[:, 1])
+
+        return out
+
+    def _toECEF_work(self, lon, lat, out, work):
+        """
+        ECEF coordinates computed in the rows of work, with the same
+        operations as toECEF.
+        """
+        angle, sin_lat, xy = work
+        np.deg2rad(lat, out=angle)
+        np.sin(angle, out=sin_lat)
+        np.cos(angle, out=xy)
+        # radius of the prime vertical
+        np.multiply(sin_lat, sin_lat, out=angle)
+        angle *= self.geod.es
+        np.subtract(1, angle, out=angle)
+        np.sqrt(angle, out=angle)
+        np.divide(self.geod.a, angle, out=angle)
+
+        xy *= angle
+        np.multiply(angle, 1 - self.geod.es, out=angle)
+        np.multiply(angle, sin_lat, out=out[:, 2])
+
+        np.deg2rad(lon, out=angle)
+        np.cos(angle, out=sin_lat)
+        np.multiply(xy, sin_lat, out=out[:, 0])
+        np.sin(angle, out=sin_lat)
+        np.multiply(xy, sin_lat, out=out[:, 1])
+
+    def _meridian_terms(self, lat, dtype=np.float64):
+        """
+        Distance to the rotation axis and z coordinate of points at the
+        given latitudes.
+        """
+        lat = np.deg2rad(lat, dtype=dtype)
+        sin_lat = np.sin(lat)
+        N = self.geod.a / np.sqrt(1 - self.geod.es * sin_lat ** 2)
+        return N * np.cos(lat), N * (1 - self.geod.es) * sin_lat
 
     def ParallelRadi(self, lat):
         """
@@ -132,7 +257,8 @@ class GeodeticDatum:
         if _element_iterable(lat):
             lat = np.array(lat, dtype=np.float64)
 
-        return np.rad2deg(np.arctan((1 - self.geod.e ** 2) * np.tan(np.deg2rad(lat))))
+        return np.rad2deg(
+            np.arctan((1 - self.geod.e ** 2) * np.tan(np.deg2rad(lat))))
 
     def GeodeticLat(self, lat):
         """
@@ -150,7 +276,8 @@ class GeodeticDatum:
         """
         if _element_iterable(lat):
             lat = np.array(lat, dtype=np.float64)
-        return np.rad2deg(np.arctan(np.tan(np.deg2rad(lat)) / (1 - self.geod.e ** 2)))
+        return np.rad2deg(
+            np.arctan(np.tan(np.deg2rad(lat)) / (1 - self.geod.e ** 2)))
 
     def ReducedLat(self, lat):
         """
@@ -297,6 +424,58 @@ class GeodeticDatum:
         fazi, bazi, dist = self.geod.inv(0.0, lat1, 0.0, lat2)
         return dist
 
+    def GreatCircleDist(self, lon1, lat1, lon2, lat2):
+        """
+        Method to calculate the great circle distance between points on a
+        sphere with the mean radius (2a + b) / 3 of the ellipsoid
+        (haversine formula).
+
+        Parameters
+        ----------
+        lon1 : numpy.array, float
+            Longitudes of points 1
+        lat1 : numpy.array, float
+            Geodatic latitudes of points 1
+        lon2 : numpy.array, float
+            Longitudes of points 2
+        lat2 : numpy.array, float
+            Geodatic latitudes of points 2
+
+        Returns
+        -------
+        dist : np.array, float
+            Great circle distance
+        """
+        lon1, lat1, lon2, lat2 = map(np.deg2rad, (lon1, lat1, lon2, lat2))
+        h = (np.sin((lat2 - lat1) / 2) ** 2
+             + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+        radius = (2 * self.geod.a + self.geod.b) / 3
+        return 2 * radius * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+    def GeodesicDist(self, lon1, lat1, lon2, lat2):
+        """
+        Method to calculate the geodesic distance between points on the
+        ellipsoid.
+
+        Parameters
+        ----------
+        lon1 : numpy.array, float
+            Longitudes of points 1
+        lat1 : numpy.array, float
+            Geodatic latitudes of points 1
+        lon2 : numpy.array, float
+            Longitudes of points 2
+        lat2 : numpy.array, float
+            Geodatic latitudes of points 2
+
+        Returns
+        -------
+        dist : np.array, float
+            Geodesic distance
+        """
+        fazi, bazi, dist = self.geod.inv(lon1, lat1, lon2, lat2)
+        return dist
+
 
 def _element_iterable(el):
     """
@@ -30,14 +30,11 @@ The grids module defines the grid classes.
 """
 
 import numpy as np
-import numpy.testing as nptest
+import copy
+import heapq
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-try:
-    from osgeo import ogr
-    ogr_installed = True
-except ImportError:
-    ogr_installed = False
 try:
     from itertools import izip as zip
 except ImportError:
@@ -45,6 +42,14 @@ except ImportError:
 
 import pygeogrids.nearest_neighbor as NN
 from pygeogrids.geodetic_datum import GeodeticDatum
+from pygeogrids.instrumentation import timed
+from pygeogrids.polygon import ogr_installed, ogr_polygon_rings, \
+    points_in_polygons
+
+
+# a dense gpi lookup table is only used if the gpi range is at most this
+# many times larger than the number of gpis, otherwise a sorted index is used
+GPI_LUT_MAX_SPARSITY = 4
 
 
 class GridDefinitionError(Exception):
@@ -79,10 +84,15 @@ class BasicGrid(object):
     subset : numpy.array, optional
         if the active part of the array is only a subset of
         all the points then the subset array which is a index
-        into lon and lat can be given here.
-    setup_kdTree : boolean, optional
-        if set (default) then the kdTree for nearest neighbour
-        search will be built on initialization
+        into lon and lat can be given here. A boolean mask of all points
+        is converted to the index of its True elements.
+    setup_kdTree : boolean or None, optional
+        if True then the kdTree for nearest neighbour search will be built
+        on initialization, if False it is built on first use. By default
+        (None) it is built on initialization unless the grid is regular
+        (2D shape, equally spaced axes, no subset): regular grids do not
+        need a kdTree for nearest neighbour search, it is only built if
+        k > 1 neighbours are requested.
     shape : tuple, optional
         The shape of the grid array in 2-d space.
         e.g. for a 1x1 degree global regular grid the shape would be (180,360).
@@ -101,6 +111,23 @@ class BasicGrid(object):
         transformation set this to ``False``.
     kd_tree_name: str, optional (default: 'pykdtree')
         KDTree engine, 'pykdtree' or 'scipy'
+    kd_tree_cache_dir: str, optional (default: None)
+        Directory in which the cartesian coordinates (and the kdTree itself
+        for 'scipy') are cached between processes, see
+        :py:class:`pygeogrids.nearest_neighbor.findGeoNN`.
+    compact : bool, optional (default: False)
+        Store the coordinates and the cartesian coordinates of the kdTree
+        as float32 and gpis, subset, cells and lookup tables as the
+        smallest integer type that holds their values. This halves the
+        memory of the grid. float32 coordinates are rounded to less than
+        1e-5 degree (about 1 m) and the cartesian coordinates to less than
+        0.5 m, so distances are accurate to about 1.5 m and neighbours
+        whose distances differ by less than about 3 m may differ from a
+        grid with float64 coordinates.
+    copy : bool, optional (default: False)
+        If True, the given arrays are copied. Otherwise numpy arrays are
+        used as they are, so the grid shares their memory and transform_lon
+        changes the given longitudes.
 
     Attributes
     ----------
@@ -162,25 +189,29 @@ class BasicGrid(object):
         gpis=None,
         geodatum="WGS84",
         subset=None,
-        setup_kdTree=True,
+        setup_kdTree=None,
         shape=None,
         transform_lon=None,
         kd_tree_name="pykdtree",
+        kd_tree_cache_dir=None,
+        compact=False,
+        copy=False,
     ):
         """
         init method, prepares lon and lat arrays for _transform_lonlats if
         necessary
 
         """
-        lon = np.atleast_1d(lon)
-        lat = np.atleast_1d(lat)
+        lon = _as_array(lon, copy)
+        lat = _as_array(lat, copy)
         if gpis is not None:
-            gpis = np.atleast_1d(gpis)
+            gpis = _as_array(gpis, copy)
         if subset is not None:
-            subset = np.atleast_1d(subset)
+            subset = _subset_array(subset, copy)
 
         if lat.shape != lon.shape:
-            raise GridDefinitionError("lat and lon np.arrays have to have equal shapes")
+            raise GridDefinitionError(
+                "lat and lon np.arrays have to have equal shapes")
 
         self.n_gpi = len(lon)
 
@@ -196,6 +227,18 @@ class BasicGrid(object):
                         " this warning set the transform_lon keyword argument"
                     )
 
+        self.compact = compact
+        # the full precision coordinates are used to detect regular grids
+        lon_full, lat_full = lon, lat
+        if compact:
+            lon = lon.astype(np.float32)
+            lat = lat.astype(np.float32)
+            if gpis is not None:
+                gpis = gpis.astype(_smallest_int_dtype(gpis), copy=False)
+            if subset is not None:
+                subset = subset.astype(_smallest_int_dtype(subset),
+                                       copy=False)
+
         self.arrlon = lon
         self.arrlat = lat
 
@@ -228,7 +271,7 @@ class BasicGrid(object):
         self.geodatum = GeodeticDatum(geodatum)
 
         if gpis is None:
-            self.gpis = np.arange(self.n_gpi, dtype=int)
+            self.gpis = self._direct_gpis()
             self.gpidirect = True
         else:
             if lat.shape != gpis.shape:
@@ -239,39 +282,357 @@ class BasicGrid(object):
             self.gpidirect = False
 
         self.subset = subset
+        self._gpi_lut = None
+        self._lat_index = None
 
-        if subset is not None:
-            self.activearrlon = self.arrlon[subset]
-            self.activearrlat = self.arrlat[subset]
-            self.activegpis = self.gpis[subset]
-            self.allpoints = False
-        else:
-            self.activearrlon = self.arrlon
-            self.activearrlat = self.arrlat
-            self.activegpis = self.gpis
-            self.allpoints = True
+        self._set_active_arrays()
 
         self.issplit = False
 
         self.kd_tree_name = kd_tree_name
+        self.kd_tree_cache_dir = kd_tree_cache_dir
         self.kdTree = None
+        self._reset_nn_links()
 
-        if setup_kdTree:
+        self._regular_nn = self._regular_search(lon_full, lat_full)
+
+        if setup_kdTree or (setup_kdTree is None
+                            and self._regular_nn is None):
             self._setup_kdtree()
 
+    def __getstate__(self):
+        """
+        Only the arrays that define the grid are pickled. The active arrays
+        (views or copies of the full arrays) are recreated when unpickling,
+        the kdTree and lookup tables when they are used.
+        """
+        state = self.__dict__.copy()
+        for key in self._derived_attributes():
+            state.pop(key, None)
+        if not self.issplit:
+            for key in self._split_attributes():
+                state.pop(key, None)
+        if self.gpidirect:
+            state.pop("gpis", None)
+        return state
+
+    def __setstate__(self, state):
+        state = _old_grid_state(state)
+        self.__dict__.update(state)
+        if self.subset is not None:
+            self.subset = _subset_array(self.subset)
+        if self.gpidirect and "gpis" not in state:
+            self.gpis = self._direct_gpis()
+        self._set_active_arrays()
+        if "_regular_nn" not in state:
+            self._regular_nn = self._regular_search(self.arrlon, self.arrlat)
+        if len(self.shape) == 2:
+            self.lat2d = np.reshape(self.arrlat, self.shape)
+            self.lon2d = np.reshape(self.arrlon, self.shape)
+        self._gpi_lut = None
+        self._lat_index = None
+        self.kdTree = None
+        self._reset_nn_links()
+
+    def _regular_search(self, lon, lat):
+        """
+        Nearest neighbour search by index arithmetic if the grid has all
+        points of a regular 2D grid, None otherwise.
+        """
+        if len(self.shape) == 2 and self.allpoints:
+            axes = _regular_axes(np.reshape(lon, self.shape),
+                                 np.reshape(lat, self.shape))
+            if axes is not None:
+                return NN.findRegularNN(*axes, self.geodatum)
+        return None
+
+    def _reset_nn_links(self):
+        """
+        Forget the grid whose kdTree of all points is used for nearest
+        neighbour search, see with_subset.
+        """
+        self._nn_root = None
+        self._nn_full_index = None
+        self._full_tree = None
+        self.__dict__.setdefault("_masked_nn", False)
+
+    def _direct_gpis(self):
+        """
+        gpis of a grid whose gpis are the indices of the points.
+        """
+        dtype = int
+        if getattr(self, "compact", False):
+            dtype = _smallest_int_dtype(np.array([self.n_gpi]))
+        return np.arange(self.n_gpi, dtype=dtype)
+
+    def _derived_attributes(self):
+        """
+        Attributes that are not pickled but recreated from the others.
+        """
+        return ("_active", "lat2d", "lon2d", "kdTree", "_gpi_lut",
+                "_lat_index", "_shared_memory", "_nn_root", "_nn_full_index",
+                "_full_tree")
+
+    def _split_attributes(self):
+        """
+        Attributes that hold the parts of a split grid.
+        """
+        return ("subarrlats", "subarrlons", "subgpis")
+
+    def _set_active_arrays(self):
+        """
+        Reset the arrays of the active grid points, they are computed from
+        the subset when they are used.
+        """
+        self._active = {}
+        self.allpoints = self.subset is None
+
+    def _active_array(self, name):
+        """
+        Active part of a full grid array, computed on first use. It is a
+        view of the full array if there is no subset or the subset is an
+        equally spaced range of indices, otherwise a copy.
+
+        Parameters
+        ----------
+        name : str
+            Name of the full array, e.g. 'arrlon'.
+
+        Returns
+        -------
+        arr : numpy.ndarray
+            Active part of the array.
+        """
+        if name not in self._active:
+            full = getattr(self, name)
+            if self.subset is None:
+                self._active[name] = full
+            else:
+                if "_index" not in self._active:
+                    self._active["_index"] = _subset_slice(self.subset)
+                index = self._active["_index"]
+                self._active[name] = full[
+                    self.subset if index is None else index]
+        return self._active[name]
+
+    @property
+    def activearrlon(self):
+        return self._active_array("arrlon")
+
+    @activearrlon.setter
+    def activearrlon(self, value):
+        self._active["arrlon"] = value
+
+    @property
+    def activearrlat(self):
+        return self._active_array("arrlat")
+
+    @activearrlat.setter
+    def activearrlat(self, value):
+        self._active["arrlat"] = value
+
+    @property
+    def activegpis(self):
+        return self._active_array("gpis")
+
+    @activegpis.setter
+    def activegpis(self, value):
+        self._active["gpis"] = value
+
     def _setup_kdtree(self):
         """
         Setup kdTree
         """
+        if self.kdTree is None and self.allpoints:
+            # the tree of all points that is kept for subset queries
+            self.kdTree = self._full_tree
         if self.kdTree is None:
             self.kdTree = NN.findGeoNN(
                 self.activearrlon,
                 self.activearrlat,
                 self.geodatum,
                 kd_tree_name=self.kd_tree_name,
+                cache_dir=self.kd_tree_cache_dir,
+                dtype=np.float32 if self.compact else np.float64,
             )
             self.kdTree._build_kdtree()
 
+    def _full_kdtree(self):
+        """
+        kdTree of all points of the grid, including the points outside of
+        the subset. Built once on first use.
+        """
+        if self._full_tree is None:
+            if self.allpoints and self.kdTree is not None:
+                self._full_tree = self.kdTree
+            else:
+                self._full_tree = NN.findGeoNN(
+                    self.arrlon,
+                    self.arrlat,
+                    self.geodatum,
+                    kd_tree_name=self.kd_tree_name,
+                    cache_dir=self.kd_tree_cache_dir,
+                    dtype=np.float32 if self.compact else np.float64,
+                )
+                self._full_tree._build_kdtree()
+        return self._full_tree
+
+    def _root_grid(self):
+        """
+        Grid whose kdTree of all points is used for nearest neighbour search
+        if _masked_nn is set.
+        """
+        return self if self._nn_root is None else self._nn_root
+
+    def _root_index(self):
+        """
+        Index of the active points in the arrays of the root grid, None if
+        they are all points of the root grid in the same order.
+        """
+        if self._nn_full_index is None:
+            return self.subset
+        if self.subset is None:
+            return self._nn_full_index
+        return self._nn_full_index[self.subset]
+
+    def _root_to_active(self, root_ind):
+        """
+        Convert indices into the arrays of the root grid to indices into the
+        active arrays of this grid.
+        """
+        if "_root_order" not in self._active:
+            root_index = self._root_index()
+            if np.all(root_index[:-1] <= root_index[1:]):
+                self._active["_root_order"] = (None, root_index)
+            else:
+                order = np.argsort(root_index, kind="stable")
+                self._active["_root_order"] = (order, root_index[order])
+
+        order, sorted_index = self._active["_root_order"]
+        pos = np.searchsorted(sorted_index, root_ind)
+        return pos if order is None else order[pos]
+
+    def with_subset(self, subset):
+        """
+        Grid with the same points as this grid but another subset.
+
+        The new grid shares the coordinate, gpi and cell arrays with this
+        grid. Nearest neighbours are searched in a kdTree of all grid
+        points, which is built once and shared by all grids derived with
+        with_subset, add_to_subset and remove_from_subset. The points
+        outside of the subset are skipped during the search, so changing
+        the subset does not build a new kdTree. Only subsets with less than
+        nearest_neighbor.MASKED_NN_MIN_FRACTION of the points build a kdTree
+        of their own, which is cheap for so few points.
+
+        Parameters
+        ----------
+        subset : numpy.ndarray or None
+            Index into arrlon, arrlat of the active points, None to make
+            all points active.
+
+        Returns
+        -------
+        grid : BasicGrid
+            Grid of the same type with the given subset.
+        """
+        grid = copy.copy(self)
+        grid._nn_root = self._root_grid()
+        grid._full_tree = None
+        grid.kdTree = None
+        grid._set_subset(subset)
+        return grid
+
+    def add_to_subset(self, gpis):
+        """
+        Add grid points to the subset, the grid is changed in place.
+
+        As for with_subset the existing arrays and the kdTree of all grid
+        points are reused.
+
+        Parameters
+        ----------
+        gpis : int or numpy.ndarray
+            Grid point indices to make active.
+        """
+        if self.subset is None:
+            return
+        active = np.zeros(self.n_gpi, dtype=bool)
+        active[self.subset] = True
+        active[self._gpi2index(np.atleast_1d(gpis))] = True
+        self._set_subset(np.flatnonzero(active))
+
+    def remove_from_subset(self, gpis):
+        """
+        Remove grid points from the subset, the grid is changed in place.
+        If the grid has no subset, all other points form the new subset.
+
+        As for with_subset the existing arrays and the kdTree of all grid
+        points are reused.
+
+        Parameters
+        ----------
+        gpis : int or numpy.ndarray
+            Grid point indices to make inactive.
+        """
+        if self.subset is None:
+            active = np.ones(self.n_gpi, dtype=bool)
+        else:
+            active = np.zeros(self.n_gpi, dtype=bool)
+            active[self.subset] = True
+        active[self._gpi2index(np.atleast_1d(gpis))] = False
+        self._set_subset(np.flatnonzero(active))
+
+    def _share_kdtree(self, grid, index):
+        """
+        Let a grid of some points of this grid search nearest neighbours in
+        the kdTree of all points of this grid (or of the grid it is derived
+        from), see with_subset.
+
+        Parameters
+        ----------
+        grid : BasicGrid
+            Grid of the points arrlon[index], arrlat[index] of this grid.
+        index : numpy.ndarray
+            Index into arrlon, arrlat of the points of grid.
+
+        Returns
+        -------
+        grid : BasicGrid
+            The given grid.
+        """
+        grid._nn_root = self._root_grid()
+        if self._nn_full_index is None:
+            grid._nn_full_index = index
+        else:
+            grid._nn_full_index = self._nn_full_index[index]
+        grid._masked_nn = True
+        return grid
+
+    def _set_subset(self, subset):
+        """
+        Replace the subset and reset the data derived from the active
+        points. Nearest neighbours are searched in the kdTree of all points
+        afterwards.
+        """
+        if subset is not None:
+            subset = _subset_array(subset)
+            if self.compact:
+                subset = subset.astype(_smallest_int_dtype(subset),
+                                       copy=False)
+
+        if (self._nn_root is None and self.allpoints
+                and self._full_tree is None):
+            # keep the kdTree of all points
+            self._full_tree = self.kdTree
+        self.kdTree = None
+        self._masked_nn = True
+
+        self.subset = subset
+        self._set_active_arrays()
+        self._lat_index = None
+        self.issplit = False
+
     def split(self, n):
         """
         Function splits the grid into n parts this changes not function but
@@ -368,7 +729,8 @@ class BasicGrid(object):
         lat : float
             longitude of gpi
         """
-        for i, (lon, lat) in enumerate(zip(self.activearrlon, self.activearrlat)):
+        for i, (lon, lat) in enumerate(zip(self.activearrlon,
+                                           self.activearrlat)):
             yield self.activegpis[i], lon, lat
 
     def _split_grid_points(self, n):
@@ -390,10 +752,12 @@ class BasicGrid(object):
             Longitude of gpi.
         """
 
-        for i, (lon, lat) in enumerate(zip(self.subarrlons[n], self.subarrlats[n])):
+        for i, (lon, lat) in enumerate(zip(self.subarrlons[n],
+                                           self.subarrlats[n])):
             yield self.subgpis[n][i], lon, lat
 
-    def find_nearest_gpi(self, lon, lat, max_dist=np.inf):
+    def find_nearest_gpi(self, lon, lat, max_dist=np.inf, metric="cartesian",
+                         mask=None):
         """
         Finds nearest gpi, builds kdTree if it does not yet exist.
 
@@ -405,6 +769,16 @@ class BasicGrid(object):
             Latitude of point.
         max_dist : float, optional
             Maximum distance [m] to consider for search (default: np.inf).
+        metric : str, optional (default: 'cartesian')
+            Distance that is returned and compared to max_dist:
+            'cartesian' for the straight line distance in 3D cartesian
+            coordinates, 'great_circle' for the distance on a sphere with the
+            mean earth radius or 'geodesic' for the distance on the
+            ellipsoid of the grid's geodatum.
+        mask : numpy.ndarray, optional
+            Only search among these points, given as a boolean array of the
+            length of activegpis (or of gpis) or as an array of gpis, see
+            find_k_nearest_gpi.
 
         Returns
         -------
@@ -412,12 +786,12 @@ class BasicGrid(object):
             Grid point index. If no point was found within the maximum
             distance to consider, an empty array is returned.
         distance : float
-            Distance of gpi to given lon, lat.
-            At the moment not on a great circle but in spherical
-            cartesian coordinates. If no point was found within the maximum
-            distance to consider, an empty array is returned.
+            Distance of gpi to given lon, lat, see metric. If no point was
+            found within the maximum distance to consider, an empty array is
+            returned.
         """
-        gpi, distance = self.find_k_nearest_gpi(lon, lat, max_dist=max_dist, k=1)
+        gpi, distance = self.find_k_nearest_gpi(lon, lat, max_dist=max_dist,
+                                                k=1, metric=metric, mask=mask)
 
         if not _element_iterable(lon) and len(gpi) > 0:
             gpi = gpi[0]
@@ -425,7 +799,8 @@ class BasicGrid(object):
 
         return gpi, distance
 
-    def find_k_nearest_gpi(self, lon, lat, max_dist=np.inf, k=1):
+    def find_k_nearest_gpi(self, lon, lat, max_dist=np.inf, k=1,
+                           metric="cartesian", mask=None):
         """
         Find k nearest gpi, builds kdTree if it does not yet exist.
 
@@ -439,21 +814,37 @@ class BasicGrid(object):
             Maximum distance to consider for search (default: np.inf).
         k : int, optional
             The number of nearest neighbors to return (default: 1).
+        metric : str, optional (default: 'cartesian')
+            Distance that is returned and compared to max_dist:
+            'cartesian' for the straight line distance in 3D cartesian
+            coordinates, 'great_circle' for the distance on a sphere with the
+            mean earth radius or 'geodesic' for the distance on the
+            ellipsoid of the grid's geodatum. The neighbours are always
+            searched and ordered by cartesian distance.
+        mask : numpy.ndarray, optional
+            Only search among these points, given as a boolean array of the
+            length of activegpis (or of gpis) or as an array of gpis. The
+            points are searched in the kdTree of the grid, skipping the
+            other points, so no kdTree is built for the mask. By default all
+            active points are searched.
 
         Returns
         -------
         gpi : np.ndarray
             Grid point indices.
         dist : np.ndarray
-            Distance of gpi(s) to given lon, lat.
-            At the moment not on a great circle but in spherical
-            cartesian coordinates.
+            Distance of gpi(s) to given lon, lat, see metric.
         """
-        if self.kdTree is None:
-            self._setup_kdtree()
+        _check_metric(metric)
+        if mask is not None:
+            mask = self._query_mask(mask)
+        dist, ind = self._find_nearest_index(
+            lon, lat, max_dist=self._search_radius(max_dist, metric), k=k,
+            mask=mask)
+        if metric != "cartesian":
+            dist = self._surface_distance(lon, lat, dist, ind, metric,
+                                          max_dist)
 
-        dist, ind = self.kdTree.find_nearest_index(lon, lat,
-                                                   max_dist=max_dist, k=k)
         mask = np.isinf(dist)
         gpi = np.zeros(dist.shape, dtype=np.int32) + np.iinfo(np.int32).max
 
@@ -464,6 +855,244 @@ class BasicGrid(object):
 
         return gpi, dist
 
+    def query_session(self, max_batch, max_dist=np.inf):
+        """
+        Session for many nearest neighbour queries of small batches, that
+        reuses its work arrays between the calls, see QuerySession.
+
+        Parameters
+        ----------
+        max_batch : int
+            Maximum number of points of a query.
+        max_dist : float, optional
+            Maximum cartesian distance [m] to consider for search
+            (default: np.inf).
+
+        Returns
+        -------
+        session : QuerySession
+            Session bound to this grid.
+        """
+        return QuerySession(self, max_batch, max_dist=max_dist)
+
+    def _search_radius(self, max_dist, metric):
+        """
+        Cartesian search radius that contains all points within max_dist
+        of the given metric.
+
+        A straight line is never longer than the geodesic on the
+        ellipsoid. Great circle distances are computed on a sphere with the
+        mean earth radius, which is smaller than the largest radius of
+        curvature a**2 / b of the ellipsoid, so the radius is scaled
+        accordingly.
+
+        Parameters
+        ----------
+        max_dist : float
+            Maximum distance in the given metric.
+        metric : str
+            'cartesian', 'great_circle' or 'geodesic'.
+
+        Returns
+        -------
+        radius : float
+            Cartesian search radius.
+        """
+        if metric == "great_circle":
+            a, b = self.geodatum.geod.a, self.geodatum.geod.b
+            return max_dist * 3 * a ** 2 / (b * (2 * a + b))
+        return max_dist
+
+    def _surface_distance(self, lon, lat, dist, ind, metric, max_dist=np.inf):
+        """
+        Distances on the earth's surface between query points and the
+        nearest neighbours found in cartesian coordinates.
+
+        The neighbours have to be searched with the radius returned by
+        _search_radius, so that all points within max_dist are found.
+
+        Parameters
+        ----------
+        lon : float or iterable
+            Longitude of the query points.
+        lat : float or iterable
+            Latitude of the query points.
+        dist : numpy.ndarray
+            Cartesian distances, np.inf where no neighbour was found.
+        ind : numpy.ndarray
+            Indices of the neighbours in the active arrays.
+        metric : str
+            'great_circle' or 'geodesic'.
+        max_dist : float, optional
+            Maximum distance on the surface.
+
+        Returns
+        -------
+        dist : numpy.ndarray
+            Surface distances, np.inf where no neighbour was found or the
+            distance is larger than max_dist.
+        """
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64)).ravel()
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64)).ravel()
+        if dist.ndim == 2:
+            lon = np.repeat(lon[:, None], dist.shape[1], axis=1)
+            lat = np.repeat(lat[:, None], dist.shape[1], axis=1)
+
+        found = ~np.isinf(dist)
+        nn_lon, nn_lat = self._active_lonlat(ind[found])
+        if metric == "great_circle":
+            surface_dist = self.geodatum.GreatCircleDist(
+                lon[found], lat[found], nn_lon, nn_lat)
+        else:
+            surface_dist = self.geodatum.GeodesicDist(
+                lon[found], lat[found], nn_lon, nn_lat)
+
+        dist = np.full(dist.shape, np.inf)
+        dist[found] = np.where(surface_dist > max_dist, np.inf, surface_dist)
+
+        return dist
+
+    def _active_lonlat(self, index):
+        """
+        Coordinates of active grid points.
+
+        Parameters
+        ----------
+        index : slice or numpy.ndarray
+            Index into the active grid points.
+
+        Returns
+        -------
+        lon : numpy.ndarray
+            Longitudes.
+        lat : numpy.ndarray
+            Latitudes.
+        """
+        return self.activearrlon[index], self.activearrlat[index]
+
+    def _query_mask(self, mask):
+        """
+        Boolean mask of the active points from the mask argument of
+        find_k_nearest_gpi.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray
+            Boolean array of the length of activegpis or gpis, or gpis.
+
+        Returns
+        -------
+        mask : numpy.ndarray
+            Boolean array of the length of activegpis.
+        """
+        mask = np.asarray(mask)
+        n_active = self.n_gpi if self.allpoints else len(self.subset)
+        if mask.dtype == bool:
+            if mask.size == n_active:
+                return mask.ravel()
+            if mask.size != self.n_gpi:
+                raise ValueError(
+                    f"Boolean mask has {mask.size} elements, expected "
+                    f"{n_active} (active points) or {self.n_gpi} (all points)")
+            full_mask = mask.ravel()
+        else:
+            full_mask = np.zeros(self.n_gpi, dtype=bool)
+            full_mask[self._gpi2index(np.atleast_1d(mask).ravel())] = True
+
+        return full_mask if self.allpoints else full_mask[self.subset]
+
+    def _find_nearest_index(self, lon, lat, max_dist=np.inf, k=1, mask=None):
+        """
+        Find the index of the k nearest active points, using the index
+        arithmetic of regular grids where possible and the kdTree otherwise.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray, optional
+            Boolean array, True for the active points that can be returned.
+
+        Returns
+        -------
+        dist : numpy.ndarray
+            Cartesian distances, np.inf where no point was found.
+        ind : numpy.ndarray
+            Indices into the active arrays.
+        """
+        if (self._regular_nn is not None and self.allpoints and k == 1
+                and mask is None):
+            return self._regular_nn.find_nearest_index(lon, lat,
+                                                       max_dist=max_dist)
+
+        if self._masked_nn and not self._small_subset():
+            return self._find_nearest_index_masked(lon, lat, max_dist, k,
+                                                   mask)
+
+        if self.kdTree is None:
+            self._setup_kdtree()
+
+        if mask is None:
+            return self.kdTree.find_nearest_index(lon, lat, max_dist=max_dist,
+                                                  k=k)
+        return self.kdTree.find_nearest_index_masked(
+            lon, lat, mask, max_dist=max_dist, k=k)
+
+    def _small_subset(self):
+        """
+        True if the active points are less than MASKED_NN_MIN_FRACTION of
+        the points of the root grid, so that a kdTree of the active points
+        is cheaper than skipping inactive points in the kdTree of all
+        points.
+        """
+        root_index = self._root_index()
+        return (root_index is not None and root_index.size
+                < NN.MASKED_NN_MIN_FRACTION * self._root_grid().n_gpi)
+
+    def _find_nearest_index_masked(self, lon, lat, max_dist=np.inf, k=1,
+                                   mask=None):
+        """
+        Find the index of the k nearest active points in the kdTree of all
+        points of the root grid, skipping the inactive points.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray, optional
+            Boolean array, True for the active points that can be returned.
+
+        Returns
+        -------
+        dist : numpy.ndarray
+            Cartesian distances, np.inf where no point was found.
+        ind : numpy.ndarray
+            Indices into the active arrays.
+        """
+        root = self._root_grid()
+        tree = root._full_kdtree()
+        root_index = self._root_index()
+        if root_index is None:
+            if mask is None:
+                return tree.find_nearest_index(lon, lat, max_dist=max_dist,
+                                               k=k)
+            return tree.find_nearest_index_masked(lon, lat, mask,
+                                                  max_dist=max_dist, k=k)
+
+        if mask is None:
+            if "_root_mask" not in self._active:
+                root_mask = np.zeros(root.n_gpi, dtype=bool)
+                root_mask[root_index] = True
+                self._active["_root_mask"] = root_mask
+            root_mask = self._active["_root_mask"]
+        else:
+            root_mask = np.zeros(root.n_gpi, dtype=bool)
+            root_mask[root_index[mask]] = True
+
+        dist, ind = tree.find_nearest_index_masked(
+            lon, lat, root_mask, max_dist=max_dist, k=k)
+        found = ~np.isinf(dist)
+        ind[found] = self._root_to_active(ind[found])
+        ind[~found] = root_index.size
+
+        return dist, ind
+
     def gpi2lonlat(self, gpi):
         """
         Longitude and latitude for given gpi.
@@ -483,16 +1112,8 @@ class BasicGrid(object):
         # check if iterable
         iterable = _element_iterable(gpi)
 
-        gpi = np.atleast_1d(gpi)
-        if self.gpidirect:
-            lons, lats = self.arrlon[gpi], self.arrlat[gpi]
-        else:
-            # get the indices that would sort the gpis
-            gpisorted = np.argsort(self.gpis)
-            # find the position where the gpis fit in the sorted array
-            pos = np.searchsorted(self.gpis[gpisorted], gpi)
-            index = gpisorted[pos]
-            lons, lats = self.arrlon[index], self.arrlat[index]
+        index = self._gpi2index(np.atleast_1d(gpi))
+        lons, lats = self.arrlon[index], self.arrlat[index]
 
         if not iterable:
             lons = lons[0]
@@ -500,6 +1121,66 @@ class BasicGrid(object):
 
         return lons, lats
 
+    def _gpi2index(self, gpi):
+        """
+        Index into arrlon, arrlat etc. for given gpis.
+
+        The lookup structure is built once on first use. If the gpi range
+        is compact a dense lookup table is used, otherwise a sorted copy of
+        the gpis with the sorting index, so that the memory stays bounded
+        for very sparse gpi numbers.
+
+        Parameters
+        ----------
+        gpi : numpy.ndarray
+            Grid point indices.
+
+        Returns
+        -------
+        index : numpy.ndarray
+            Index of the gpis in the grid arrays.
+        """
+        if self.gpidirect:
+            return gpi
+
+        if self._gpi_lut is None:
+            self._gpi_lut = self._build_gpi_lut()
+
+        offset, lut, sorted_gpis = self._gpi_lut
+        if sorted_gpis is None:
+            return lut[gpi - offset]
+        else:
+            return lut[np.searchsorted(sorted_gpis, gpi)]
+
+    def _build_gpi_lut(self):
+        """
+        Build the lookup structure used by _gpi2index.
+
+        Returns
+        -------
+        offset : int
+            Smallest gpi, only used for the dense table.
+        lut : numpy.ndarray
+            Dense table of indices for gpi - offset, or indices that sort
+            the gpis.
+        sorted_gpis : numpy.ndarray or None
+            Sorted gpis if a sorted index is used, None for a dense table.
+        """
+        n = self.gpis.size
+        index_dtype = np.int32 if n < np.iinfo(np.int32).max else np.int64
+        if n == 0:
+            return 0, np.zeros(0, dtype=index_dtype), None
+
+        gpimin = int(self.gpis.min())
+        gpirange = int(self.gpis.max()) - gpimin + 1
+        if gpirange <= GPI_LUT_MAX_SPARSITY * n:
+            lut = np.zeros(gpirange, dtype=index_dtype)
+            lut[self.gpis - gpimin] = np.arange(n, dtype=index_dtype)
+            return gpimin, lut, None
+        else:
+            lut = np.argsort(self.gpis, kind="stable").astype(index_dtype)
+            return gpimin, lut, self.gpis[lut]
+
     def gpi2rowcol(self, gpi):
         """
         If the grid can be reshaped into a sensible 2D shape then this
@@ -523,14 +1204,7 @@ class BasicGrid(object):
 
         gpi = np.atleast_1d(gpi)
         if len(self.shape) == 2:
-            if self.gpidirect:
-                index = gpi
-            else:
-                # get the indices that would sort the gpis
-                gpisorted = np.argsort(self.gpis)
-                # find the position where the gpis fit in the sorted array
-                pos = np.searchsorted(self.gpis[gpisorted], gpi)
-                index = gpisorted[pos]
+            index = self._gpi2index(gpi)
 
             index_lat = (index / self.shape[1]).astype(np.int64)
             index_lon = index % self.shape[1]
@@ -542,7 +1216,9 @@ class BasicGrid(object):
         else:
             raise (GridDefinitionError("Grid has no 2D shape"))
 
-    def calc_lut(self, other, max_dist=np.inf, into_subset=False):
+    @timed()
+    def calc_lut(self, other, max_dist=np.inf, into_subset=False,
+                 chunk_size=None, n_workers=1, metric="cartesian"):
         """
         Takes other BasicGrid or CellGrid objects and computes a lookup table
         between them. The lut will have the size of self.n_gpis and will
@@ -562,43 +1238,74 @@ class BasicGrid(object):
             be given as arrays with len(ind_l) elements. These
             datasets can not be indexed with gpi numbers but have to
             be indexed with indices into the subset
+        chunk_size : int, optional
+            if given, the points of this grid are processed in chunks of
+            this size, which limits the memory needed for temporary arrays
+            when both grids are large. By default the points are split into
+            one chunk per worker.
+        n_workers : int, optional (default: 1)
+            number of threads that process chunks in parallel, sharing the
+            search tree of the other grid.
+        metric : str, optional (default: 'cartesian')
+            distance measure for max_dist, 'cartesian', 'great_circle' or
+            'geodesic', see find_k_nearest_gpi.
         """
-
-        if self.kdTree is None:
-            self._setup_kdtree()
-
-        if other.kdTree is None:
+        _check_metric(metric)
+        n_active = self.n_gpi if self.allpoints else len(self.subset)
+        if chunk_size is None:
+            chunk_size = max(-(-n_active // max(n_workers, 1)), 1)
+
+        # set up the search structure once, before it is shared by threads
+        if other._masked_nn and not other._small_subset():
+            other._root_grid()._full_kdtree()
+        elif other._regular_nn is not None and other.allpoints:
+            if other._regular_nn.row_xy is None:
+                other._regular_nn._setup_axes()
+        elif other.kdTree is None:
             other._setup_kdtree()
 
-        if self.kdTree.kdtree is not None and other.kdTree.kdtree is not None:
-            dist, index = other.kdTree.find_nearest_index(
-                self.activearrlon, self.activearrlat, max_dist=max_dist
-            )
+        active_lut = np.empty(n_active, dtype=np.int64)
+        active_lut.fill(-1)
+
+        def lut_chunk(start):
+            lon, lat = self._active_lonlat(slice(start, start + chunk_size))
+            dist, index = other._find_nearest_index(
+                lon, lat, max_dist=other._search_radius(max_dist, metric))
+            if metric != "cartesian" and max_dist != np.inf:
+                dist = other._surface_distance(lon, lat, dist, index, metric,
+                                               max_dist)
 
             valid_index = np.where(dist != np.inf)[0]
-            dist = dist[valid_index]
             index = index[valid_index]
             if not other.gpidirect or not other.allpoints:
                 if not into_subset:
                     index = other.activegpis[index]
 
-            active_lut = np.empty_like(self.activearrlat, dtype=np.int64)
-            active_lut.fill(-1)
-            active_lut[valid_index] = index
-
-            if not self.allpoints:
-                gpi_lut = np.empty_like(self.gpis)
-                gpi_lut.fill(-1)
-                gpi_lut[self.gpis[self.subset]] = active_lut
-            elif not self.gpidirect:
-                gpi_lut = np.empty(np.max(self.activegpis) + 1, dtype=np.int64)
-                gpi_lut.fill(-1)
-                gpi_lut[self.activegpis] = active_lut
-            else:
-                gpi_lut = active_lut
+            active_lut[start + valid_index] = index
+
+        starts = range(0, n_active, chunk_size)
+        if n_workers > 1:
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(lut_chunk, starts))
+        else:
+            for start in starts:
+                lut_chunk(start)
+
+        if self.gpidirect and self.allpoints:
+            gpi_lut = active_lut
+        else:
+            # indexed by the gpis of all points of this grid
+            size = self.n_gpi if self.gpidirect else np.max(self.gpis) + 1
+            gpi_lut = np.empty(size, dtype=np.int64)
+            gpi_lut.fill(-1)
+            gpi_lut[self.activegpis] = active_lut
+
+        if self.compact:
+            gpi_lut = gpi_lut.astype(_smallest_int_dtype(gpi_lut), copy=False)
 
-            return gpi_lut
+        return gpi_lut
 
+    @timed()
     def get_shp_grid_points(self, ply):
         """
         Returns all grid points located in a submitted shapefile,
@@ -616,25 +1323,33 @@ class BasicGrid(object):
         """
 
         if ogr_installed:
+            from osgeo import ogr
             lonmin, lonmax, latmin, latmax = ply.GetEnvelope()
             gpis, lats, lons = self.get_bbox_grid_points(
                 latmin, latmax, lonmin, lonmax, both=True
             )
 
-            lon_ip = []
-            lat_ip = []
-            gpi_ip = []
-
             if len(gpis) > 0:
-                for gpi, lon, lat in zip(gpis, lons, lats):
+                try:
+                    polygons = ogr_polygon_rings(ply)
+                except ValueError:
+                    # unsupported geometry type, test every point with ogr
+                    inside = np.zeros(gpis.shape, dtype=bool)
+                    ambiguous = np.ones(gpis.shape, dtype=bool)
+                else:
+                    inside, ambiguous = points_in_polygons(lons, lats,
+                                                           polygons)
+
+                # points on the polygon boundary are decided by ogr
+                for i in np.flatnonzero(ambiguous):
                     pt = ogr.Geometry(ogr.wkbPoint)
-                    pt.SetPoint_2D(0, float(lon), float(lat))
-                    if ply.Contains(pt):
-                        lon_ip.append(lon)
-                        lat_ip.append(lat)
-                        gpi_ip.append(gpi)
-            if len(gpi_ip) > 0:
-                return self.subgrid_from_gpis(gpi_ip)
+                    pt.SetPoint_2D(0, float(lons[i]), float(lats[i]))
+                    inside[i] = ply.Contains(pt)
+
+                gpis = gpis[inside]
+
+            if len(gpis) > 0:
+                return self.subgrid_from_gpis(gpis)
             else:
                 return None
 
@@ -650,24 +1365,43 @@ class BasicGrid(object):
 
     def _index_bbox_grid_points(
         self,
-        gp_info: np.array,
         latmin: float,
         latmax: float,
         lonmin: float,
         lonmax: float,
-    ) -> (np.array, np.array):
+    ) -> np.array:
+        """
+        Index into the active arrays of the points in a bounding box.
 
-        index = np.where(
-            (gp_info[2] <= latmax)
-            & (gp_info[2] >= latmin)
-            & (gp_info[1] <= lonmax)
-            & (gp_info[1] >= lonmin)
-        )
+        The points are looked up in a latitude sorted index that is built
+        on first use, so only the latitude band of the box is scanned.
+        If lonmin is larger than lonmax the box crosses the antimeridian.
 
-        return index
+        Returns
+        -------
+        index : numpy.ndarray
+            Sorted index into activegpis, activearrlon, activearrlat.
+        """
+        if self._lat_index is None:
+            order = np.argsort(self.activearrlat, kind="stable")
+            self._lat_index = (order, self.activearrlat[order])
+
+        order, sorted_lats = self._lat_index
+        band = order[
+            np.searchsorted(sorted_lats, latmin, side="left"):
+            np.searchsorted(sorted_lats, latmax, side="right")
+        ]
+        lons = self.activearrlon[band]
+        if lonmin <= lonmax:
+            inside = (lons >= lonmin) & (lons <= lonmax)
+        else:
+            inside = (lons >= lonmin) | (lons <= lonmax)
+
+        return np.sort(band[inside])
 
     def get_bbox_grid_points(
-        self, latmin=-90, latmax=90, lonmin=-180, lonmax=180, coords=False, both=False
+        self, latmin=-90, latmax=90, lonmin=-180, lonmax=180, coords=False,
+        both=False
     ):
         """
         Returns all grid points located in a submitted geographic box,
@@ -680,9 +1414,10 @@ class BasicGrid(object):
         latmax : float, optional (default: 90)
             maximum latitude
         lonmin : float, optional (default: -180)
-            minimum latitude
+            minimum longitude, if larger than lonmax the box crosses
+            the antimeridian
         lonmax : float, optional (default: 180)
-            maximum latitude
+            maximum longitude
         coords : boolean, optional (default: False)
             set to True if coordinates should be returned
         both: boolean, optional (default: False)
@@ -701,10 +1436,8 @@ class BasicGrid(object):
         if self.issplit:
             raise NotImplementedError
 
-        gp_info = self.get_grid_points()
-
-        index = self._index_bbox_grid_points(gp_info, latmin, latmax, lonmin, lonmax)
-        gpis, lons, lats = gp_info
+        index = self._index_bbox_grid_points(latmin, latmax, lonmin, lonmax)
+        gpis, lons, lats = self.get_grid_points()
 
         if coords is True:
             return lats[index], lons[index]
@@ -751,11 +1484,14 @@ class BasicGrid(object):
             gpis=gpis,
             subset=self.subset,
             shape=self.shape,
+            geodatum=self.geodatum.name,
+            kd_tree_name=self.kd_tree_name,
         )
 
     def subgrid_from_gpis(self, gpis):
         """
-        Generate a subgrid for given gpis.
+        Generate a subgrid for given gpis. The subgrid searches nearest
+        neighbours in the kdTree of this grid instead of building its own.
 
         Parameters
         ----------
@@ -767,9 +1503,12 @@ class BasicGrid(object):
         grid : BasicGrid
             Subgrid.
         """
-        sublons, sublats = self.gpi2lonlat(gpis)
+        index = self._gpi2index(np.atleast_1d(gpis))
 
-        return BasicGrid(sublons, sublats, gpis, geodatum=self.geodatum.name)
+        return self._share_kdtree(
+            BasicGrid(self.arrlon[index], self.arrlat[index], gpis,
+                      geodatum=self.geodatum.name, setup_kdTree=False),
+            index)
 
     def __eq__(self, other):
         """
@@ -780,6 +1519,8 @@ class BasicGrid(object):
         result : boolean
             Returns True if grids are equal.
         """
+        import numpy.testing as nptest
+
         # only test to certain significance for float variables
         # grids are assumed to be the same if the gpi, lon, lat tuples are the
         # same
@@ -787,18 +1528,21 @@ class BasicGrid(object):
         idx_gpi_other = np.argsort(other.gpis)
         gpisame = np.array_equal(self.gpis[idx_gpi], other.gpis[idx_gpi_other])
         try:
-            nptest.assert_allclose(self.arrlon[idx_gpi], other.arrlon[idx_gpi_other])
+            nptest.assert_allclose(self.arrlon[idx_gpi],
+                                   other.arrlon[idx_gpi_other])
             lonsame = True
         except AssertionError:
             lonsame = False
         try:
-            nptest.assert_allclose(self.arrlat[idx_gpi], other.arrlat[idx_gpi_other])
+            nptest.assert_allclose(self.arrlat[idx_gpi],
+                                   other.arrlat[idx_gpi_other])
             latsame = True
         except AssertionError:
             latsame = False
         if self.subset is not None and other.subset is not None:
             subsetsame = np.all(
-                sorted(self.gpis[self.subset]) == sorted(other.gpis[other.subset])
+                sorted(self.gpis[self.subset])
+                == sorted(other.gpis[other.subset])
             )
         elif self.subset is None and other.subset is None:
             subsetsame = True
@@ -817,7 +1561,321 @@ class BasicGrid(object):
         else:
             geosame = False
 
-        return np.all([lonsame, latsame, gpisame, subsetsame, shapesame, geosame])
+        return np.all([lonsame, latsame, gpisame, subsetsame, shapesame,
+                       geosame])
+
+
+class RegularGrid(BasicGrid):
+
+    """
+    Regular lon/lat grid that only stores the equally spaced longitude and
+    latitude dimensions. The grid point coordinates and gpis are the same as
+    for a grid created with :py:func:`gridfromdims`, but arrlon, arrlat and
+    gpis are only computed when they are accessed for the first time.
+    Lookups by gpi, bounding box queries and nearest neighbour search work
+    on the dimensions directly, so even very high resolution grids can be
+    used without materializing the coordinate arrays.
+
+    Parameters
+    ----------
+    londim : numpy.ndarray
+        Equally spaced longitude dimension.
+    latdim : numpy.ndarray
+        Equally spaced latitude dimension.
+    origin : Literal['bottom', 'top'], optional (default: 'top')
+        If bottom is selected, the GPI origin is at (min_lon, min_lat),
+        i.e. in the bottom left corner.
+        If 'top' is selected, the origin is at (min_lon, max_lat),
+        i.e. in the top left corner
+    geodatum : basestring
+        Name of the geodatic datum associated with the grid
+    setup_kdTree : boolean, optional (default: False)
+        If True the kdTree is built on initialization, otherwise when it is
+        first used. It is only used if more than one nearest neighbour is
+        requested, the nearest neighbour is found without a kdTree.
+    transform_lon : bool or None, optional (default: None)
+        Whether to transform longitudes to values between -180 and 180.
+        By default values are transformed, but a warning is issued.
+        To turn off the warning, set this to ``True``, to turn of
+        transformation set this to ``False``.
+    kd_tree_name: str, optional (default: 'pykdtree')
+        KDTree engine, 'pykdtree' or 'scipy'
+    kd_tree_cache_dir: str, optional (default: None)
+        Directory in which the kdTree coordinates are cached.
+
+    Attributes
+    ----------
+    londim : numpy.ndarray
+        Longitudes of the grid columns.
+    latdim : numpy.ndarray
+        Latitudes of the grid rows, in the order of the gpis.
+    """
+
+    def __init__(
+        self,
+        londim,
+        latdim,
+        origin="top",
+        geodatum="WGS84",
+        setup_kdTree=False,
+        transform_lon=None,
+        kd_tree_name="pykdtree",
+        kd_tree_cache_dir=None,
+    ):
+        londim = np.array(londim, dtype=np.float64, ndmin=1)
+        latdim = np.array(latdim, dtype=np.float64, ndmin=1)
+
+        if origin.lower() == "bottom":
+            latdim = latdim[::-1]
+        elif origin.lower() != "top":
+            raise ValueError(
+                f"Unexpected origin passed, expected 'top' or 'bottom' "
+                f"got {origin.lower()}"
+            )
+
+        if not (_equally_spaced(londim) and _equally_spaced(latdim)):
+            raise GridDefinitionError(
+                "londim and latdim have to be equally spaced and have at "
+                "least two elements")
+
+        self.geodatum = GeodeticDatum(geodatum)
+        # the nearest neighbour search works with longitudes > 180 as well
+        self._regular_nn = NN.findRegularNN(londim, latdim, self.geodatum)
+
+        if transform_lon or transform_lon is None:
+            if np.any(londim > 180):
+                londim[londim > 180] -= 360
+                if transform_lon is None:
+                    warnings.warn(
+                        "Longitude values have been transformed to be in"
+                        " (-180, 180]. If this was not intended or to suppress"
+                        " this warning set the transform_lon keyword argument"
+                    )
+
+        self.londim = londim
+        self.latdim = latdim
+        self.shape = (latdim.size, londim.size)
+        self.n_gpi = latdim.size * londim.size
+        self.gpidirect = True
+        self.subset = None
+        self.allpoints = True
+        self.issplit = False
+        self.compact = False
+        self._arrays = None
+        self._gpi_lut = None
+        self._lat_index = None
+
+        self.kd_tree_name = kd_tree_name
+        self.kd_tree_cache_dir = kd_tree_cache_dir
+        self.kdTree = None
+        self._reset_nn_links()
+
+        if setup_kdTree:
+            self._setup_kdtree()
+
+    def __setstate__(self, state):
+        state = _old_grid_state(state)
+        self.__dict__.update(state)
+        if "_regular_nn" not in state:
+            self._regular_nn = NN.findRegularNN(self.londim, self.latdim,
+                                                self.geodatum)
+        self._arrays = None
+        self._gpi_lut = None
+        self._lat_index = None
+        self.kdTree = None
+        self._reset_nn_links()
+
+    def _derived_attributes(self):
+        """
+        Attributes that are not pickled but recreated from the others.
+        """
+        return ("_arrays", "kdTree", "_gpi_lut", "_lat_index",
+                "_shared_memory", "_nn_root", "_nn_full_index", "_full_tree")
+
+    def _materialize(self):
+        """
+        Compute (once) the coordinate and gpi arrays of all grid points.
+        """
+        if self._arrays is None:
+            self._arrays = (
+                np.tile(self.londim, self.shape[0]),
+                np.repeat(self.latdim, self.shape[1]),
+                np.arange(self.n_gpi),
+            )
+        return self._arrays
+
+    @property
+    def arrlon(self):
+        return self._materialize()[0]
+
+    @property
+    def arrlat(self):
+        return self._materialize()[1]
+
+    @property
+    def gpis(self):
+        return self._materialize()[2]
+
+    activearrlon = arrlon
+    activearrlat = arrlat
+    activegpis = gpis
+
+    @property
+    def lon2d(self):
+        return np.broadcast_to(self.londim[None, :], self.shape)
+
+    @property
+    def lat2d(self):
+        return np.broadcast_to(self.latdim[:, None], self.shape)
+
+    def gpi2lonlat(self, gpi):
+        """
+        Longitude and latitude for given gpi.
+
+        Parameters
+        ----------
+        gpi : int32 or iterable
+            Grid point index.
+
+        Returns
+        -------
+        lon : float
+            Longitude of gpi.
+        lat : float
+            Latitude of gpi
+        """
+        iterable = _element_iterable(gpi)
+
+        row, col = np.divmod(np.atleast_1d(gpi), self.shape[1])
+        lons, lats = self.londim[col], self.latdim[row]
+
+        if not iterable:
+            lons = lons[0]
+            lats = lats[0]
+
+        return lons, lats
+
+    def _active_lonlat(self, index):
+        """
+        Coordinates of grid points by slice or index, computed from the
+        dimensions.
+        """
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(self.n_gpi))
+        return self.gpi2lonlat(np.atleast_1d(index))
+
+    def get_bbox_grid_points(
+        self, latmin=-90, latmax=90, lonmin=-180, lonmax=180, coords=False,
+        both=False
+    ):
+        """
+        Returns all grid points located in a submitted geographic box,
+        optional as coordinates.
+
+        Parameters
+        ----------
+        latmin : float, optional (default: -90)
+            minimum latitude
+        latmax : float, optional (default: 90)
+            maximum latitude
+        lonmin : float, optional (default: -180)
+            minimum longitude, if larger than lonmax the box crosses
+            the antimeridian
+        lonmax : float, optional (default: 180)
+            maximum longitude
+        coords : boolean, optional (default: False)
+            set to True if coordinates should be returned
+        both: boolean, optional (default: False)
+            set to True if gpis and coordinates should be returned
+
+        Returns
+        -------
+        gpi : numpy.ndarray
+            grid point indices, if coords=False
+        lat : numpy.ndarray
+            longitudes of gpis, if coords=True
+        lon : numpy.ndarray
+            longitudes of gpis, if coords=True
+        """
+        if self.issplit:
+            raise NotImplementedError
+
+        rows = np.flatnonzero((self.latdim >= latmin)
+                              & (self.latdim <= latmax))
+        if lonmin <= lonmax:
+            cols = (self.londim >= lonmin) & (self.londim <= lonmax)
+        else:
+            cols = (self.londim >= lonmin) | (self.londim <= lonmax)
+        cols = np.flatnonzero(cols)
+
+        gpis = (rows[:, None] * self.shape[1] + cols[None, :]).flatten()
+        lats = np.repeat(self.latdim[rows], cols.size)
+        lons = np.tile(self.londim[cols], rows.size)
+
+        if coords is True:
+            return lats, lons
+        elif both:
+            return gpis, lats, lons
+        else:
+            return gpis
+
+    def subgrid_from_gpis(self, gpis):
+        """
+        Generate a subgrid for given gpis. The subgrid searches nearest
+        neighbours in the kdTree of this grid instead of building its own.
+
+        Parameters
+        ----------
+        gpis : int, numpy.ndarray
+            Grid point indices.
+
+        Returns
+        -------
+        grid : BasicGrid
+            Subgrid.
+        """
+        gpis = np.atleast_1d(gpis)
+        sublons, sublats = self.gpi2lonlat(gpis)
+
+        return self._share_kdtree(
+            BasicGrid(sublons, sublats, gpis, geodatum=self.geodatum.name,
+                      setup_kdTree=False),
+            gpis)
+
+    def with_subset(self, subset):
+        """
+        BasicGrid with the points of this grid and the given subset. The
+        nearest neighbours are searched in the kdTree of this grid, see
+        BasicGrid.with_subset.
+
+        Parameters
+        ----------
+        subset : numpy.ndarray or None
+            Index of the active points, None to make all points active.
+
+        Returns
+        -------
+        grid : BasicGrid
+            Grid with the given subset.
+        """
+        grid = BasicGrid(
+            self.arrlon,
+            self.arrlat,
+            geodatum=self.geodatum.name,
+            setup_kdTree=False,
+            shape=self.shape,
+            transform_lon=False,
+            kd_tree_name=self.kd_tree_name,
+            kd_tree_cache_dir=self.kd_tree_cache_dir,
+        )
+        grid._nn_root = self
+        grid._set_subset(subset)
+        return grid
+
+    def _set_subset(self, subset):
+        raise GridDefinitionError(
+            "RegularGrid has no subset, use with_subset to get a BasicGrid "
+            "with a subset")
 
 
 class CellGrid(BasicGrid):
@@ -843,7 +1901,8 @@ class CellGrid(BasicGrid):
     subset : numpy.array, optional
         If the active part of the array is only a subset of all the points
         then the subset array which is a index into lon, lat and cells can
-        be given here.
+        be given here. A boolean mask of all points is converted to the
+        index of its True elements.
 
     Attributes
     ----------
@@ -863,6 +1922,7 @@ class CellGrid(BasicGrid):
         geodatum="WGS84",
         subset=None,
         setup_kdTree=False,
+        copy=False,
         **kwargs,
     ):
 
@@ -873,11 +1933,13 @@ class CellGrid(BasicGrid):
             geodatum=geodatum,
             subset=subset,
             setup_kdTree=setup_kdTree,
+            copy=copy,
             **kwargs,
         )
 
-        self.gpi_lut = None
-        cells = np.atleast_1d(cells)
+        cells = _as_array(cells, copy)
+        if self.compact:
+            cells = cells.astype(_smallest_int_dtype(cells), copy=False)
 
         if self.arrlon.shape != cells.shape:
             raise GridDefinitionError(
@@ -885,10 +1947,134 @@ class CellGrid(BasicGrid):
             )
         self.arrcell = cells
 
-        if subset is not None:
-            self.activearrcell = self.arrcell[subset]
-        else:
-            self.activearrcell = self.arrcell
+        self._cell_csr = None
+        self._cell_order = None
+        self.split_cells = None
+
+    def __setstate__(self, state):
+        super(CellGrid, self).__setstate__(state)
+        self.__dict__.setdefault("split_cells", None)
+        self._cell_csr = None
+        self._cell_order = None
+
+    @property
+    def activearrcell(self):
+        return self._active_array("arrcell")
+
+    @activearrcell.setter
+    def activearrcell(self, value):
+        self._active["arrcell"] = value
+
+    def _derived_attributes(self):
+        """
+        Attributes that are not pickled but recreated from the others.
+        """
+        return super(CellGrid, self)._derived_attributes() + (
+            "_cell_csr", "_cell_order")
+
+    def _split_attributes(self):
+        """
+        Attributes that hold the parts of a split grid.
+        """
+        return super(CellGrid, self)._split_attributes() + (
+            "subcells", "split_cells")
+
+    def _cell_index(self):
+        """
+        Index of the active grid points grouped by cell (CSR layout). Built
+        once on first use.
+
+        Returns
+        -------
+        cells : numpy.ndarray
+            Sorted unique cell numbers.
+        offsets : numpy.ndarray
+            The points of cells[i] are order[offsets[i]:offsets[i + 1]].
+        order : numpy.ndarray
+            Stable sorting index of activearrcell.
+        """
+        if self._cell_csr is None:
+            full_order = self._full_cell_order(build=self._masked_nn)
+            if self.allpoints and full_order is not None:
+                order = full_order
+            elif (full_order is not None
+                  and np.all(self.subset[:-1] < self.subset[1:])):
+                # the points of a sorted subset keep the order they have
+                # among all points, no need to sort the cells again
+                active = np.zeros(self.n_gpi, dtype=bool)
+                active[self.subset] = True
+                full_order = full_order[active[full_order]]
+                order = (np.cumsum(active) - 1)[full_order]
+            else:
+                order = np.argsort(self.activearrcell, kind="stable")
+
+            sorted_cells = self.activearrcell[order]
+            starts = np.flatnonzero(sorted_cells[1:] != sorted_cells[:-1]) + 1
+            if sorted_cells.size > 0:
+                starts = np.append(0, starts)
+            offsets = np.append(starts, order.size)
+            self._cell_csr = (sorted_cells[starts], offsets, order)
+
+        return self._cell_csr
+
+    def _full_cell_order(self, build=True):
+        """
+        Stable sorting index of the cells of all grid points (arrcell). It
+        is shared with the grids derived by with_subset, whose cell index
+        is built from it.
+
+        Parameters
+        ----------
+        build : bool, optional (default: True)
+            Build the sorting index if it does not exist yet, otherwise
+            None is returned in that case.
+
+        Returns
+        -------
+        order : numpy.ndarray or None
+            Sorting index of arrcell.
+        """
+        owner = self
+        if (isinstance(self._nn_root, CellGrid)
+                and self._nn_full_index is None):
+            owner = self._nn_root
+        if owner._cell_order is None:
+            if owner.allpoints and owner._cell_csr is not None:
+                owner._cell_order = owner._cell_csr[2]
+            elif build or owner.allpoints:
+                owner._cell_order = np.argsort(owner.arrcell, kind="stable")
+        return owner._cell_order
+
+    def _set_subset(self, subset):
+        super(CellGrid, self)._set_subset(subset)
+        self._cell_csr = None
+        self.split_cells = None
+
+    def _cell_point_index(self, cells):
+        """
+        Index into the active arrays of all points in the given cells.
+
+        Parameters
+        ----------
+        cells : numpy.ndarray
+            Cell numbers.
+
+        Returns
+        -------
+        index : numpy.ndarray
+            Index into activegpis, activearrlon, ... in order of the given
+            cells.
+        """
+        uniq_cells, offsets, order = self._cell_index()
+        pos = np.searchsorted(uniq_cells, cells)
+        slices = [
+            order[offsets[p]:offsets[p + 1]]
+            for p, cell in zip(pos, cells)
+            if p < uniq_cells.size and uniq_cells[p] == cell
+        ]
+        if len(slices) == 0:
+            return order[:0]
+        return np.concatenate(slices)
 
     def gpi2cell(self, gpi):
         """
@@ -907,15 +2093,7 @@ class CellGrid(BasicGrid):
         # check if iterable
         iterable = _element_iterable(gpi)
 
-        gpi = np.atleast_1d(gpi)
-        if self.gpidirect:
-            cell = self.arrcell[gpi]
-        else:
-            if self.gpi_lut is None:
-                self.gpi_lut = np.zeros(self.gpis.max() + 1, dtype=np.int32)
-                self.gpi_lut[self.gpis] = np.arange(self.gpis.size)
-
-            cell = self.arrcell[self.gpi_lut[gpi]]
+        cell = self.arrcell[self._gpi2index(np.atleast_1d(gpi))]
 
         if not iterable:
             cell = cell[0]
@@ -931,7 +2109,7 @@ class CellGrid(BasicGrid):
         cells : numpy.ndarray
             Unique cell numbers.
         """
-        return np.unique(self.activearrcell)
+        return self._cell_index()[0].copy()
 
     def get_grid_points(self, *args):
         """
@@ -989,24 +2167,12 @@ class CellGrid(BasicGrid):
         lats : numpy.array
             Latitudes belonging to the gpis.
         """
-        cells = np.atleast_1d(cells)
-
-        gpis = []
-        lons = []
-        lats = []
-        for cell in cells:
-            cell_index = np.where(cell == self.activearrcell)
-            gpis.append(self.activegpis[cell_index])
-            lons.append(self.activearrlon[cell_index])
-            lats.append(self.activearrlat[cell_index])
-
-        gpis = np.hstack(gpis)
-        lons = np.hstack(lons)
-        lats = np.hstack(lats)
+        index = self._cell_point_index(np.atleast_1d(cells))
 
-        return gpis, lons, lats
+        return (self.activegpis[index], self.activearrlon[index],
+                self.activearrlat[index])
 
-    def split(self, n):
+    def split(self, n, by_cell=False, cell_costs=None):
         """
         Function splits the grid into n parts this changes not function but
         grid_points() which takes the argument n and will only iterate through
@@ -1016,15 +2182,80 @@ class CellGrid(BasicGrid):
         ----------
         n : int
             Number of parts the grid should be split into.
+        by_cell : boolean, optional (default: False)
+            If True, whole cells are assigned to the parts, balanced by the
+            number of points per cell, see partition_cells. Otherwise the
+            cell sorted points are split into parts of equal size, which
+            may cut through cells.
+        cell_costs : numpy.ndarray or dict, optional
+            Cost of each cell used to balance the parts, implies
+            by_cell=True. See partition_cells.
         """
+        if by_cell or cell_costs is not None:
+            self.split_cells = self.partition_cells(n, cell_costs)
+            parts = [self._cell_point_index(cells)
+                     for cells in self.split_cells]
+            self.subarrlats = [self.activearrlat[i] for i in parts]
+            self.subarrlons = [self.activearrlon[i] for i in parts]
+            self.subgpis = [self.activegpis[i] for i in parts]
+            self.subcells = [self.activearrcell[i] for i in parts]
+            self.issplit = True
+            return
+
         self.issplit = True
+        self.split_cells = None
         # sort by cell number to split correctly
-        sorted_index = np.argsort(self.activearrcell)
+        sorted_index = self._cell_index()[2]
         self.subarrlats = np.array_split(self.activearrlat[sorted_index], n)
         self.subarrlons = np.array_split(self.activearrlon[sorted_index], n)
         self.subgpis = np.array_split(self.activegpis[sorted_index], n)
         self.subcells = np.array_split(self.activearrcell[sorted_index], n)
 
+    def partition_cells(self, n, cell_costs=None):
+        """
+        Assign whole cells to n parts with balanced total cost, using the
+        longest processing time first rule: cells are taken in order of
+        decreasing cost and each is assigned to the part with the lowest
+        total cost so far.
+
+        Parameters
+        ----------
+        n : int
+            Number of parts.
+        cell_costs : numpy.ndarray or dict, optional
+            Cost of each cell, either an array in the order of get_cells()
+            or a dict of cell: cost, cells missing in the dict have a cost
+            of 0. By default the number of active points in a cell.
+
+        Returns
+        -------
+        parts : list of numpy.ndarray
+            Sorted cell numbers of each of the n parts. Parts can be empty
+            if there are less cells than parts.
+        """
+        cells, offsets, _ = self._cell_index()
+        if cell_costs is None:
+            costs = np.diff(offsets)
+        elif isinstance(cell_costs, dict):
+            costs = np.array([cell_costs.get(c, 0) for c in cells],
+                             dtype=np.float64)
+        else:
+            costs = np.asarray(cell_costs, dtype=np.float64)
+            if costs.shape != cells.shape:
+                raise ValueError(
+                    f"cell_costs has to contain one cost per cell, "
+                    f"{costs.size} given for {cells.size} cells")
+
+        assignment = np.zeros(cells.size, dtype=int)
+        loads = [(0, part) for part in range(n)]
+        # ties are broken by cell number for a reproducible partitioning
+        for i in np.lexsort((cells, -costs)):
+            load, part = heapq.heappop(loads)
+            assignment[i] = part
+            heapq.heappush(loads, (load + costs[i], part))
+
+        return [cells[assignment == part] for part in range(n)]
+
     def _normal_grid_points(self):
         """
         Yields all grid points in cell order.
@@ -1040,14 +2271,12 @@ class CellGrid(BasicGrid):
         cell : int
             Cell number.
         """
-        uniq_cells = np.unique(self.activearrcell)
+        uniq_cells, offsets, order = self._cell_index()
 
-        for cell in uniq_cells:
-            cell_gpis = np.where(cell == self.activearrcell)[0]
-            for gpi in cell_gpis:
-                yield self.activegpis[gpi], self.activearrlon[gpi], self.activearrlat[
-                    gpi
-                ], cell
+        for i, cell in enumerate(uniq_cells):
+            for gpi in order[offsets[i]:offsets[i + 1]]:
+                yield (self.activegpis[gpi], self.activearrlon[gpi],
+                       self.activearrlat[gpi], cell)
 
     def _split_grid_points(self, n):
         """
@@ -1069,18 +2298,69 @@ class CellGrid(BasicGrid):
         cell : int
             Cell number.
         """
-        uniq_cells = np.unique(self.subcells[n])
+        # the split arrays are already sorted by cell
+        for gpi, lon, lat, cell in zip(self.subgpis[n], self.subarrlons[n],
+                                       self.subarrlats[n], self.subcells[n]):
+            yield gpi, lon, lat, cell
+
+    def iter_cell_batches(self, *args):
+        """
+        Yields the active grid points cell by cell in cell order, as arrays
+        of all points in a cell.
+
+        Parameters
+        ----------
+        n : int, optional
+            If the grid is split in n parts using the split function then
+            this iterator will only iterate over the nth part of the grid.
+            A cell may be spread over two neighbouring parts.
+
+        Returns
+        -------
+        cell : int
+            Cell number.
+        gpis : numpy.ndarray
+            Grid point indices in the cell.
+        lons : numpy.ndarray
+            Longitudes of the gpis.
+        lats : numpy.ndarray
+            Latitudes of the gpis.
+        """
+        if not self.issplit and len(args) == 0:
+            order = self._cell_index()[2]
+            gpis = self.activegpis[order]
+            lons = self.activearrlon[order]
+            lats = self.activearrlat[order]
+            cells = self.activearrcell[order]
+        elif self.issplit and len(args) == 1:
+            n = args[0]
+            gpis, lons, lats, cells = (self.subgpis[n], self.subarrlons[n],
+                                       self.subarrlats[n], self.subcells[n])
+        else:
+            raise GridIterationError(
+                "this function only takes an argument if "
+                "the grid is split, and takes no argument "
+                "if the grid is not split"
+            )
+
+        return self._cell_batches(gpis, lons, lats, cells)
 
-        for cell in uniq_cells:
-            cell_gpis = np.where(cell == self.subcells[n])[0]
-            for gpi in cell_gpis:
-                yield self.subgpis[n][gpi], self.subarrlons[n][gpi], self.subarrlats[n][
-                    gpi
-                ], cell
+    @staticmethod
+    def _cell_batches(gpis, lons, lats, cells):
+        """
+        Yield views of cell sorted arrays, one per cell.
+        """
+        bounds = np.concatenate(
+            ([0], np.flatnonzero(np.diff(cells)) + 1, [cells.size]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if start < end:
+                yield (cells[start], gpis[start:end], lons[start:end],
+                       lats[start:end])
 
     def subgrid_from_gpis(self, gpis):
         """
-        Generate a subgrid for given gpis.
+        Generate a subgrid for given gpis. The subgrid searches nearest
+        neighbours in the kdTree of this grid instead of building its own.
 
         Parameters
         ----------
@@ -1092,14 +2372,17 @@ class CellGrid(BasicGrid):
         grid : BasicGrid
             Subgrid.
         """
-        sublons, sublats = self.gpi2lonlat(gpis)
-        subcells = self.gpi2cell(gpis)
+        index = self._gpi2index(np.atleast_1d(gpis))
 
-        return CellGrid(sublons, sublats, subcells, gpis, geodatum=self.geodatum.name)
+        return self._share_kdtree(
+            CellGrid(self.arrlon[index], self.arrlat[index],
+                     self.arrcell[index], gpis, geodatum=self.geodatum.name),
+            index)
 
     def subgrid_from_cells(self, cells):
         """
-        Generate a subgrid for given cells.
+        Generate a subgrid for given cells. The subgrid searches nearest
+        neighbours in the kdTree of this grid instead of building its own.
 
         Parameters
         ----------
@@ -1111,12 +2394,17 @@ class CellGrid(BasicGrid):
         grid : CellGrid
             Subgrid.
         """
-        subgpis, sublons, sublats = self.grid_points_for_cell(cells)
-        subcells = self.gpi2cell(subgpis)
-
-        return CellGrid(
-            sublons, sublats, subcells, subgpis, geodatum=self.geodatum.name
+        index = self._cell_point_index(np.atleast_1d(cells))
+
+        grid = CellGrid(
+            self.activearrlon[index],
+            self.activearrlat[index],
+            self.activearrcell[index],
+            self.activegpis[index],
+            geodatum=self.geodatum.name,
         )
+        return self._share_kdtree(
+            grid, index if self.allpoints else self.subset[index])
 
     def __eq__(self, other):
         """
@@ -1130,7 +2418,8 @@ class CellGrid(BasicGrid):
         basicsame = super(CellGrid, self).__eq__(other)
         idx_gpi = np.argsort(self.gpis)
         idx_gpi_other = np.argsort(other.gpis)
-        cellsame = np.array_equal(self.arrcell[idx_gpi], other.arrcell[idx_gpi_other])
+        cellsame = np.array_equal(self.arrcell[idx_gpi],
+                                  other.arrcell[idx_gpi_other])
         return np.all([basicsame, cellsame])
 
     def get_bbox_grid_points(
@@ -1154,16 +2443,18 @@ class CellGrid(BasicGrid):
         latmax : float, optional (default: 90)
             maximum latitude
         lonmin : float, optional (default: -180)
-            minimum latitude
+            minimum longitude, if larger than lonmax the box crosses
+            the antimeridian
         lonmax : float, optional (default: 180)
-            maximum latitude
+            maximum longitude
         coords : boolean, optional (default: False)
             set to True if coordinates should be returned
         both: boolean, optional (default: False)
             set to True if gpis and coordinates should be returned
         sort_by_cells: bool, optional (default: True)
-            Points in the bbox are grouped by cells (so that e.g. when iterating
-            over them you can read data from a cell that is already in memory).
+            Points in the bbox are grouped by cells (so that e.g. when
+            iterating over them you can read data from a cell that is already
+            in memory).
 
         Returns
         -------
@@ -1175,17 +2466,17 @@ class CellGrid(BasicGrid):
             longitudes of gpis, if coords=True
         """
 
-        gp_info = self.get_grid_points()
-
-        index = self._index_bbox_grid_points(gp_info, latmin, latmax, lonmin, lonmax)
+        index = self._index_bbox_grid_points(latmin, latmax, lonmin, lonmax)
 
-        gpis, lons, lats, cells = gp_info
+        gpis, lons, lats, cells = self.get_grid_points()
 
-        gpis, lons, lats, cells = gpis[index], lons[index], lats[index], cells[index]
+        gpis, lons, lats, cells = (gpis[index], lons[index], lats[index],
+                                   cells[index])
 
         if sort_by_cells:
             indx = np.lexsort((gpis, cells))
-            gpis, lons, lats, cells = gpis[indx], lons[indx], lats[indx], cells[indx]
+            gpis, lons, lats, cells = (gpis[indx], lons[indx], lats[indx],
+                                       cells[indx])
 
         if coords is True:
             return lats, lons
@@ -1195,6 +2486,116 @@ class CellGrid(BasicGrid):
             return gpis
 
 
+class QuerySession(object):
+    """
+    Nearest neighbour search of many small batches of points in the
+    kdTree of a grid.
+
+    The cartesian coordinates of the query points, the work arrays of the
+    transformation and the results are kept in arrays allocated once for
+    max_batch points, only the kdTree query itself allocates its
+    distance and index arrays. The results are the same as those of
+    BasicGrid.find_nearest_gpi with the cartesian metric, but points
+    without a neighbour within max_dist do not issue a warning. The
+    kdTree is built for regular grids as well. A session must not be
+    used by several threads at once.
+
+    Parameters
+    ----------
+    grid : BasicGrid
+        Grid whose active points are searched.
+    max_batch : int
+        Maximum number of points of a query.
+    max_dist : float, optional
+        Maximum cartesian distance [m] to consider for search
+        (default: np.inf).
+
+    Attributes
+    ----------
+    gpi : numpy.ndarray
+        int32 array of max_batch elements the gpis are written to if no
+        output array is passed.
+    dist : numpy.ndarray
+        float64 array of max_batch elements the distances are written to
+        if no output array is passed.
+    """
+
+    def __init__(self, grid, max_batch, max_dist=np.inf):
+        self.grid = grid
+        self.max_batch = int(max_batch)
+        self.max_dist = max_dist
+
+        if grid.kdTree is None:
+            grid._setup_kdtree()
+        self.gpi = np.empty(self.max_batch, dtype=np.int32)
+        self.dist = np.empty(self.max_batch, dtype=np.float64)
+        self._coords = np.empty((self.max_batch, 3), dtype=grid.kdTree.dtype)
+        self._work = np.empty((3, self.max_batch), dtype=np.float64)
+        self._missing = np.empty(self.max_batch, dtype=bool)
+
+    def find_nearest_gpi(self, lon, lat, gpi=None, dist=None):
+        """
+        Find the nearest gpi of each point.
+
+        Parameters
+        ----------
+        lon : numpy.ndarray
+            Longitudes of at most max_batch points.
+        lat : numpy.ndarray
+            Latitudes of the points.
+        gpi : numpy.ndarray, optional
+            Integer array the gpis are written to, by default the gpi
+            attribute of the session.
+        dist : numpy.ndarray, optional
+            Float array the cartesian distances are written to, by default
+            the dist attribute of the session.
+
+        Returns
+        -------
+        gpi : numpy.ndarray
+            Grid point indices, np.iinfo(np.int32).max if no point was
+            found within max_dist. A view of the gpi attribute of the
+            session if no array was passed, which is overwritten by the
+            next query.
+        dist : numpy.ndarray
+            Cartesian distances, np.inf if no point was found within
+            max_dist. A view of the dist attribute if no array was passed.
+        """
+        lon = np.asarray(lon).ravel()
+        lat = np.asarray(lat).ravel()
+        n = lon.size
+        if n > self.max_batch or lat.size != n:
+            raise ValueError(
+                f"lon and lat must have the same size of at most "
+                f"{self.max_batch}, got {lon.size} and {lat.size}")
+        gpi = self.gpi[:n] if gpi is None else gpi
+        dist = self.dist[:n] if dist is None else dist
+
+        grid = self.grid
+        if grid.kdTree is None:
+            grid._setup_kdtree()
+        tree = grid.kdTree
+        if tree.kdtree is None:
+            tree._build_kdtree()
+
+        coords = self._coords[:n]
+        grid.geodatum.toECEFArray(lon, lat, out=coords, work=self._work)
+        d, ind = tree.kdtree.query(coords, k=1,
+                                   distance_upper_bound=self.max_dist)
+        dist[:] = d
+
+        if grid.gpidirect and grid.allpoints:
+            gpi[:] = ind
+        else:
+            np.take(grid.activegpis, ind, out=gpi, mode="clip")
+        if self.max_dist < np.inf:
+            missing = self._missing[:n]
+            np.greater_equal(ind, tree.coords.shape[0], out=missing)
+            np.copyto(gpi, np.iinfo(np.int32).max, where=missing)
+
+        return gpi, dist
+
+
 def lonlat2cell(lon, lat, cellsize=5.0, cellsize_lon=None, cellsize_lat=None):
     """
     Partition lon, lat points into cells.
@@ -1225,7 +2626,8 @@ def lonlat2cell(lon, lat, cellsize=5.0, cellsize_lon=None, cellsize_lat=None):
     x = np.floor((np.double(lon) + (np.double(180.0) + 1e-9)) / cellsize_lon)
     cells = np.int32(x * (np.double(180.0) / cellsize_lat) + y)
 
-    max_cells = (np.double(180.0) / cellsize_lat) * (np.double(360.0)) / cellsize_lon
+    max_cells = ((np.double(180.0) / cellsize_lat) * (np.double(360.0))
+                 / cellsize_lon)
     cells = np.where(cells > max_cells - 1, cells - max_cells, cells)
     return np.int32(cells)
 
@@ -1265,7 +2667,8 @@ def gridfromdims(londim, latdim, origin="top", **kwargs):
         )
 
     return BasicGrid(
-        lons.flatten(), lats.flatten(), shape=(len(latdim), len(londim)), **kwargs
+        lons.flatten(), lats.flatten(), shape=(len(latdim), len(londim)),
+        **kwargs
     )
 
 
@@ -1305,6 +2708,161 @@ def genreg_grid(
     return gridfromdims(lon_dim, lat_dim, **kwargs)
 
 
+def _regular_axes(lon2d, lat2d):
+    """
+    Check if 2D longitudes and latitudes describe a regular grid with
+    equally spaced axes.
+
+    Parameters
+    ----------
+    lon2d : numpy.ndarray
+        2D array of longitudes.
+    lat2d : numpy.ndarray
+        2D array of latitudes.
+
+    Returns
+    -------
+    axes : tuple of numpy.ndarray or None
+        Longitude and latitude axis if the grid is regular, otherwise None.
+    """
+    if lon2d.shape[0] < 2 or lon2d.shape[1] < 2:
+        return None
+
+    lon_axis, lat_axis = lon2d[0, :], lat2d[:, 0]
+    if (np.any(lon2d != lon_axis[None, :])
+            or np.any(lat2d != lat_axis[:, None])):
+        return None
+
+    if not (_equally_spaced(lon_axis) and _equally_spaced(lat_axis)):
+        return None
+
+    return lon_axis, lat_axis
+
+
+def _equally_spaced(axis):
+    """
+    Check if a 1D array has at least two elements with equal, non-zero
+    spacing.
+
+    Parameters
+    ----------
+    axis : numpy.ndarray
+        1D array.
+
+    Returns
+    -------
+    result : boolean
+        True if the array is equally spaced.
+    """
+    if axis.size < 2:
+        return False
+
+    spacing = np.diff(axis)
+    return spacing[0] != 0 and not np.any(
+        np.abs(spacing - spacing[0]) > 1e-6 * np.abs(spacing[0]))
+
+
+def _as_array(arr, copy=False):
+    """
+    At least 1D numpy array (or subclass like numpy.memmap) of the input,
+    copied only if requested or necessary.
+    """
+    return np.array(arr, ndmin=1, copy=copy or None, subok=True)
+
+
+def _old_grid_state(state):
+    """
+    Pickled state of a grid with the defaults of attributes that grids
+    pickled by older versions do not have. Their active arrays and lookup
+    table are dropped, they are recreated on first use.
+    """
+    state = dict(state)
+    for key in ("activearrlon", "activearrlat", "activegpis",
+                "activearrcell", "gpi_lut"):
+        state.pop(key, None)
+    state.setdefault("compact", False)
+    state.setdefault("kd_tree_name", "pykdtree")
+    state.setdefault("kd_tree_cache_dir", None)
+    return state
+
+
+def _subset_array(subset, copy=False):
+    """
+    Index array of a subset given as indices or as a boolean mask of all
+    points.
+    """
+    subset = _as_array(subset, copy)
+    if subset.dtype == bool:
+        return np.flatnonzero(subset)
+    return subset
+
+
+def _subset_slice(subset):
+    """
+    Slice equivalent to a subset index, if it is an equally spaced range.
+
+    Parameters
+    ----------
+    subset : numpy.ndarray
+        Index of the active grid points.
+
+    Returns
+    -------
+    index : slice or None
+        Slice selecting the same points, None if there is none.
+    """
+    if subset.size == 0 or subset[0] < 0:
+        return None
+    if subset.size == 1:
+        return slice(int(subset[0]), int(subset[0]) + 1)
+
+    step = int(subset[1] - subset[0])
+    if step <= 0 or subset[-1] - subset[0] != step * (subset.size - 1):
+        return None
+    if not np.all(np.diff(subset) == step):
+        return None
+    return slice(int(subset[0]), int(subset[-1]) + 1, step)
+
+
+def _smallest_int_dtype(arr):
+    """
+    Smallest signed integer dtype that holds all values of an array.
+
+    Parameters
+    ----------
+    arr : numpy.ndarray
+        Integer array.
+
+    Returns
+    -------
+    dtype : numpy.dtype
+        int8, int16, int32 or int64.
+    """
+    if arr.size == 0:
+        return np.dtype(np.int8)
+    lo, hi = arr.min(), arr.max()
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _check_metric(metric):
+    """
+    Raise a ValueError for unknown distance metrics.
+
+    Parameters
+    ----------
+    metric : str
+        Name of the distance metric.
+    """
+    if metric not in ("cartesian", "great_circle", "geodesic"):
+        raise ValueError(
+            f"Unknown metric {metric}, expected 'cartesian', "
+            f"'great_circle' or 'geodesic'")
+
+
 def _element_iterable(el):
     """
     Test if a element is iterable
@@ -1352,7 +2910,8 @@ def reorder_to_cellsize(grid, cellsize_lat, cellsize_lon):
         different ordering.
     """
 
-    cell_grid = grid.to_cell_grid(cellsize_lat=cellsize_lat, cellsize_lon=cellsize_lon)
+    cell_grid = grid.to_cell_grid(cellsize_lat=cellsize_lat,
+                                  cellsize_lon=cellsize_lon)
     cell_sort = np.argsort(cell_grid.arrcell)
     new_arrlon = grid.arrlon[cell_sort]
     new_arrlat = grid.arrlat[cell_sort]
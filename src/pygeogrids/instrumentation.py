@@ -0,0 +1,235 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Opt-in timers and counters of grid operations.
+
+The expensive operations of the package (kdTree builds and queries,
+transformations to cartesian coordinates, lookup tables, reading and
+writing grid files, shapefile masking) are timed and the number of
+processed points is counted once recording is enabled, either with
+:py:func:`enable`, the :py:func:`recording` context manager or the
+environment variable ``PYGEOGRIDS_INSTRUMENTATION=1``. While recording is
+disabled (the default) an instrumented function only checks a flag.
+
+The recorded values are returned by :py:func:`snapshot` or passed to
+callbacks, e.g. of a metrics exporter, as they are recorded::
+
+    from pygeogrids import instrumentation
+
+    with instrumentation.recording():
+        grid.calc_lut(other)
+    instrumentation.snapshot()["timers"]["grids.BasicGrid.calc_lut"]
+
+Times are measured per call and include the time of instrumented functions
+that are called from within, e.g. calc_lut includes the kdTree queries.
+"""
+
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_enabled = False
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_callbacks = []
+
+
+def enable():
+    """
+    Start recording timers and counters.
+    """
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """
+    Stop recording timers and counters, the recorded values are kept.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """
+    Whether timers and counters are recorded.
+
+    Returns
+    -------
+    enabled : bool
+        True if recording is enabled.
+    """
+    return _enabled
+
+
+@contextmanager
+def recording(clear=True):
+    """
+    Context manager that records timers and counters within its block.
+
+    Parameters
+    ----------
+    clear : bool, optional (default: True)
+        Remove previously recorded values first.
+    """
+    global _enabled
+    if clear:
+        reset()
+    previous = _enabled
+    _enabled = True
+    try:
+        yield
+    finally:
+        _enabled = previous
+
+
+def reset():
+    """
+    Remove all recorded values.
+    """
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def snapshot():
+    """
+    Copy of the recorded values.
+
+    Returns
+    -------
+    values : dict
+        'timers' maps the names of the timed functions to dicts with the
+        number of calls ('count'), the total and the maximum time of a call
+        in seconds ('total', 'max'). 'counters' maps counter names to
+        their sums.
+    """
+    with _lock:
+        timers = {name: {"count": count, "total": total, "max": longest}
+                  for name, (count, total, longest) in _timers.items()}
+        return {"timers": timers, "counters": dict(_counters)}
+
+
+def add_callback(callback):
+    """
+    Call a function for every recorded value, while recording is enabled.
+
+    Parameters
+    ----------
+    callback : callable
+        Called as callback(kind, name, value), kind is 'timer' with the
+        duration of a call in seconds as value or 'counter' with the
+        increment of the counter. It is called in the thread of the
+        instrumented function and should return quickly.
+    """
+    with _lock:
+        _callbacks.append(callback)
+
+
+def remove_callback(callback):
+    """
+    Remove a function added with add_callback.
+
+    Parameters
+    ----------
+    callback : callable
+        Function to remove.
+    """
+    with _lock:
+        _callbacks.remove(callback)
+
+
+def count(name, value=1):
+    """
+    Increment a counter if recording is enabled.
+
+    Parameters
+    ----------
+    name : str
+        Name of the counter.
+    value : int, optional (default: 1)
+        Increment.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+        callbacks = list(_callbacks)
+    for callback in callbacks:
+        callback("counter", name, value)
+
+
+def _record_time(name, seconds):
+    """
+    Add the duration of a call to a timer.
+    """
+    with _lock:
+        calls, total, longest = _timers.get(name, (0, 0.0, 0.0))
+        _timers[name] = (calls + 1, total + seconds, max(longest, seconds))
+        callbacks = list(_callbacks)
+    for callback in callbacks:
+        callback("timer", name, seconds)
+
+
+def timed(name=None):
+    """
+    Decorator that times the calls of a function if recording is enabled.
+
+    Parameters
+    ----------
+    name : str, optional
+        Name of the timer. By default the last part of the module name and
+        the qualified name of the function, e.g.
+        'nearest_neighbor.findGeoNN.find_nearest_index'.
+    """
+    def decorator(func):
+        timer = name
+        if timer is None:
+            timer = f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record_time(timer, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+if os.environ.get("PYGEOGRIDS_INSTRUMENTATION", "").lower() in (
+        "1", "true", "yes"):
+    enable()
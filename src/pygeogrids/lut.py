@@ -0,0 +1,291 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Persistent storage of lookup tables between grids.
+"""
+
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+from pygeogrids.grids import RegularGrid
+from pygeogrids.nearest_neighbor import _write_atomic
+
+
+def grid_fingerprint(grid):
+    """
+    Content hash of a grid definition, i.e. of the gpis, coordinates,
+    subset and geodetic datum. Grids with the same fingerprint produce the
+    same lookup tables.
+
+    Parameters
+    ----------
+    grid : BasicGrid
+        Grid to identify.
+
+    Returns
+    -------
+    fingerprint : str
+        hex digest of the hash
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(type(grid).__name__.encode())
+    h.update(grid.geodatum.name.encode())
+    h.update(str(grid.shape).encode())
+
+    if isinstance(grid, RegularGrid):
+        # the dimensions define the grid, do not compute the full arrays
+        arrays = (grid.londim, grid.latdim)
+    else:
+        arrays = (grid.gpis, grid.arrlon, grid.arrlat)
+    if grid.subset is not None:
+        arrays = arrays + (grid.subset,)
+
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(f"{arr.dtype.str}{arr.shape}".encode())
+        h.update(arr.data)
+
+    return h.hexdigest()
+
+
+class LutStore:
+    """
+    Directory of lookup tables computed with
+    :py:meth:`pygeogrids.grids.BasicGrid.calc_lut`, keyed by the
+    fingerprints of both grids and the calc_lut arguments. A stored lookup
+    table is loaded instead of being computed again.
+
+    Parameters
+    ----------
+    path : str
+        Directory in which the lookup tables are stored.
+    max_size : int, optional
+        Maximum total size of the stored files in bytes. If it is exceeded,
+        the least recently used lookup tables are removed.
+    format : str, optional (default: 'npy')
+        'npy' to store uncompressed files that are memory-mapped when
+        loaded, or 'nc' to store zlib compressed netCDF files that are read
+        into memory.
+
+    Attributes
+    ----------
+    path : str
+        Directory in which the lookup tables are stored.
+    """
+
+    def __init__(self, path, max_size=None, format="npy"):
+        if format not in ("npy", "nc"):
+            raise ValueError(f"Unknown format {format}, use 'npy' or 'nc'")
+        self.path = path
+        self.max_size = max_size
+        self.format = format
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(path={self.path!r}, "
+                f"max_size={self.max_size}, format={self.format!r})")
+
+    def key(self, grid, other, max_dist=np.inf, into_subset=False,
+            metric="cartesian"):
+        """
+        Key of a lookup table from grid to other.
+
+        Parameters
+        ----------
+        grid : BasicGrid
+            Grid for whose points the lut is calculated.
+        other : BasicGrid
+            Grid in which the nearest neighbours are searched.
+        max_dist : float, optional
+            See calc_lut.
+        into_subset : boolean, optional
+            See calc_lut.
+        metric : str, optional
+            See calc_lut.
+
+        Returns
+        -------
+        key : str
+            hex digest identifying the lookup table
+        """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(grid_fingerprint(grid).encode())
+        h.update(grid_fingerprint(other).encode())
+        key_args = (float(max_dist), bool(into_subset))
+        if metric != "cartesian":
+            key_args = key_args + (metric,)
+        h.update(repr(key_args).encode())
+        return h.hexdigest()
+
+    def get(self, grid, other, max_dist=np.inf, into_subset=False,
+            metric="cartesian", **calc_lut_kwargs):
+        """
+        Load the lookup table from grid to other, calculating and storing it
+        first if it is not in the store yet.
+
+        Parameters
+        ----------
+        grid : BasicGrid
+            Grid for whose points the lut is calculated.
+        other : BasicGrid
+            Grid in which the nearest neighbours are searched.
+        max_dist : float, optional
+            See calc_lut.
+        into_subset : boolean, optional
+            See calc_lut.
+        metric : str, optional
+            See calc_lut.
+        **calc_lut_kwargs
+            Further keywords passed to calc_lut, e.g. chunk_size.
+
+        Returns
+        -------
+        lut : numpy.ndarray
+            Lookup table as returned by calc_lut, as int32 if the values
+            fit, read-only memory-mapped for the 'npy' format.
+        """
+        filename = os.path.join(
+            self.path,
+            f"{self.key(grid, other, max_dist, into_subset, metric)}"
+            f".{self.format}")
+
+        lut = self._load(filename)
+        if lut is not None:
+            # the modification time is used to evict the least recently
+            # used lookup tables
+            try:
+                os.utime(filename)
+            except FileNotFoundError:
+                # removed by another process after loading
+                pass
+            return lut
+
+        lut = grid.calc_lut(other, max_dist=max_dist, into_subset=into_subset,
+                            metric=metric, **calc_lut_kwargs)
+        if lut.size == 0 or lut.max() <= np.iinfo(np.int32).max:
+            lut = lut.astype(np.int32)
+
+        if self.format == "npy":
+            _write_atomic(filename, lambda f: np.save(f, lut))
+        else:
+            self._save_nc(filename, lut)
+        self._evict(keep=filename)
+
+        stored = self._load(filename)
+        if stored is None:
+            # removed by another process in the meantime
+            return lut
+        return stored
+
+    def clear(self):
+        """
+        Remove all stored lookup tables.
+        """
+        for filename in self._files():
+            _remove(filename)
+
+    def _files(self):
+        return glob.glob(os.path.join(self.path, f"*.{self.format}"))
+
+    def _load(self, filename):
+        """
+        Load a stored lookup table, returns None if it does not exist.
+        """
+        if not os.path.exists(filename):
+            return None
+        try:
+            if self.format == "npy":
+                return np.load(filename, mmap_mode="r")
+            else:
+                from netCDF4 import Dataset
+                with Dataset(filename, "r") as ncfile:
+                    return np.array(ncfile.variables["lut"][:])
+        except FileNotFoundError:
+            # removed by another process, treated as a cache miss
+            return None
+
+    @staticmethod
+    def _save_nc(filename, lut):
+        """
+        Store a lookup table in a compressed netCDF file.
+        """
+        from netCDF4 import Dataset
+
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with Dataset(tmp_filename, "w", format="NETCDF4") as ncfile:
+                ncfile.createDimension("gpi", lut.size)
+                var = ncfile.createVariable("lut", lut.dtype, ("gpi",),
+                                            zlib=True, complevel=4)
+                var[:] = lut
+                var.setncattr("long_name", "Lookup table")
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+    def _evict(self, keep=None):
+        """
+        Remove the least recently used lookup tables until the total size
+        is below max_size.
+        """
+        if self.max_size is None:
+            return
+
+        files = []
+        for filename in self._files():
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                # already removed by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        for _, size, filename in files:
+            if total <= self.max_size:
+                break
+            if filename == keep:
+                continue
+            total -= size
+            _remove(filename)
+
+
+def _remove(filename):
+    """
+    Remove a file, ignoring that another process removed it already.
+    """
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
@@ -25,22 +25,30 @@
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import numpy as np
+import copy
+import hashlib
+import os
+import pickle
+import tempfile
 import warnings
+from importlib.util import find_spec
+
+import numpy as np
 
-try:
-    import pykdtree.kdtree as pykd
+from pygeogrids.instrumentation import count, timed
 
-    pykdtree_installed = True
-except ImportError:
-    pykdtree_installed = False
+# the kdTree implementations are imported when the first kdTree is built,
+# importing scipy.spatial takes longer than importing pygeogrids itself
+pykdtree_installed = find_spec("pykdtree") is not None
+scipy_installed = find_spec("scipy") is not None
 
-try:
-    import scipy.spatial as sc_spat
+# number of points transformed to cartesian coordinates at once
+ECEF_CHUNK_SIZE = 2 ** 16
 
-    scipy_installed = True
-except ImportError:
-    scipy_installed = False
+# masks that select less than this fraction of the points of a kdTree are
+# searched in a kdTree of the selected points, for larger masks the kdTree
+# of all points is searched with the other points skipped
+MASKED_NN_MIN_FRACTION = 1 / 8
 
 
 class findGeoNN(object):
@@ -68,7 +76,26 @@ class findGeoNN(object):
         'pykdtree' to use pykdtree or
         'scipy' to use scipy.spatial.kdTree
         Fallback is always scipy if any other string is given
-        or if pykdtree is not installed. standard is pykdtree since it is faster
+        or if pykdtree is not installed. standard is pykdtree since it is
+        faster
+    cache_dir : str, optional
+        if given, the cartesian coordinates and (for scipy) the built kdTree
+        are stored in this directory, keyed by a hash of the input
+        coordinates, geodatum and kd_tree_name. Subsequent instances with
+        the same inputs memory-map the coordinates and load the tree from
+        the cache instead of recomputing them. pykdtree objects can not be
+        serialized, so for pykdtree only the coordinates are cached and the
+        tree is rebuilt from them.
+    coords : numpy.ndarray, optional
+        precomputed cartesian coordinates of the points as returned by
+        _transform_lonlats, e.g. loaded from a grid file. If given, they are
+        used instead of transforming lon and lat.
+    dtype : numpy.dtype, optional (default: numpy.float64)
+        dtype of the cartesian coordinates. numpy.float32 halves the memory
+        of the coordinates and of the pykdtree (scipy converts them to
+        float64 internally). Coordinates are then rounded to less than
+        0.5 m, so neighbours whose distances differ by less than about 1 m
+        may be swapped.
 
     Attributes
     ----------
@@ -89,13 +116,15 @@ class findGeoNN(object):
     Methods
     -------
     find_nearest_index(lon,lat)
-        finds the nearest neighbor of the given lon,lat coordinates in the lon,lat
-        arrays given during initialization and returns the index of the nearest neighbour
+        finds the nearest neighbor of the given lon,lat coordinates in the
+        lon,lat arrays given during initialization and returns the index of
+        the nearest neighbour
         in those arrays.
 
     """
 
-    def __init__(self, lon, lat, geodatum, grid=False, kd_tree_name="pykdtree"):
+    def __init__(self, lon, lat, geodatum, grid=False, kd_tree_name="pykdtree",
+                 cache_dir=None, coords=None, dtype=np.float64):
         """
         init method, prepares lon and lat arrays for _transform_lonlats if
         necessary
@@ -116,9 +145,41 @@ class findGeoNN(object):
         # Earth radius
         self.geodatum = geodatum
         self.kd_tree_name = kd_tree_name
-        self.coords = self._transform_lonlats(lon_init, lat_init)
+        self.cache_dir = cache_dir
         self.kdtree = None
         self.grid = grid
+        # selected indices and kdTree of the last small mask
+        self._masked_subtree = None
+
+        self.coords = coords
+        self.dtype = np.dtype(dtype) if coords is None else coords.dtype
+        if self.cache_dir is not None:
+            self.cache_key = _cache_key(lon_init, lat_init, geodatum.name,
+                                        kd_tree_name, self.dtype)
+            if self.coords is None:
+                self.coords = self._load_cached_coords()
+
+        if self.coords is None:
+            self.coords = self._transform_lonlats(lon_init, lat_init)
+            if self.cache_dir is not None:
+                _write_atomic(self._cache_path("coords.npy"),
+                              lambda f: np.save(f, self.coords))
+
+    def _cache_path(self, suffix):
+        """
+        Path of a cache file for this coordinate set.
+        """
+        return os.path.join(self.cache_dir, f"{self.cache_key}.{suffix}")
+
+    def _load_cached_coords(self):
+        """
+        Memory-map cached cartesian coordinates, returns None if there
+        are none or they can not be read.
+        """
+        try:
+            return np.load(self._cache_path("coords.npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
 
     def _transform_lonlats(self, lon, lat):
         """
@@ -136,28 +197,48 @@ class findGeoNN(object):
         coords : np.array
             3D cartesian coordinates
         """
-        lon = np.array(lon)
-        lat = np.array(lat)
-        coords = np.zeros((lon.size, 3), dtype=np.float64)
-        (coords[:, 0], coords[:, 1], coords[:, 2]
-         ) = self.geodatum.toECEF(lon, lat)
+        # transformed in chunks to limit the memory of the temporary
+        # arrays, without copying the inputs
+        lon = np.asarray(lon).ravel()
+        lat = np.asarray(lat).ravel()
+        coords = np.empty((lon.size, 3), dtype=self.dtype)
+        for start in range(0, lon.size, ECEF_CHUNK_SIZE):
+            chunk = slice(start, start + ECEF_CHUNK_SIZE)
+            self.geodatum.toECEFArray(lon[chunk], lat[chunk],
+                                      out=coords[chunk])
 
         return coords
 
+    @timed()
     def _build_kdtree(self):
         """
         Build the kdtree and saves it in the self.kdtree attribute
         """
+        count("nearest_neighbor.kdtree_points", self.coords.shape[0])
         if self.kd_tree_name == "pykdtree" and pykdtree_installed:
+            import pykdtree.kdtree as pykd
             self.kdtree = pykd.KDTree(self.coords)
         elif scipy_installed:
+            import scipy.spatial as sc_spat
+            if self.cache_dir is not None:
+                tree_path = self._cache_path("scipy.pkl")
+                try:
+                    with open(tree_path, "rb") as f:
+                        self.kdtree = pickle.load(f)
+                    return
+                except (OSError, pickle.UnpicklingError, EOFError):
+                    pass
             self.kdtree = sc_spat.cKDTree(self.coords)
+            if self.cache_dir is not None:
+                _write_atomic(tree_path, lambda f: pickle.dump(
+                    self.kdtree, f, protocol=pickle.HIGHEST_PROTOCOL))
         else:
             raise Exception(
                 "No supported kdtree implementation installed.\
                              Please install pykdtree and/or scipy."
             )
 
+    @timed()
     def find_nearest_index(self, lon, lat, max_dist=np.inf, k=1):
         """
         finds nearest index, builds kdTree if it does not yet exist
@@ -177,10 +258,9 @@ class findGeoNN(object):
         -------
         d : float, numpy.array
             distances of query coordinates to the nearest grid point,
-            distance is given in cartesian coordinates and is not the
-            great circle distance at the moment. This should be OK for
-            most applications that look for the nearest neighbor which
-            should not be hundreds of kilometers away.
+            distance is given in cartesian coordinates. Surface distances
+            can be requested with the metric keyword of
+            BasicGrid.find_k_nearest_gpi.
             If no point was found within the maximum distance to consider, an
             empty array is returned.
         ind : int, numpy.array
@@ -202,6 +282,7 @@ class findGeoNN(object):
             self._build_kdtree()
 
         query_coords = self._transform_lonlats(lon, lat)
+        count("nearest_neighbor.query_points", query_coords.shape[0])
 
         if k is None:
             if self.kd_tree_name != "scipy":
@@ -214,6 +295,7 @@ class findGeoNN(object):
 
         d, ind = self.kdtree.query(
             query_coords, distance_upper_bound=max_dist, k=k)
+        d = np.asarray(d, dtype=np.float64)
 
         if np.any(np.isinf(d)):
             warnings.warn(f"Less than k={k} points found within "
@@ -228,3 +310,392 @@ class findGeoNN(object):
             index_lat = ind / self.lon_size
             index_lon = ind % self.lon_size
             return d, index_lon.astype(np.int32), index_lat.astype(np.int32)
+
+    def _subtree(self, selected):
+        """
+        kdTree of the selected points, reused if the same points were
+        selected in the previous call.
+        """
+        cached = getattr(self, "_masked_subtree", None)
+        if cached is not None and np.array_equal(cached[0], selected):
+            return cached[1]
+
+        subtree = copy.copy(self)
+        subtree.coords = self.coords[selected]
+        subtree.kdtree = None
+        subtree.cache_dir = None
+        subtree.grid = False
+        subtree._masked_subtree = None
+        self._masked_subtree = (selected, subtree)
+        return subtree
+
+    @timed()
+    def find_nearest_index_masked(self, lon, lat, mask, max_dist=np.inf,
+                                  k=1):
+        """
+        Finds the nearest indices among the points selected by a mask,
+        builds kdTree if it does not yet exist.
+
+        The tree is queried for more neighbours than requested and the
+        masked points are skipped. Queries for which not enough selected
+        points are found are repeated with a larger number of neighbours
+        until k points are found, or all points within max_dist were seen.
+        If less than MASKED_NN_MIN_FRACTION of the points are selected, a
+        kdTree of the selected points is searched instead, which is kept
+        for further queries with the same mask.
+
+        Parameters
+        ----------
+        lon : float, list or numpy.array
+            longitude of point
+        lat : float, list or numpy.array
+            latitude of point
+        mask : numpy.ndarray
+            Boolean array, True for the points of the tree that can be
+            returned.
+        max_dist : float, optional
+            Maximum distance to consider for search (default: np.inf).
+        k : int, optional
+            The number of nearest neighbors to return (default: 1).
+
+        Returns
+        -------
+        d : numpy.array
+            Cartesian distances of the query coordinates to the nearest
+            selected points, of shape (n,) for k=1 and (n, k) otherwise.
+            np.inf where less than k points were found.
+        ind : numpy.array
+            Indices of the nearest selected points, the number of points in
+            the tree where less than k points were found.
+        """
+        n_points = mask.size
+        selected = np.flatnonzero(mask)
+        if k < selected.size < MASKED_NN_MIN_FRACTION * n_points:
+            subtree = self._subtree(selected)
+            d, ind = subtree.find_nearest_index(lon, lat, max_dist=max_dist,
+                                                k=k)
+            found = ~np.isinf(d)
+            ind = np.asarray(ind, dtype=np.int64)
+            ind[found] = selected[ind[found]]
+            ind[~found] = n_points
+            return d.reshape(ind.shape), ind
+
+        if self.kdtree is None:
+            self._build_kdtree()
+
+        query_coords = self._transform_lonlats(lon, lat)
+        n_query = query_coords.shape[0]
+        count("nearest_neighbor.query_points", n_query)
+
+        d = np.full((n_query, k), np.inf)
+        ind = np.full((n_query, k), n_points, dtype=np.int64)
+
+        n_selected = selected.size
+        todo = np.arange(n_query)
+        # about twice the number of neighbours that contain k selected
+        # points on average
+        k_query = min(-(-2 * k * n_points // max(n_selected, 1)), n_points)
+        while todo.size > 0 and n_selected > 0:
+            dq, iq = self.kdtree.query(query_coords[todo],
+                                       distance_upper_bound=max_dist,
+                                       k=k_query)
+            dq = np.asarray(dq, dtype=np.float64).reshape(todo.size, k_query)
+            iq = np.asarray(iq, dtype=np.int64).reshape(todo.size, k_query)
+
+            valid = np.isfinite(dq)
+            valid[valid] = mask[iq[valid]]
+            # the query is complete if k selected points were found, or if
+            # all points within max_dist were returned
+            done = ((np.count_nonzero(valid, axis=1) >= k)
+                    | np.isinf(dq[:, -1]) | (k_query == n_points))
+
+            # move the selected points to the front, keeping their order
+            order = np.argsort(~valid[done], axis=1, kind="stable")[:, :k]
+            found = np.take_along_axis(valid[done], order, axis=1)
+            d_done = np.take_along_axis(dq[done], order, axis=1)
+            i_done = np.take_along_axis(iq[done], order, axis=1)
+            d_done[~found] = np.inf
+            i_done[~found] = n_points
+            d[todo[done], :order.shape[1]] = d_done
+            ind[todo[done], :order.shape[1]] = i_done
+
+            todo = todo[~done]
+            # queries repeated with more neighbours
+            count("nearest_neighbor.masked_requeries", todo.size)
+            k_query = min(2 * k_query, n_points)
+
+        if np.any(np.isinf(d)):
+            warnings.warn(f"Less than k={k} points found within "
+                          f"max_dist={max_dist}. Distance set to 'Inf'."
+                          )
+
+        if k == 1:
+            d, ind = d[:, 0], ind[:, 0]
+        return d, ind
+
+
+class findRegularNN(object):
+
+    """
+    Nearest neighbour search on a regular lon/lat grid without a kdTree.
+
+    The position of a query point in the grid is computed from the
+    (equally spaced) grid axes, and the cartesian distances to the grid
+    points in a small window around it are compared. The window is large
+    enough to always contain the true nearest neighbour, so the results
+    are the same as with the kdTree in findGeoNN, including the distance
+    measure.
+
+    Parameters
+    ----------
+    lon : numpy.array
+        equally spaced longitudes of the grid columns
+    lat : numpy.array
+        equally spaced latitudes of the grid rows
+    geodatum : object
+        pygeogrids.geodatic_datum.GeodeticDatum object associated with
+        lons/lats coordinates
+    chunk_size : int, optional
+        number of query points processed at once, limits the memory used
+        for the candidate distances
+
+    Attributes
+    ----------
+    lon_size : int
+        number of grid columns
+    lat_size : int
+        number of grid rows
+    is_global : boolean
+        True if the longitudes wrap around the globe
+    """
+
+    def __init__(self, lon, lat, geodatum, chunk_size=65536):
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.geodatum = geodatum
+        self.chunk_size = chunk_size
+        self.lon_size = self.lon.size
+        self.lat_size = self.lat.size
+
+        self.dlon = (self.lon[-1] - self.lon[0]) / (self.lon_size - 1)
+        self.dlat = (self.lat[-1] - self.lat[0]) / (self.lat_size - 1)
+        self.is_global = np.isclose(abs(self.dlon) * self.lon_size, 360.0)
+
+        # cartesian coordinates of the grid points are
+        # (row_xy * col_cos, row_xy * col_sin, row_z), computed with the
+        # first query
+        self.row_xy = None
+        self.row_z = None
+        self.col_cos = None
+        self.col_sin = None
+
+    def _setup_axes(self):
+        """
+        Cartesian coordinates of the grid rows and columns. row_xy is
+        assigned last, it marks the others as set up.
+        """
+        row_xy, _, self.row_z = self.geodatum.toECEF(
+            np.zeros_like(self.lat), self.lat)
+        self.col_cos = np.cos(np.deg2rad(self.lon))
+        self.col_sin = np.sin(np.deg2rad(self.lon))
+        self.row_xy = row_xy
+
+    @timed()
+    def find_nearest_index(self, lon, lat, max_dist=np.inf, k=1):
+        """
+        finds the nearest grid point
+
+        Parameters
+        ----------
+        lon : float, list or numpy.array
+            longitude of point
+        lat : float, list or numpy.array
+            latitude of point
+        max_dist : float, optional
+            Maximum distance to consider for search (default: np.inf).
+        k : int, optional
+            Only k=1 is supported.
+
+        Returns
+        -------
+        d : numpy.array
+            cartesian distances of query coordinates to the nearest grid
+            point, np.inf if no point was found within max_dist
+        ind : numpy.array
+            index of the nearest grid point in the flattened grid, i.e.
+            row * lon_size + column. Equal to the number of grid points if
+            no point was found within max_dist.
+        """
+        if k != 1:
+            raise NotImplementedError("Only k=1 is supported")
+
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64)).ravel()
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64)).ravel()
+        count("nearest_neighbor.query_points", lon.size)
+        if self.row_xy is None:
+            self._setup_axes()
+
+        d = np.empty(lon.size, dtype=np.float64)
+        ind = np.empty(lon.size, dtype=np.int64)
+        for start in range(0, lon.size, self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            d[chunk], ind[chunk] = self._query(lon[chunk], lat[chunk])
+
+        invalid = d > max_dist
+        if np.any(invalid):
+            d[invalid] = np.inf
+            ind[invalid] = self.lon_size * self.lat_size
+            warnings.warn(f"Less than k={k} points found within "
+                          f"max_dist={max_dist}. Distance set to 'Inf'."
+                          )
+
+        return d, ind
+
+    def _candidate_cols(self, lon):
+        """
+        Columns that can contain the nearest neighbour of each point.
+        """
+        offset = np.mod((lon - self.lon[0]) * np.sign(self.dlon), 360.0)
+        col = np.floor(offset / abs(self.dlon)).astype(np.int64)
+        cols = np.stack([col, col + 1], axis=1)
+        if self.is_global:
+            return np.mod(cols, self.lon_size)
+        else:
+            # outside of a regional grid the nearest column is the one with
+            # the smaller longitude difference, which can be either edge
+            edges = np.broadcast_to([0, self.lon_size - 1], cols.shape)
+            return np.hstack([np.clip(cols, 0, self.lon_size - 1), edges])
+
+    def _row_extra(self, lat, dlon):
+        """
+        Number of rows the search window of each point is widened by.
+
+        On a meridian at a longitude difference dlon the point closest to
+        the query point is shifted towards the pole, so the window is
+        widened by this shift.
+        """
+        phi = np.deg2rad(lat)
+        phi_closest = np.arctan2(np.sin(phi), np.cos(phi) * np.cos(dlon))
+        shift = np.rad2deg(np.abs(phi_closest - phi))
+        return np.ceil(shift / abs(self.dlat)).astype(np.int64)
+
+    def _candidate_rows(self, lat, extra, width):
+        """
+        Rows that can contain the nearest neighbour of each point, width
+        distinct rows per point that contain the rows within extra + 1
+        of the row of the point.
+        """
+        row = np.floor((lat - self.lat[0]) / self.dlat).astype(np.int64)
+        first = np.clip(row - 1 - extra, 0, self.lat_size - width)
+        return first[:, None] + np.arange(width)
+
+    def _query(self, lon, lat):
+        """
+        Nearest neighbour of each point by comparing the distances to all
+        candidate grid points.
+        """
+        qx, qy, qz = self.geodatum.toECEF(lon, lat)
+        cols = self._candidate_cols(lon)
+        dlon = np.mod(np.deg2rad(lon[:, None] - self.lon[cols]), 2 * np.pi)
+        dlon = np.min(np.minimum(dlon, 2 * np.pi - dlon), axis=1)
+        extra = self._row_extra(lat, dlon)
+        width = np.minimum(2 * extra + 4, self.lat_size)
+
+        # points are compared in groups of similar window widths, so that
+        # points far outside of a regional grid do not widen the windows
+        # of the others, and in parts that limit the candidate distances
+        # to about 32 * chunk_size
+        group = np.ceil(np.log2(width)).astype(np.int64)
+        d = np.empty(lon.size, dtype=np.float64)
+        ind = np.empty(lon.size, dtype=np.int64)
+        for g in np.unique(group):
+            points = np.flatnonzero(group == g)
+            group_width = int(np.max(width[points]))
+            step = max(1, 32 * self.chunk_size
+                       // (group_width * cols.shape[1]))
+            for start in range(0, points.size, step):
+                part = points[start:start + step]
+                rows = self._candidate_rows(lat[part], extra[part],
+                                            group_width)
+                d[part], ind[part] = self._compare(
+                    qx[part], qy[part], qz[part], rows, cols[part])
+
+        return d, ind
+
+    def _compare(self, qx, qy, qz, rows, cols):
+        """
+        Distance and index of the nearest of the candidate grid points
+        given by rows x cols of each query point.
+        """
+        row_xy = self.row_xy[rows][:, :, None]
+        dist2 = (row_xy * self.col_cos[cols][:, None, :]
+                 - qx[:, None, None]) ** 2
+        dist2 += (row_xy * self.col_sin[cols][:, None, :]
+                  - qy[:, None, None]) ** 2
+        dist2 += (self.row_z[rows] - qz[:, None])[:, :, None] ** 2
+        dist2 = dist2.reshape(qx.size, -1)
+
+        best = np.argmin(dist2, axis=1)
+        points = np.arange(qx.size)
+        row = rows[points, best // cols.shape[1]]
+        col = cols[points, best % cols.shape[1]]
+
+        return np.sqrt(dist2[points, best]), row * self.lon_size + col
+
+
+def _cache_key(lon, lat, geodatum_name, kd_tree_name, dtype=np.float64):
+    """
+    Content hash identifying a set of coordinates for the kdTree cache.
+
+    Parameters
+    ----------
+    lon : numpy.array
+        longitudes of the points
+    lat : numpy.array
+        latitudes of the points
+    geodatum_name : str
+        name of the geodetic datum
+    kd_tree_name : str
+        name of the kdTree implementation
+    dtype : numpy.dtype, optional
+        dtype of the cartesian coordinates
+
+    Returns
+    -------
+    key : str
+        hex digest of the hash
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for arr in (lon, lat):
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        h.update(str(arr.shape).encode())
+        h.update(arr.data)
+    h.update(geodatum_name.encode())
+    h.update(kd_tree_name.encode())
+    if np.dtype(dtype) != np.float64:
+        h.update(np.dtype(dtype).str.encode())
+    return h.hexdigest()
+
+
+def _write_atomic(path, write):
+    """
+    Write a cache file via a temporary file and rename it into place, so
+    that concurrent readers never see a partially written file.
+
+    Parameters
+    ----------
+    path : str
+        target path
+    write : callable
+        called with an open binary file object to write the content
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -29,13 +29,30 @@
 Module for saving grid to netCDF.
 """
 
-from netCDF4 import Dataset
 import numpy as np
 import os
 from datetime import datetime
-from pygeogrids import CellGrid, BasicGrid
+from importlib.util import find_spec
+from pygeogrids import CellGrid, BasicGrid, RegularGrid
+from pygeogrids.grids import GridDefinitionError
+from pygeogrids.instrumentation import timed
 
+# netCDF4 and h5py are imported when a file is read or written
+h5py_installed = find_spec("h5py") is not None
 
+# attributes with which netCDF4 unpacks or masks the stored values when
+# reading, variables that have one of them are not memory-mapped. The valid
+# range only masks values, which are kept when reading grid variables.
+_PACKING_ATTRIBUTES = ("scale_factor", "add_offset", "_FillValue",
+                       "missing_value", "_Unsigned")
+
+# keyword arguments of load_grid that RegularGrid accepts as well, other
+# keywords load 2D grids as BasicGrid
+_REGULAR_GRID_KWARGS = {"setup_kdTree", "transform_lon", "kd_tree_name",
+                        "kd_tree_cache_dir"}
+
+
+@timed()
 def save_lonlat(
     filename,
     arrlon,
@@ -89,6 +106,8 @@ def save_lonlat(
         see netCDF documentation
     """
 
+    from netCDF4 import Dataset
+
     with Dataset(filename, "w", format=format) as ncfile:
 
         if (
@@ -104,7 +123,8 @@ def save_lonlat(
             ncfile.createDimension("lon", lonsize)
             gpisize = global_attrs["shape"][0] * global_attrs["shape"][1]
             if gpis is None:
-                gpivalues = np.arange(gpisize, dtype=np.int32).reshape(latsize, lonsize)
+                gpivalues = np.arange(gpisize, dtype=np.int32).reshape(
+                    latsize, lonsize)
             else:
                 gpivalues = gpis.reshape(latsize, lonsize)
 
@@ -297,18 +317,20 @@ def sort_for_netcdf(lons, lats, values):
     arrval = values.flatten()
     idxlatsrt = np.argsort(arrlat)[::-1]
     idxlat = np.argsort(arrlat[idxlatsrt].reshape(lats.shape), axis=0)[::-1]
+    cols = np.arange(lons.shape[1])
     idxlon = np.argsort(
-        arrlon[idxlatsrt].reshape(lons.shape)[idxlat, np.arange(lons.shape[1])], axis=1
+        arrlon[idxlatsrt].reshape(lons.shape)[idxlat, cols], axis=1
     )
 
-    values = arrval[idxlatsrt].reshape(*lons.shape)[idxlat, np.arange(lons.shape[1])][
-        np.arange(lons.shape[0])[:, None], idxlon
+    rows = np.arange(lons.shape[0])[:, None]
+    values = arrval[idxlatsrt].reshape(*lons.shape)[idxlat, cols][
+        rows, idxlon
     ]
-    lons = arrlon[idxlatsrt].reshape(*lons.shape)[idxlat, np.arange(lons.shape[1])][
-        np.arange(lons.shape[0])[:, None], idxlon
+    lons = arrlon[idxlatsrt].reshape(*lons.shape)[idxlat, cols][
+        rows, idxlon
     ]
-    lats = arrlat[idxlatsrt].reshape(*lons.shape)[idxlat, np.arange(lons.shape[1])][
-        np.arange(lons.shape[0])[:, None], idxlon
+    lats = arrlat[idxlatsrt].reshape(*lons.shape)[idxlat, cols][
+        rows, idxlon
     ]
     return lons, lats, values
 
@@ -377,11 +399,15 @@ def save_grid(
     )
 
 
+@timed()
 def load_grid(
     filename,
     subset_flag="subset_flag",
     subset_value=1,
     location_var_name="gpi",
+    lazy=False,
+    only_subset=False,
+    cells=None,
     **grid_kwargs
 ):
     """
@@ -398,13 +424,32 @@ def load_grid(
     location_var_name: string, optional (default: 'gpi')
         variable name under which the grid point locations
         are stored
+    lazy : boolean, optional (default: False)
+        If True, only the variables that are needed are read and
+        uncompressed variables of NETCDF4 files are memory-mapped (requires
+        h5py). 2D grids with equally spaced dimensions, gpis in storage
+        order and without cells or subset are returned as RegularGrid,
+        which keeps the dimensions instead of the full coordinate arrays,
+        unless grid_kwargs contains keywords RegularGrid does not accept
+        (e.g. compact or copy).
+    only_subset : boolean, optional (default: False)
+        If True, only the points of the subset are loaded and the returned
+        grid has no subset.
+    cells : int or iterable, optional (default: None)
+        If given, only the points in these cells are loaded.
     **grid_kwargs: additional kwargs that are passed to BasicGrid or CellGrid
 
     Returns
     -------
-    grid : BasicGrid or CellGrid instance
+    grid : BasicGrid, CellGrid or RegularGrid instance
         grid instance initialized with the loaded data
     """
+    if lazy or only_subset or cells is not None:
+        return _load_grid_lazy(filename, subset_flag, subset_value,
+                               location_var_name, lazy, only_subset, cells,
+                               **grid_kwargs)
+
+    from netCDF4 import Dataset
 
     with Dataset(filename, "r") as nc_data:
         # determine if it is a cell grid or a basic grid
@@ -414,25 +459,8 @@ def load_grid(
 
         gpis = np.array(nc_data.variables[location_var_name][:].flatten())
 
-        shape = None
-        if hasattr(nc_data, "shape"):
-            try:
-                shape = tuple(nc_data.shape)
-            except TypeError as e:
-                try:
-                    length = len(nc_data.shape)
-                except TypeError:
-                    length = nc_data.shape.size
-                if length == 1:
-                    shape = tuple([nc_data.shape])
-                else:
-                    raise e
-
+        shape = _read_shape(nc_data)
         subset = None
-        # some old grid do not have a shape attribute
-        # this meant that they had shape of len 1
-        if shape is None:
-            shape = tuple([len(nc_data.variables["lon"][:])])
 
         # check if grid has regular shape
         if len(shape) == 2:
@@ -445,7 +473,8 @@ def load_grid(
 
             if subset_flag in nc_data.variables.keys():
                 subset = np.where(
-                    np.isin(nc_data.variables[subset_flag][:].flatten(), subset_value)
+                    np.isin(nc_data.variables[subset_flag][:].flatten(),
+                            subset_value)
                 )[0]
 
         elif len(shape) == 1:
@@ -461,11 +490,7 @@ def load_grid(
                     )
                 )[0]
 
-        if "crs" in nc_data.variables:
-            geodatumName = nc_data.variables["crs"].getncattr("ellipsoid_name")
-        else:
-            # ellipsoid information is missing, use WGS84 by default
-            geodatumName = "WGS84"
+        geodatumName = _read_geodatum_name(nc_data)
 
         if arrcell is None:
             # BasicGrid
@@ -490,3 +515,218 @@ def load_grid(
                 shape=shape,
                 **grid_kwargs
             )
+
+
+def _read_shape(nc_data):
+    """
+    Read the grid shape from the global attributes of a grid file.
+    """
+    shape = None
+    if hasattr(nc_data, "shape"):
+        try:
+            shape = tuple(nc_data.shape)
+        except TypeError as e:
+            try:
+                length = len(nc_data.shape)
+            except TypeError:
+                length = nc_data.shape.size
+            if length == 1:
+                shape = tuple([nc_data.shape])
+            else:
+                raise e
+
+    # some old grid do not have a shape attribute
+    # this meant that they had shape of len 1
+    if shape is None:
+        shape = tuple([len(nc_data.variables["lon"])])
+
+    return shape
+
+
+def _read_geodatum_name(nc_data):
+    """
+    Read the name of the geodetic datum of a grid file.
+    """
+    if "crs" in nc_data.variables:
+        return nc_data.variables["crs"].getncattr("ellipsoid_name")
+    else:
+        # ellipsoid information is missing, use WGS84 by default
+        return "WGS84"
+
+
+def _mmap_offsets(filename, names):
+    """
+    Find the file offsets of uncompressed, contiguous variables of a
+    NETCDF4 file, whose stored values are the values netCDF4 reads (not
+    packed, no fill values, native byte order).
+
+    Parameters
+    ----------
+    filename : string
+        name of the file
+    names : list of str
+        names of the variables
+
+    Returns
+    -------
+    offsets : dict
+        (offset, dtype, shape) for each variable that can be memory-mapped.
+    """
+    offsets = {}
+    if not h5py_installed:
+        return offsets
+
+    import h5py
+
+    try:
+        h5file = h5py.File(filename, "r")
+    except OSError:
+        # NETCDF3 files are no HDF5 files
+        return offsets
+
+    with h5file:
+        for name in names:
+            if name not in h5file:
+                continue
+            dset = h5file[name]
+            if dset.chunks is not None or dset.compression is not None:
+                continue
+            if not dset.dtype.isnative or any(
+                    attr in dset.attrs for attr in _PACKING_ATTRIBUTES):
+                continue
+            offset = dset.id.get_offset()
+            if offset is not None:
+                offsets[name] = (offset, dset.dtype, dset.shape)
+
+    return offsets
+
+
+class _VariableReader:
+    """
+    Read flattened grid variables, either memory-mapped or only the part of
+    the file that contains the selected points.
+
+    Parameters
+    ----------
+    filename : string
+        name of the file
+    nc_data : netCDF4.Dataset
+        opened file
+    index : numpy.ndarray or None
+        sorted flat indices of the points to read, None to read all points
+    mmap : boolean
+        memory-map uncompressed variables if possible
+    """
+
+    def __init__(self, filename, nc_data, index=None, mmap=False):
+        self.filename = filename
+        self.nc_data = nc_data
+        self.index = index
+        if mmap:
+            self.offsets = _mmap_offsets(filename,
+                                         list(nc_data.variables.keys()))
+        else:
+            self.offsets = {}
+
+    def read(self, name, index=None):
+        """
+        Read a variable, flattened, at the given flat indices.
+        """
+        if index is None:
+            index = self.index
+
+        if name in self.offsets:
+            offset, dtype, shape = self.offsets[name]
+            # copy-on-write, BasicGrid transforms longitudes in place
+            data = np.memmap(self.filename, dtype=dtype, mode="c",
+                             offset=offset, shape=shape).reshape(-1)
+            return data if index is None else data[index]
+
+        var = self.nc_data.variables[name]
+        if index is None:
+            return np.array(var[:]).flatten()
+        if index.size == 0:
+            return np.array([], dtype=var.dtype)
+
+        # read only the hyperslab that contains the selected points
+        stride = int(np.prod(var.shape[1:], dtype=np.int64))
+        start = index[0] // stride
+        stop = index[-1] // stride + 1
+        data = np.array(var[start:stop]).reshape(-1)
+        return data[index - start * stride]
+
+
+def _load_grid_lazy(filename, subset_flag, subset_value, location_var_name,
+                    lazy, only_subset, cells, **grid_kwargs):
+    """
+    Load a grid, reading only the variables and points that are needed,
+    see load_grid.
+    """
+    from netCDF4 import Dataset
+
+    with Dataset(filename, "r") as nc_data:
+        shape = _read_shape(nc_data)
+        geodatumName = _read_geodatum_name(nc_data)
+        variables = nc_data.variables.keys()
+        has_cells = "cell" in variables
+        has_subset = subset_flag in variables
+
+        reader = _VariableReader(filename, nc_data, mmap=lazy)
+
+        # select the points to load
+        selection = None
+        if cells is not None:
+            if not has_cells:
+                raise ValueError(f"{filename} does not contain cells")
+            selection = np.isin(reader.read("cell"), cells)
+        if only_subset and has_subset:
+            in_subset = np.isin(reader.read(subset_flag), subset_value)
+            selection = in_subset if selection is None \
+                else selection & in_subset
+        if selection is not None:
+            reader.index = np.flatnonzero(selection)
+
+        if len(shape) == 2:
+            londim = np.array(nc_data.variables["lon"][:])
+            latdim = np.array(nc_data.variables["lat"][:])
+
+            if (reader.index is None and not has_cells and not has_subset
+                    and _REGULAR_GRID_KWARGS.issuperset(grid_kwargs)):
+                gpis = reader.read(location_var_name)
+                if np.array_equal(gpis, np.arange(gpis.size)):
+                    try:
+                        return RegularGrid(londim, latdim, origin="top",
+                                           geodatum=geodatumName,
+                                           **grid_kwargs)
+                    except GridDefinitionError:
+                        pass
+
+            # coordinates of the points from the dimensions
+            if reader.index is None:
+                lons = np.tile(londim, latdim.size)
+                lats = np.repeat(latdim, londim.size)
+            else:
+                row, col = np.divmod(reader.index, londim.size)
+                lons, lats = londim[col], latdim[row]
+                shape = (reader.index.size,)
+        else:
+            lons = reader.read("lon")
+            lats = reader.read("lat")
+            if reader.index is not None:
+                shape = (reader.index.size,)
+
+        gpis = reader.read(location_var_name)
+        arrcell = reader.read("cell") if has_cells else None
+
+        subset = None
+        if has_subset and not only_subset:
+            subset = np.flatnonzero(
+                np.isin(reader.read(subset_flag), subset_value))
+
+    if arrcell is None:
+        return BasicGrid(lons, lats, gpis=gpis, geodatum=geodatumName,
+                         subset=subset, shape=shape, **grid_kwargs)
+    else:
+        return CellGrid(lons, lats, arrcell, gpis=gpis,
+                        geodatum=geodatumName, subset=subset, shape=shape,
+                        **grid_kwargs)
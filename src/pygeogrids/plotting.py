@@ -29,7 +29,6 @@ import warnings
 
 try:
     import matplotlib.pyplot as plt
-    import matplotlib as mp
 except ImportError:
     warnings.warn("Matplotlib is necessary for plotting grids. "
                   "Call `conda install matplotlib`")
@@ -72,8 +71,8 @@ def plot_cell_grid_partitioning(
     ax.add_feature(cartopy.feature.OCEAN, color='aqua')
 
     for y in np.arange(-90, 90, cellsize_lat):
-        ax.plot([-180, 180], [y, y], '--', transform=ccrs.PlateCarree(), lw=0.5,
-                color='black')
+        ax.plot([-180, 180], [y, y], '--', transform=ccrs.PlateCarree(),
+                lw=0.5, color='black')
 
     for x in np.arange(-180, 180, cellsize_lat):
         ax.plot([x, x], [-90, 90], '--', transform=ccrs.PlateCarree(), lw=0.5,
@@ -101,4 +100,4 @@ def plot_cell_grid_partitioning(
         )
 
     fig.savefig(output, format="png", dpi=300)
-    plt.close(fig)
\ No newline at end of file
+    plt.close(fig)
@@ -0,0 +1,227 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Vectorized point in polygon tests for masking grid points with polygons.
+"""
+
+from importlib.util import find_spec
+
+import numpy as np
+
+# ogr is imported when it is used, importing GDAL takes longer than
+# importing pygeogrids itself
+ogr_installed = find_spec("osgeo") is not None
+
+
+def ogr_polygon_rings(geom):
+    """
+    Extract the ring coordinates of an OGR (multi)polygon.
+
+    Parameters
+    ----------
+    geom : ogr.Geometry
+        Polygon or MultiPolygon geometry.
+
+    Returns
+    -------
+    polygons : list of list of numpy.ndarray
+        One list of rings per polygon, the first ring is the exterior ring,
+        the others are holes. Each ring is a (n, 2) array of x, y
+        coordinates.
+
+    Raises
+    ------
+    ValueError
+        If the geometry is not a (multi)polygon.
+    """
+    from osgeo import ogr
+
+    gtype = ogr.GT_Flatten(geom.GetGeometryType())
+    if gtype == ogr.wkbPolygon:
+        polys = [geom]
+    elif gtype == ogr.wkbMultiPolygon:
+        polys = [geom.GetGeometryRef(i)
+                 for i in range(geom.GetGeometryCount())]
+    else:
+        raise ValueError(
+            f"Unsupported geometry type {geom.GetGeometryName()}")
+
+    polygons = []
+    for poly in polys:
+        rings = []
+        for i in range(poly.GetGeometryCount()):
+            points = poly.GetGeometryRef(i).GetPoints()
+            if points:
+                rings.append(np.array(points, dtype=np.float64)[:, :2])
+        if rings:
+            polygons.append(rings)
+
+    return polygons
+
+
+def points_in_polygons(x, y, polygons, eps=1e-9):
+    """
+    Test which points are located inside the given polygons using the
+    even-odd rule (crossing number).
+
+    All edge crossings are computed at once: points are sorted by y, so the
+    points whose horizontal ray can cross an edge are found with a binary
+    search per edge. Points outside the bounding box of a ring are skipped.
+    Points closer than ``eps`` to an edge are reported as ambiguous, the
+    result for them depends on how the boundary should be treated.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        x coordinates (longitudes) of the points.
+    y : numpy.ndarray
+        y coordinates (latitudes) of the points.
+    polygons : list of list of numpy.ndarray
+        Polygons as returned by :py:func:`ogr_polygon_rings`.
+    eps : float, optional (default: 1e-9)
+        Distance to an edge below which a point is ambiguous.
+
+    Returns
+    -------
+    inside : numpy.ndarray
+        Boolean array, True for points inside any of the polygons.
+    ambiguous : numpy.ndarray
+        Boolean array, True for points located on an edge (within eps)
+        which are not inside another polygon.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    inside = np.zeros(x.shape, dtype=bool)
+    ambiguous = np.zeros(x.shape, dtype=bool)
+
+    for rings in polygons:
+        parity = np.zeros(x.shape, dtype=bool)
+        on_edge = np.zeros(x.shape, dtype=bool)
+        for ring in rings:
+            ring_parity, ring_on_edge = _ring_crossings(x, y, ring, eps)
+            parity ^= ring_parity
+            on_edge |= ring_on_edge
+        # the parity of points on an edge is arbitrary
+        inside |= parity & ~on_edge
+        ambiguous |= on_edge
+
+    return inside, ambiguous & ~inside
+
+
+def _ring_crossings(x, y, ring, eps):
+    """
+    Parity of the crossings of rays from the points in +x direction with a
+    ring, and points located on the ring.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        x coordinates of the points.
+    y : numpy.ndarray
+        y coordinates of the points.
+    ring : numpy.ndarray
+        (n, 2) array of ring vertices, closed or not.
+    eps : float
+        Distance to an edge below which a point is on the ring.
+
+    Returns
+    -------
+    parity : numpy.ndarray
+        True for points with an odd number of crossings.
+    on_ring : numpy.ndarray
+        True for points located on the ring.
+    """
+    parity = np.zeros(x.shape, dtype=bool)
+    on_ring = np.zeros(x.shape, dtype=bool)
+
+    # bounding box pruning, points right of the ring can not cross it
+    (xmin, ymin), (xmax, ymax) = ring.min(axis=0), ring.max(axis=0)
+    cand = np.flatnonzero((x >= xmin - eps) & (x <= xmax + eps)
+                          & (y >= ymin - eps) & (y <= ymax + eps))
+    if cand.size == 0:
+        return parity, on_ring
+
+    px, py = x[cand], y[cand]
+    order = np.argsort(py, kind="stable")
+    py_sorted = py[order]
+
+    x1, y1 = ring[:, 0], ring[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    edge_ymin, edge_ymax = np.minimum(y1, y2), np.maximum(y1, y2)
+
+    # edge i is crossed by the ray of a point if
+    # edge_ymin[i] <= y < edge_ymax[i] and x < intersection
+    lo = np.searchsorted(py_sorted, edge_ymin, side="left")
+    hi = np.searchsorted(py_sorted, edge_ymax, side="left")
+    edges, points = _expand_ranges(lo, hi)
+    points = order[points]
+    sloped = (x2[edges] - x1[edges]) / (y2[edges] - y1[edges])
+    xint = x1[edges] + (py[points] - y1[edges]) * sloped
+    crossed = px[points] < xint
+    n_crossings = np.bincount(points[crossed], minlength=cand.size)
+    parity[cand] = n_crossings % 2 == 1
+
+    # points on any edge (also horizontal ones) or vertex
+    lo = np.searchsorted(py_sorted, edge_ymin - eps, side="left")
+    hi = np.searchsorted(py_sorted, edge_ymax + eps, side="right")
+    edges, points = _expand_ranges(lo, hi)
+    points = order[points]
+    ex, ey = x2[edges] - x1[edges], y2[edges] - y1[edges]
+    dx, dy = px[points] - x1[edges], py[points] - y1[edges]
+    length2 = ex ** 2 + ey ** 2
+    t = np.clip(np.divide(dx * ex + dy * ey, length2,
+                          out=np.zeros_like(dx), where=length2 > 0), 0, 1)
+    dist2 = (dx - t * ex) ** 2 + (dy - t * ey) ** 2
+    on_ring[cand[np.unique(points[dist2 <= eps ** 2])]] = True
+
+    return parity, on_ring
+
+
+def _expand_ranges(lo, hi):
+    """
+    Expand index ranges [lo[i], hi[i]) into flat pairs (i, j).
+
+    Parameters
+    ----------
+    lo : numpy.ndarray
+        Start of the ranges.
+    hi : numpy.ndarray
+        End of the ranges (exclusive).
+
+    Returns
+    -------
+    i : numpy.ndarray
+        Range number of each pair.
+    j : numpy.ndarray
+        Value in the range of each pair.
+    """
+    counts = np.maximum(hi - lo, 0)
+    i = np.repeat(np.arange(lo.size), counts)
+    starts = np.cumsum(counts) - counts
+    j = np.arange(counts.sum()) - np.repeat(starts - lo, counts)
+    return i, j
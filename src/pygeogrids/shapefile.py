@@ -31,18 +31,14 @@ Module for extracting grid points from global administrative areas
 import os
 import numpy as np
 from typing import Union, Optional
-import pandas as pd
 from pygeogrids.grids import CellGrid
-
-try:
-    from osgeo import ogr
-    ogr_installed = True
-except ImportError:
-    ogr_installed = False
+from pygeogrids.instrumentation import timed
+from pygeogrids.polygon import ogr_installed
 
 path_shp_countries = os.path.join(
     os.path.dirname(__file__), 'shapefiles', 'ne_110m_admin_0_countries.shp')
 
+
 def get_gad_grid_points(grid, gadm_shp_path, level, name=None, oid=None):
     """
     Returns all grid points located in a administrative area. For this
@@ -77,6 +73,7 @@ def get_gad_grid_points(grid, gadm_shp_path, level, name=None, oid=None):
     ImportError: If gdal or osgeo are not installed
     """
     if ogr_installed:
+        from osgeo import ogr
         drv = ogr.GetDriverByName("ESRI Shapefile")
         ds_in = drv.Open(os.path.join(gadm_shp_path, f"gadm28_adm{level}.shp"))
         lyr_in = ds_in.GetLayer(0)
@@ -97,7 +94,8 @@ def get_gad_grid_points(grid, gadm_shp_path, level, name=None, oid=None):
 
     else:
         raise ImportError("Could not import ogr from osgeo. "
-                          "Please install them via `conda install geos gdal` first.")
+                          "Please install them via "
+                          "`conda install geos gdal` first.")
 
 
 class ShpReader:
@@ -137,7 +135,8 @@ class ShpReader:
         """
         if not ogr_installed:
             raise ImportError("Could not import ogr from osgeo. "
-                              "Please install them via `conda install geos gdal` first.")
+                              "Please install them via "
+                              "`conda install geos gdal` first.")
         self.shp_path = shp_path
         self.driver = driver
         self._init_open_shp()
@@ -171,6 +170,7 @@ class ShpReader:
         """
         Open shapefile and get layer
         """
+        from osgeo import ogr
         self.driver = ogr.GetDriverByName(self.driver)
         self.ds = self.driver.Open(self.shp_path)
         self.layer = self.ds.GetLayer()
@@ -190,6 +190,8 @@ class ShpReader:
             Dataframe with feature ids and names for features in passed fields
 
         """
+        import pandas as pd
+
         ids = []
         features = {}
 
@@ -211,7 +213,7 @@ class ShpReader:
         rows = np.unique(np.where(np.isin(self.features.values, names))[0])
         return self.features.index.values[rows]
 
-    def geom(self, id) -> 'ogr.Geometry':
+    def geom(self, id):
         """
         Get geometry of feature with passed id
         """
@@ -219,6 +221,8 @@ class ShpReader:
         geom = feature.geometry().Clone()
         return geom
 
+
+@timed()
 def subgrid_for_shp(grid, values=None, shp_path=path_shp_countries,
                     field=None, shp_driver='ESRI Shapefile',
                     verbose=False):
@@ -236,7 +240,8 @@ def subgrid_for_shp(grid, values=None, shp_path=path_shp_countries,
         columns of the feature table. A polygon is selected if the value
         appears in ANY of the columns (fields) of the feature table.
         If None is passed, all features are used.
-    shp_path: str, optional (default: ./shapefiles/ne_10m_admin_0_countries.shp)
+    shp_path: str, optional
+        (default: ./shapefiles/ne_10m_admin_0_countries.shp)
         Path to shapefile. By default we use the 110m resolution country
         shape file provided in this package. In theory any shapefile should
         work as long as the structure is the same (the GADM shapefiles
@@ -0,0 +1,175 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Sharing grids between processes via shared memory.
+
+A grid is written once into a shared memory block in the layout of the
+binary grid format (see :py:mod:`pygeogrids.binary`). Other processes
+attach to the block by its name and get a grid whose arrays are read-only
+views of the block, so all processes use the same physical memory.
+
+Examples
+--------
+>>> with SharedGrid(grid) as shared:
+...     with multiprocessing.Pool(64) as pool:
+...         pool.map(work, [(shared.name, part) for part in range(64)])
+
+where ``work`` calls ``attach_grid(name)`` to get the grid.
+"""
+
+import sys
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from pygeogrids.binary import MAGIC, _align, grid_from_arrays, grid_layout, \
+    parse_header
+
+_attach_lock = threading.Lock()
+
+
+class SharedGrid:
+    """
+    Grid exported into a shared memory block. The block is removed by
+    unlink (or at the end of a with statement), processes that are
+    attached to it keep their mapping until they exit.
+
+    Parameters
+    ----------
+    grid : BasicGrid, CellGrid or RegularGrid
+        grid to share
+    kdtree : boolean, optional (default: False)
+        If True, the cartesian coordinates of the kdTree are shared as
+        well, and for scipy the serialized tree, see
+        pygeogrids.binary.save_grid.
+
+    Attributes
+    ----------
+    name : str
+        name of the shared memory block, to be passed to attach_grid
+    """
+
+    def __init__(self, grid, kdtree=False):
+        header_bytes, data_start, data_size, arrays = grid_layout(grid,
+                                                                  kdtree)
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=max(data_start + data_size, 1))
+
+        buf = self.shm.buf
+        start = len(MAGIC) + 8
+        buf[:len(MAGIC)] = MAGIC
+        buf[len(MAGIC):start] = np.uint64(len(header_bytes)).tobytes()
+        buf[start:start + len(header_bytes)] = header_bytes
+        for offset, arr in arrays:
+            view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=buf,
+                              offset=data_start + offset)
+            view[...] = arr
+            del view
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(name={self.name!r})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlink()
+
+    def unlink(self):
+        """
+        Close and remove the shared memory block.
+        """
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_grid(name, **grid_kwargs):
+    """
+    Attach to a grid in shared memory.
+
+    Parameters
+    ----------
+    name : str
+        name of the shared memory block, see SharedGrid.name
+    **grid_kwargs
+        additional kwargs that are passed to BasicGrid, CellGrid or
+        RegularGrid
+
+    Returns
+    -------
+    grid : BasicGrid, CellGrid or RegularGrid
+        grid whose arrays are read-only views of the shared memory block
+    """
+    shm = _attach(name)
+    buf = shm.buf
+
+    if bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f"Shared memory block {name} does not contain a grid")
+    start = len(MAGIC) + 8
+    length = int(np.frombuffer(buf[len(MAGIC):start], dtype=np.uint64)[0])
+    header = parse_header(buf[start:start + length])
+    data_start = _align(start + length)
+
+    arrays = {}
+    for key, info in header["arrays"].items():
+        arr = np.ndarray(tuple(info["shape"]), dtype=np.dtype(info["dtype"]),
+                         buffer=buf, offset=data_start + info["offset"])
+        arr.flags.writeable = False
+        arrays[key] = arr
+
+    grid = grid_from_arrays(header, arrays, **grid_kwargs)
+    # the mapping has to stay open as long as the grid uses it
+    grid._shared_memory = shm
+
+    return grid
+
+
+def _attach(name):
+    """
+    Open an existing shared memory block without registering it with the
+    resource tracker, which would remove the block when the attaching
+    process exits.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    # older versions always register the block, unregistering it afterwards
+    # would also drop the registration of the creating process if both use
+    # the same resource tracker
+    with _attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
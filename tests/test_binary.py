@@ -0,0 +1,108 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Testing the binary grid file format.
+"""
+
+import numpy as np
+import numpy.testing as nptest
+import pytest
+
+import pygeogrids.binary as grid_bin
+from pygeogrids.grids import (BasicGrid, CellGrid, RegularGrid, genreg_grid,
+                              lonlat2cell)
+
+
+def random_grids():
+    lons = np.random.RandomState(0).uniform(-180, 180, 2000)
+    lats = np.random.RandomState(1).uniform(-90, 90, 2000)
+    subset = np.arange(0, 2000, 3)
+    return [
+        BasicGrid(lons, lats, gpis=np.arange(2000) * 2, subset=subset),
+        CellGrid(lons, lats, lonlat2cell(lons, lats), subset=subset),
+        genreg_grid(2, 2),
+        RegularGrid(np.arange(0.5, 360, 2), np.arange(89, -90, -2),
+                    transform_lon=True),
+    ]
+
+
+@pytest.mark.parametrize("grid", random_grids())
+@pytest.mark.parametrize("mmap", [True, False])
+def test_save_load_binary(tmp_path, grid, mmap):
+    filename = str(tmp_path / "grid.grd")
+    grid_bin.save_grid(filename, grid)
+    loaded = grid_bin.load_grid(filename, mmap=mmap)
+
+    assert type(loaded) is type(grid)
+    assert loaded == grid
+    assert loaded.geodatum.name == grid.geodatum.name
+    if not isinstance(grid, RegularGrid):
+        assert isinstance(loaded.arrlon, np.memmap) == mmap
+    nptest.assert_array_equal(loaded.find_nearest_gpi(10.3, 45.2),
+                              grid.find_nearest_gpi(10.3, 45.2))
+
+
+@pytest.mark.parametrize("kd_tree_name", ["pykdtree", "scipy"])
+def test_save_load_kdtree(tmp_path, kd_tree_name):
+    lons = np.random.RandomState(0).uniform(-180, 180, 2000)
+    lats = np.random.RandomState(1).uniform(-90, 90, 2000)
+    grid = BasicGrid(lons, lats, subset=np.arange(0, 2000, 3),
+                     kd_tree_name=kd_tree_name)
+    filename = str(tmp_path / "grid.grd")
+    grid_bin.save_grid(filename, grid, kdtree=True)
+
+    header, _ = grid_bin.read_header(filename)
+    assert ("kdtree" in header["arrays"]) == (kd_tree_name == "scipy")
+
+    loaded = grid_bin.load_grid(filename)
+    assert isinstance(loaded.kdTree.coords, np.memmap)
+    assert loaded.kdTree.kdtree is not None
+    lon, lat = np.array([10.3, -100.2]), np.array([45.2, -30.8])
+    nptest.assert_array_equal(loaded.find_k_nearest_gpi(lon, lat, k=3),
+                              grid.find_k_nearest_gpi(lon, lat, k=3))
+
+
+def test_netcdf_conversion(tmp_path):
+    from pygeogrids.netcdf import load_grid, save_grid
+
+    grid = random_grids()[1]
+    save_grid(str(tmp_path / "grid.nc"), grid)
+    grid_bin.netcdf_to_binary(str(tmp_path / "grid.nc"),
+                              str(tmp_path / "grid.grd"))
+    assert grid_bin.load_grid(str(tmp_path / "grid.grd")) == grid
+
+    grid_bin.binary_to_netcdf(str(tmp_path / "grid.grd"),
+                              str(tmp_path / "converted.nc"))
+    assert load_grid(str(tmp_path / "converted.nc")) == grid
+
+
+def test_invalid_file(tmp_path):
+    filename = tmp_path / "grid.grd"
+    filename.write_bytes(b"CDF\x01" + bytes(100))
+    with pytest.raises(ValueError):
+        grid_bin.load_grid(str(filename))
@@ -47,6 +47,38 @@ class test_GeodaticDatum(unittest.TestCase):
                                    np.array([x, y, z]),
                                    decimal=5)
 
+    def test_toECEFArray(self):
+        lon, lat = np.meshgrid(np.arange(-180., 180., 7.5),
+                               np.arange(90., -91., -2.5))
+        lon, lat = lon.ravel(), lat.ravel()
+        expected = np.column_stack(self.datum.toECEF(lon, lat))
+
+        # consecutive equal latitudes use the same latitude terms
+        nptest.assert_array_equal(self.datum.toECEFArray(lon, lat), expected)
+        rng = np.random.default_rng(0)
+        order = rng.permutation(lon.size)
+        nptest.assert_array_equal(
+            self.datum.toECEFArray(lon[order], lat[order]), expected[order])
+
+        out = np.empty((lon.size, 3), dtype=np.float32)
+        coords = self.datum.toECEFArray(lon, lat, out=out)
+        assert coords is out
+        nptest.assert_array_equal(out, expected.astype(np.float32))
+
+        coords = self.datum.toECEFArray(lon, lat, dtype=np.float32)
+        assert coords.dtype == np.float32
+        nptest.assert_allclose(coords, expected, atol=5)
+
+        work = np.empty((3, lon.size + 5))
+        nptest.assert_array_equal(
+            self.datum.toECEFArray(lon[order], lat[order], work=work),
+            expected[order])
+
+        with self.assertRaises(ValueError):
+            self.datum.toECEFArray(lon, lat, out=np.empty((lon.size, 2)))
+        with self.assertRaises(ValueError):
+            self.datum.toECEFArray(lon, lat, work=np.empty((3, 5)))
+
     def test_ParallelRadi(self):
         r = self.datum.ParallelRadi(0.)
         nptest.assert_almost_equal(r, self.datum.geod.a, decimal=5)
@@ -72,6 +104,23 @@ class test_GeodaticDatum(unittest.TestCase):
         assert great_circle_dist < parallel_dist, \
             (great_circle_dist, parallel_dist)
 
+    def test_GreatCircleDist(self):
+        radius = (2 * self.datum.geod.a + self.datum.geod.b) / 3
+        dist = self.datum.GreatCircleDist(0., 0., 180., 0.)
+        nptest.assert_almost_equal(dist, radius * np.pi, decimal=5)
+
+        dist = self.datum.GreatCircleDist(np.array([10., 10.]),
+                                          np.array([45., 45.]),
+                                          np.array([10., 11.]),
+                                          np.array([45., 46.]))
+        nptest.assert_almost_equal(dist[0], 0.)
+        geodesic = self.datum.GeodesicDist(10., 45., 11., 46.)
+        nptest.assert_allclose(dist[1], geodesic, rtol=5e-3)
+
+    def test_GeodesicDist(self):
+        dist = self.datum.GeodesicDist(0., 0., 0., 90.)
+        nptest.assert_almost_equal(dist, self.datum.MeridianArcDist(0., 90.))
+
 
 if __name__ == "__main__":
     unittest.main()
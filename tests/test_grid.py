@@ -29,13 +29,22 @@
 Testing grid functionality.
 """
 
+import os
+import pickle
+import subprocess
+import sys
+import tracemalloc
 import unittest
 import numpy.testing as nptest
 import numpy as np
 import pytest
 
-from pygeogrids.grids import lonlat2cell, BasicGrid
+from pygeogrids.grids import (lonlat2cell, BasicGrid, gridfromdims,
+                              GridDefinitionError, GridIterationError)
 import pygeogrids as grids
+import pygeogrids.nearest_neighbor as NN
+from pygeogrids import instrumentation
+from pygeogrids.geodetic_datum import GeodeticDatum
 from pygeogrids.grids import ogr_installed
 
 
@@ -114,7 +123,6 @@ class TestFindNearestNeighbor(unittest.TestCase):
         assert lon == 145.5
         assert lat == 45.5
 
-
     def test_k_nearest_neighbor(self):
         gpi, dist = self.grid.find_k_nearest_gpi(14.3, 18.5, k=2)
         assert gpi[0, 0] == 25754
@@ -132,7 +140,6 @@ class TestFindNearestNeighbor(unittest.TestCase):
                                                      max_dist=25000)
         assert gpi.shape == dist.shape == (1, 2)
 
-
     def test_k_nearest_neighbor_list(self):
         gpi, dist = self.grid.find_k_nearest_gpi(
             [145.1, 90.2], [45.8, -16.3], k=2)
@@ -159,12 +166,94 @@ class TestFindNearestNeighbor(unittest.TestCase):
         assert dist == np.inf
 
         # test with custom gpi, see issue #68
-        grid = grids.BasicGrid(lon=[16,17], lat=[45,46], gpis=[100,200])
+        grid = grids.BasicGrid(lon=[16, 17], lat=[45, 46], gpis=[100, 200])
         with pytest.warns(UserWarning):
-            gpi, dist = grid.find_nearest_gpi(0,0, max_dist=1000)
+            gpi, dist = grid.find_nearest_gpi(0, 0, max_dist=1000)
         assert gpi == np.iinfo(np.int32).max
         assert dist == np.inf
 
+
+@pytest.mark.parametrize("lon_axis, lat_axis", [
+    (np.arange(-179.5, 180, 1), np.arange(89.5, -90, -1)),
+    (np.arange(-180, 180, 30.), np.arange(-89.5, 90, 1)),
+    (np.arange(10, -20, -3.), np.arange(50, 80, 0.5)),
+])
+def test_regular_grid_nearest_neighbor(lon_axis, lat_axis):
+    """
+    Test that nearest neighbours on regular grids are found without a
+    kdTree and agree with the kdTree search.
+    """
+    lons, lats = np.meshgrid(lon_axis, lat_axis)
+    grid = grids.BasicGrid(lons.flatten(), lats.flatten(), shape=lons.shape)
+    assert grid.kdTree is None
+
+    rng = np.random.RandomState(0)
+    lon = rng.uniform(-180, 180, 5000)
+    lat = np.append(rng.uniform(-90, 90, 4900), rng.uniform(89, 90, 100))
+    gpi, dist = grid.find_nearest_gpi(lon, lat)
+    assert grid.kdTree is None
+
+    requested = grids.BasicGrid(lons.flatten(), lats.flatten(),
+                                shape=lons.shape, setup_kdTree=True)
+    assert requested.kdTree is not None
+
+    tree_grid = grids.BasicGrid(lons.flatten(), lats.flatten())
+    tree_gpi, tree_dist = tree_grid.find_nearest_gpi(lon, lat)
+    nptest.assert_array_equal(gpi, tree_gpi)
+    nptest.assert_allclose(dist, tree_dist)
+
+    nptest.assert_array_equal(tree_grid.calc_lut(grid),
+                              tree_grid.calc_lut(tree_grid))
+
+
+def test_regular_grid_nearest_neighbor_far_point():
+    """
+    Test that a query point far outside of a regional grid only widens
+    its own search window.
+    """
+    grid = grids.genreg_grid(0.05, 0.05, minlat=40, maxlat=50, minlon=0,
+                             maxlon=10)
+    lon = np.full(2000, 5.)
+    lat = np.full(2000, 45.)
+    lon[0] = -170
+
+    tracemalloc.start()
+    gpi, dist = grid.find_nearest_gpi(lon, lat)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # all points in the window of the far point would need about 25 MB
+    assert peak < 5e6
+
+    tree_grid = grids.BasicGrid(grid.arrlon, grid.arrlat)
+    tree_gpi, tree_dist = tree_grid.find_nearest_gpi(lon, lat)
+    nptest.assert_array_equal(gpi, tree_gpi)
+    nptest.assert_allclose(dist, tree_dist)
+
+
+@pytest.mark.parametrize("kd_tree_name", ["pykdtree", "scipy"])
+def test_kdtree_cache(tmp_path, kd_tree_name):
+    """
+    Test that coordinates and trees are reused from the kdTree cache.
+    """
+    lons = np.random.RandomState(0).uniform(-180, 180, 1000)
+    lats = np.random.RandomState(1).uniform(-90, 90, 1000)
+    grid = grids.BasicGrid(lons, lats, kd_tree_name=kd_tree_name,
+                           kd_tree_cache_dir=str(tmp_path))
+    cached = grids.BasicGrid(lons, lats, kd_tree_name=kd_tree_name,
+                             kd_tree_cache_dir=str(tmp_path))
+    assert isinstance(cached.kdTree.coords, np.memmap)
+    nptest.assert_allclose(cached.kdTree.coords, grid.kdTree.coords)
+    if kd_tree_name == "scipy":
+        assert len(list(tmp_path.glob("*.scipy.pkl"))) == 1
+
+    gpi, dist = cached.find_nearest_gpi(14.3, 18.5)
+    assert gpi == grid.find_nearest_gpi(14.3, 18.5)[0]
+
+    other = grids.BasicGrid(lons[1:], lats[1:], kd_tree_name=kd_tree_name,
+                            kd_tree_cache_dir=str(tmp_path))
+    assert other.kdTree.cache_key != cached.kdTree.cache_key
+
+
 class TestCellGridNotGpiDirect(unittest.TestCase):
 
     """
@@ -250,7 +339,7 @@ class TestCellGridNotGpiDirect(unittest.TestCase):
         """
         cells = [1549, 577]
         subgrid = self.cellgrid.subgrid_from_cells(cells)
-        assert type(subgrid) == type(self.cellgrid)
+        assert type(subgrid) is type(self.cellgrid)
 
         for cell in cells:
             gpis, lons, lats = subgrid.grid_points_for_cell(cell)
@@ -268,7 +357,7 @@ class TestCellGridNotGpiDirect(unittest.TestCase):
         """
         gpis = [200, 255]
         subgrid = self.cellgrid.subgrid_from_gpis(gpis)
-        assert type(subgrid) == type(self.cellgrid)
+        assert type(subgrid) is type(self.cellgrid)
         lons_should, lats_should = self.cellgrid.gpi2lonlat(gpis)
         cells_should = self.cellgrid.gpi2cell(gpis)
         subgrid_should = grids.CellGrid(
@@ -276,11 +365,143 @@ class TestCellGridNotGpiDirect(unittest.TestCase):
         assert subgrid == subgrid_should
 
 
+@pytest.mark.parametrize("gpi_step", [1, 1000])
+def test_gpi2index_lookup(gpi_step):
+    """
+    Test gpi lookups for compact (dense table) and sparse (sorted index)
+    gpi numbers.
+    """
+    lon, lat = np.meshgrid(np.arange(-180, 180, 10.), np.arange(80, -90, -10.))
+    gpis = 50 + np.arange(lon.size)[::-1] * gpi_step
+    cells = lonlat2cell(lon.flatten(), lat.flatten())
+    grid = grids.CellGrid(lon.flatten(), lat.flatten(), cells, gpis=gpis,
+                          shape=lon.shape)
+
+    offset, lut, sorted_gpis = grid._build_gpi_lut()
+    assert (sorted_gpis is None) == (gpi_step == 1)
+
+    query = gpis[[0, 17, 100, -1]]
+    lons, lats = grid.gpi2lonlat(query)
+    nptest.assert_array_equal(lons, lon.flatten()[[0, 17, 100, -1]])
+    nptest.assert_array_equal(lats, lat.flatten()[[0, 17, 100, -1]])
+    nptest.assert_array_equal(grid.gpi2cell(query), cells[[0, 17, 100, -1]])
+    row, col = grid.gpi2rowcol(query[1])
+    assert (row, col) == (0, 17)
+
+    subgrid = grid.subgrid_from_gpis(query)
+    nptest.assert_array_equal(subgrid.arrlon, lons)
+    nptest.assert_array_equal(subgrid.arrcell, cells[[0, 17, 100, -1]])
+
+
+def test_cell_index():
+    """
+    Test cell queries and cell ordered iteration against a brute force
+    search.
+    """
+    grid = grids.genreg_grid(2.5, 2.5).to_cell_grid(10.)
+    subset = np.flatnonzero(np.abs(grid.arrlat) < 30)
+    grid = grids.CellGrid(grid.arrlon, grid.arrlat, grid.arrcell,
+                          subset=subset)
+
+    cells = grid.get_cells()
+    nptest.assert_array_equal(cells, np.unique(grid.activearrcell))
+
+    query = [cells[3], 9999, cells[0]]
+    gpis, lons, lats = grid.grid_points_for_cell(query)
+    should = np.hstack([np.where(grid.activearrcell == c)[0] for c in query])
+    nptest.assert_array_equal(gpis, grid.activegpis[should])
+    nptest.assert_array_equal(lons, grid.activearrlon[should])
+    assert grid.grid_points_for_cell(9999)[0].size == 0
+
+    subgrid = grid.subgrid_from_cells(query)
+    nptest.assert_array_equal(subgrid.gpis, grid.activegpis[should])
+    nptest.assert_array_equal(np.unique(subgrid.arrcell), np.sort(query[::2]))
+
+    points = list(grid.grid_points())
+    order = np.argsort(grid.activearrcell, kind="stable")
+    nptest.assert_array_equal([p[0] for p in points], grid.activegpis[order])
+    nptest.assert_array_equal([p[3] for p in points],
+                              grid.activearrcell[order])
+
+    grid.split(3)
+    split_points = [p for n in range(3) for p in grid.grid_points(n)]
+    nptest.assert_array_equal([p[0] for p in split_points],
+                              [p[0] for p in points])
+
+
+def test_iter_cell_batches():
+    """
+    Test that cell batches contain the same points as grid_points, also for
+    a split grid.
+    """
+    grid = grids.genreg_grid(2.5, 2.5).to_cell_grid(10.)
+    subset = np.flatnonzero(np.abs(grid.arrlat) < 30)
+    grid = grids.CellGrid(grid.arrlon, grid.arrlat, grid.arrcell,
+                          subset=subset)
+    points = list(grid.grid_points())
+
+    batches = list(grid.iter_cell_batches())
+    nptest.assert_array_equal([b[0] for b in batches], grid.get_cells())
+    for cell, gpis, lons, lats in batches:
+        nptest.assert_array_equal(gpis, grid.grid_points_for_cell(cell)[0])
+        nptest.assert_array_equal(lats, grid.grid_points_for_cell(cell)[2])
+    nptest.assert_array_equal(np.concatenate([b[1] for b in batches]),
+                              [p[0] for p in points])
+    nptest.assert_array_equal(np.concatenate([b[2] for b in batches]),
+                              [p[1] for p in points])
+
+    grid.split(4)
+    split_batches = [b for n in range(4) for b in grid.iter_cell_batches(n)]
+    assert len(split_batches) >= len(batches)
+    nptest.assert_array_equal(np.concatenate([b[1] for b in split_batches]),
+                              [p[0] for p in points])
+    assert np.shares_memory(split_batches[0][1], grid.subgpis[0])
+    with pytest.raises(GridIterationError):
+        next(grid.iter_cell_batches())
+
+
+def test_split_by_cell():
+    """
+    Test that whole cells are assigned to balanced parts.
+    """
+    grid = grids.genreg_grid(1, 1).to_cell_grid(5.)
+    subset = np.flatnonzero((grid.arrlat > 0) | (grid.arrlon > 100))
+    grid = grids.CellGrid(grid.arrlon, grid.arrlat, grid.arrcell,
+                          subset=subset)
+    counts = np.bincount(grid.activearrcell)
+
+    grid.split(7, by_cell=True)
+    part_cells = [np.unique(c) for c in grid.subcells]
+    nptest.assert_array_equal(np.sort(np.concatenate(part_cells)),
+                              grid.get_cells())
+    for n, cells in enumerate(grid.split_cells):
+        nptest.assert_array_equal(cells, part_cells[n])
+        assert grid.subgpis[n].size == counts[cells].sum()
+    nptest.assert_array_equal(
+        np.sort(np.concatenate([grid.get_grid_points(n)[0]
+                                for n in range(7)])),
+        np.sort(grid.activegpis))
+    loads = [g.size for g in grid.subgpis]
+    # longest processing time bound: no part exceeds the mean by more than
+    # the largest cell
+    assert max(loads) - np.mean(loads) <= counts.max()
+
+    costs = {cell: 1 for cell in grid.get_cells()}
+    parts = grid.partition_cells(4, cell_costs=costs)
+    assert [p.size for p in parts] == [grid.get_cells().size // 4 +
+                                       (i < grid.get_cells().size % 4)
+                                       for i in range(4)]
+    assert len(grid.partition_cells(3000)[-1]) == 0
+    with pytest.raises(ValueError):
+        grid.partition_cells(2, cell_costs=[1, 2])
+
+
 class TestLutCalculation(unittest.TestCase):
 
     def setUp(self):
         """
-        Setup two grids with similar gpis but with different subset/gpi ordering.
+        Setup two grids with similar gpis but with different subset/gpi
+        ordering.
         The lookup tables should still give the correct results.
         The gpi's of the two grids are identical.
         """
@@ -307,6 +528,42 @@ class TestLutCalculation(unittest.TestCase):
         nptest.assert_array_equal(
             lut2[self.grid1.activegpis], self.grid1.activegpis)
 
+    def test_calc_lut_chunked(self):
+        lut = self.grid1.calc_lut(self.grid2, chunk_size=1, n_workers=2)
+        nptest.assert_array_equal(lut, [-1, -1, 2, 3])
+
+        src = grids.RegularGrid(np.arange(-179.75, 180, 0.5),
+                                np.arange(89.75, -90, -0.5))
+        lons = np.random.RandomState(0).uniform(-180, 180, 5000)
+        lats = np.random.RandomState(1).uniform(-90, 90, 5000)
+        dest = grids.BasicGrid(lons, lats, gpis=np.arange(5000) * 3,
+                               subset=np.arange(0, 5000, 2))
+        lut = src.calc_lut(dest, max_dist=200e3)
+        chunked = src.calc_lut(dest, max_dist=200e3, chunk_size=10000,
+                               n_workers=3)
+        nptest.assert_array_equal(chunked, lut)
+        assert src._arrays is None
+
+        # the regular search is set up before the threads share it
+        regular = grids.genreg_grid(2, 2)
+        assert regular._regular_nn.row_xy is None
+        with instrumentation.recording():
+            chunked = dest.calc_lut(regular, n_workers=3)
+        # one chunk per worker by default
+        timers = instrumentation.snapshot()["timers"]
+        assert timers["nearest_neighbor.findRegularNN.find_nearest_index"][
+            "count"] == 3
+        assert regular._regular_nn.col_cos is not None
+        lut = dest.calc_lut(regular)
+        nptest.assert_array_equal(chunked, lut)
+        # indexed by the gpis of dest
+        assert lut.size == dest.gpis.max() + 1
+        nptest.assert_array_equal(
+            lut[dest.activegpis],
+            regular.find_nearest_gpi(dest.activearrlon, dest.activearrlat)[0])
+        assert np.all(lut[np.setdiff1d(np.arange(lut.size),
+                                       dest.activegpis)] == -1)
+
 
 class TestCellGridNotGpiDirectSubset(unittest.TestCase):
 
@@ -323,8 +580,9 @@ class TestCellGridNotGpiDirectSubset(unittest.TestCase):
                                     gpis=np.arange(self.lon.flatten().size),
                                     shape=(len(self.londim),
                                            len(self.latdim)),
-                                    subset=np.arange(self.lon.flatten().size / 2,
-                                                     dtype=np.int64))
+                                    subset=np.arange(
+                                        self.lon.flatten().size / 2,
+                                        dtype=np.int64))
         self.cellgrid = self.grid.to_cell_grid()
 
     def test_gpi2cell(self):
@@ -442,7 +700,7 @@ class TestCellGrid(unittest.TestCase):
         """
         cells = [1549, 577]
         subgrid = self.cellgrid.subgrid_from_cells(cells)
-        assert type(subgrid) == type(self.cellgrid)
+        assert type(subgrid) is type(self.cellgrid)
 
         for cell in cells:
             gpis, lons, lats = subgrid.grid_points_for_cell(cell)
@@ -460,7 +718,7 @@ class TestCellGrid(unittest.TestCase):
         """
         gpis = [200, 255]
         subgrid = self.cellgrid.subgrid_from_gpis(gpis)
-        assert type(subgrid) == type(self.cellgrid)
+        assert type(subgrid) is type(self.cellgrid)
         lons_should, lats_should = self.cellgrid.gpi2lonlat(gpis)
         cells_should = self.cellgrid.gpi2cell(gpis)
         subgrid_should = grids.CellGrid(
@@ -515,6 +773,33 @@ class TestCellGrid(unittest.TestCase):
                                          1241, 1241, 1276, 1276, 1277]))
 
 
+def test_bbox_grid_points_index():
+    """
+    Test bbox queries against a brute force search, also for boxes that
+    cross the antimeridian.
+    """
+    lons = np.random.RandomState(0).uniform(-180, 180, 5000)
+    lats = np.random.RandomState(1).uniform(-90, 90, 5000)
+    grid = grids.BasicGrid(lons, lats, subset=np.arange(0, 5000, 2))
+    glons, glats = grid.activearrlon, grid.activearrlat
+
+    gpis = grid.get_bbox_grid_points(-10, 20, 30, 60)
+    should = (glats >= -10) & (glats <= 20) & (glons >= 30) & (glons <= 60)
+    nptest.assert_array_equal(gpis, grid.activegpis[should])
+
+    lats_bbox, lons_bbox = grid.get_bbox_grid_points(-10, 20, 170, -170,
+                                                     coords=True)
+    should = ((glats >= -10) & (glats <= 20)
+              & ((glons >= 170) | (glons <= -170)))
+    assert should.sum() > 0
+    nptest.assert_array_equal(lats_bbox, glats[should])
+    nptest.assert_array_equal(lons_bbox, glons[should])
+
+    cellgrid = grid.to_cell_grid(5.)
+    gpis = cellgrid.get_bbox_grid_points(-10, 20, 170, -170)
+    nptest.assert_array_equal(np.sort(gpis), grid.activegpis[should])
+
+
 def test_setup_grid_with_lists():
 
     grid = grids.BasicGrid([1, 2, 3, 4, 5], [1, 2, 3, 4, 5])
@@ -584,11 +869,10 @@ class Test_2Dgrid(unittest.TestCase):
         """
         Test if gpi to row column lookup works correctly.
         """
-        self.custom_gpi_grid = grids.BasicGrid(self.lon.flatten(),
-                                               self.lat.flatten(),
-                                               shape=(len(self.latdim),
-                                                      len(self.londim)),
-                                               gpis=np.arange(len(self.lat.flatten()))[::-1])
+        self.custom_gpi_grid = grids.BasicGrid(
+            self.lon.flatten(), self.lat.flatten(),
+            shape=(len(self.latdim), len(self.londim)),
+            gpis=np.arange(len(self.lat.flatten()))[::-1])
         gpi = [200, 255]
         row_should = [70, 70]
         column_should = [87, 32]
@@ -609,7 +893,8 @@ class Test_2Dgrid(unittest.TestCase):
 
     def test_lonlat2d(self):
         """
-        Test if lonlat 2d grids are the same as the grids used for making the grid.
+        Test if lonlat 2d grids are the same as the grids used for making the
+        grid.
         """
         assert np.all(self.lon == self.grid.lon2d)
         assert np.all(self.lat == self.grid.lat2d)
@@ -637,6 +922,421 @@ def test_genreggrid():
     assert lat == 88.5
 
 
+@pytest.mark.parametrize("origin", ["top", "bottom"])
+def test_regular_grid(origin):
+    """
+    Test that a RegularGrid behaves like the same grid created by
+    gridfromdims, without computing the coordinate arrays.
+    """
+    londim = np.arange(0.5, 360, 2.5)
+    latdim = np.arange(-89.5, 90, 2)
+    grid = grids.RegularGrid(londim, latdim, origin=origin,
+                             transform_lon=True)
+    should = gridfromdims(londim, latdim, origin=origin,
+                          transform_lon=True)
+
+    gpi, dist = grid.find_nearest_gpi([14.3, -120.1], [18.2, -45.7])
+    nptest.assert_array_equal(gpi, should.find_nearest_gpi(
+        [14.3, -120.1], [18.2, -45.7])[0])
+    lon, lat = grid.gpi2lonlat(gpi)
+    nptest.assert_array_equal(lon, should.gpi2lonlat(gpi)[0])
+    nptest.assert_array_equal(lat, should.gpi2lonlat(gpi)[1])
+    assert grid.gpi2rowcol(1000) == should.gpi2rowcol(1000)
+    for bbox in [(-10, 20, 30, 60), (-10, 20, 170, -170)]:
+        nptest.assert_array_equal(grid.get_bbox_grid_points(*bbox),
+                                  should.get_bbox_grid_points(*bbox))
+    assert grid._arrays is None
+
+    assert grid == should
+    nptest.assert_array_equal(grid.lat2d, should.lat2d)
+    nptest.assert_array_equal(grid.activegpis, should.activegpis)
+
+    assert grid.kdTree is None
+    tree_grid = grids.RegularGrid(londim, latdim, origin=origin,
+                                  transform_lon=True, setup_kdTree=True)
+    assert tree_grid.kdTree is not None
+    nptest.assert_array_equal(
+        tree_grid.find_k_nearest_gpi(14.3, 18.2, k=3)[0],
+        should.find_k_nearest_gpi(14.3, 18.2, k=3)[0])
+
+    with pytest.raises(GridDefinitionError):
+        grids.RegularGrid([1, 2, 4], latdim)
+
+
+@pytest.mark.parametrize("metric", ["great_circle", "geodesic"])
+def test_nearest_gpi_surface_distance(metric):
+    """
+    Test that surface distances are computed for the found neighbours and
+    that max_dist is applied to them.
+    """
+    grid = grids.genreg_grid(1, 1)
+    lon, lat = np.array([14.3, -120.1, 179.9]), np.array([18.2, -45.7, 0.1])
+
+    gpi, cart_dist = grid.find_nearest_gpi(lon, lat)
+    gpi_surface, dist = grid.find_nearest_gpi(lon, lat, metric=metric)
+    nptest.assert_array_equal(gpi, gpi_surface)
+    if metric == "geodesic":
+        assert np.all(dist >= cart_dist)
+    nn_lon, nn_lat = grid.gpi2lonlat(gpi)
+    if metric == "geodesic":
+        should = grid.geodatum.GeodesicDist(lon, lat, nn_lon, nn_lat)
+    else:
+        should = grid.geodatum.GreatCircleDist(lon, lat, nn_lon, nn_lat)
+    nptest.assert_allclose(dist, should)
+
+    gpi, dist = grid.find_nearest_gpi(lon, lat, max_dist=dist[1],
+                                      metric=metric)
+    assert np.isinf(dist[0]) and not np.isinf(dist[1])
+
+    gpis, dists = grid.find_k_nearest_gpi(lon, lat, k=3, metric=metric)
+    assert dists.shape == (3, 3)
+    assert np.all(np.diff(dists, axis=1) > -1)
+
+    lut = grid.calc_lut(grid, max_dist=1000, metric=metric)
+    nptest.assert_array_equal(lut, grid.gpis)
+
+    with pytest.raises(ValueError):
+        grid.find_nearest_gpi(lon, lat, metric="manhattan")
+
+
+def test_pickle_grids():
+    """
+    Test that pickled grids only contain the defining arrays and work the
+    same after unpickling.
+    """
+    cellgrid = grids.genreg_grid(2.5, 2.5).to_cell_grid(10.)
+    subset = np.flatnonzero(cellgrid.arrlat > 0)
+    cellgrid = grids.CellGrid(cellgrid.arrlon, cellgrid.arrlat,
+                              cellgrid.arrcell, subset=subset)
+    cellgrid.split(3)
+    regular = grids.RegularGrid(np.arange(-179, 180, 2),
+                                np.arange(89, -90, -2))
+
+    for grid in [grids.genreg_grid(2.5, 2.5), cellgrid, regular]:
+        should = grid.find_k_nearest_gpi([10.3, -100.2], [45.2, 30.8], k=2)
+        state = grid.__getstate__()
+        assert "kdTree" not in state
+        assert "activearrlon" not in state
+        assert "_arrays" not in state
+
+        loaded = pickle.loads(pickle.dumps(grid))
+        assert loaded == grid
+        assert loaded.kdTree is None
+        nptest.assert_array_equal(
+            loaded.find_k_nearest_gpi([10.3, -100.2], [45.2, 30.8], k=2),
+            should)
+
+    assert loaded._arrays is not None
+    assert "gpis" not in cellgrid.__getstate__()
+    loaded = pickle.loads(pickle.dumps(cellgrid))
+    nptest.assert_array_equal(loaded.activearrcell, cellgrid.activearrcell)
+    for n in range(3):
+        nptest.assert_array_equal(loaded.get_grid_points(n)[0],
+                                  cellgrid.get_grid_points(n)[0])
+    nptest.assert_array_equal(loaded.get_cells(), cellgrid.get_cells())
+
+
+def test_compact_grid():
+    """
+    Test that compact grids store smaller dtypes and find the same
+    neighbours.
+    """
+    rng = np.random.RandomState(0)
+    lons, lats = rng.uniform(-180, 180, 5000), rng.uniform(-90, 90, 5000)
+    cells = lonlat2cell(lons, lats)
+    grid = grids.CellGrid(lons, lats, cells, subset=np.arange(0, 5000, 2))
+    compact = grids.CellGrid(lons, lats, cells, subset=np.arange(0, 5000, 2),
+                             compact=True)
+
+    assert compact.arrlon.dtype == np.float32
+    assert compact.gpis.dtype == np.int16
+    assert compact.arrcell.dtype == np.int16
+    assert compact.subset.dtype == np.int16
+    nptest.assert_allclose(compact.arrlat, lats, atol=1e-5)
+
+    query_lons = rng.uniform(-180, 180, 50)
+    query_lats = rng.uniform(-90, 90, 50)
+    gpis, dist = compact.find_nearest_gpi(query_lons, query_lats)
+    should_gpis, should_dist = grid.find_nearest_gpi(query_lons, query_lats)
+    assert compact.kdTree.coords.dtype == np.float32
+    nptest.assert_array_equal(gpis, should_gpis)
+    nptest.assert_allclose(dist, should_dist, atol=2)
+    assert dist.dtype == np.float64
+
+    lut = compact.calc_lut(grids.genreg_grid(1, 1))
+    assert lut.dtype == np.int32
+    nptest.assert_array_equal(lut, grid.calc_lut(grids.genreg_grid(1, 1)))
+
+    regular = grids.genreg_grid(0.5, 0.5, compact=True)
+    assert regular._regular_nn is not None
+    assert regular.gpis.dtype == np.int32
+
+
+def test_construction_memory():
+    """
+    Test that active arrays are computed lazily, as views where possible,
+    and that constructing a subset grid does not copy the coordinates.
+    """
+    rng = np.random.RandomState(0)
+    n = 200000
+    lons, lats = rng.uniform(-180, 180, n), rng.uniform(-90, 90, n)
+    subset = np.sort(rng.choice(n, n // 2, replace=False))
+
+    tracemalloc.start()
+    grid = BasicGrid(lons, lats, subset=subset, setup_kdTree=False)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # only the gpis are allocated
+    assert peak < 0.6 * (lons.nbytes + lats.nbytes)
+    assert grid.arrlon is lons
+    nptest.assert_array_equal(grid.activearrlon, lons[subset])
+
+    grid = BasicGrid(lons, lats, subset=np.arange(10, n, 3),
+                     setup_kdTree=False)
+    assert np.shares_memory(grid.activearrlat, lats)
+    nptest.assert_array_equal(grid.activegpis, np.arange(10, n, 3))
+
+    grid = BasicGrid(lons, lats, copy=True, transform_lon=False)
+    assert not np.shares_memory(grid.arrlon, lons)
+
+
+def test_with_subset():
+    """
+    Test that grids derived with with_subset share the arrays and kdTree of
+    the original grid and find the same neighbours as a new grid with the
+    subset.
+    """
+    rng = np.random.RandomState(0)
+    lons, lats = rng.uniform(-180, 180, 5000), rng.uniform(-90, 90, 5000)
+    cells = lonlat2cell(lons, lats)
+    gpis = np.arange(5000) * 2 + 10
+    grid = grids.CellGrid(lons, lats, cells, gpis=gpis, setup_kdTree=True)
+    query_lons = rng.uniform(-180, 180, 50)
+    query_lats = rng.uniform(-90, 90, 50)
+
+    for subset in (np.flatnonzero(rng.uniform(size=5000) < 0.5),
+                   rng.permutation(5000)[:2000],
+                   np.arange(0, 5000, 40)):
+        derived = grid.with_subset(subset)
+        new = grids.CellGrid(lons, lats, cells, gpis=gpis, subset=subset)
+        assert derived.arrlon is grid.arrlon
+        assert derived.arrcell is grid.arrcell
+        assert grid.subset is None
+
+        for k in (1, 3):
+            result = derived.find_k_nearest_gpi(query_lons, query_lats, k=k,
+                                                max_dist=500000)
+            should = new.find_k_nearest_gpi(query_lons, query_lats, k=k,
+                                            max_dist=500000)
+            nptest.assert_array_equal(result[0], should[0])
+            nptest.assert_allclose(result[1], should[1])
+        nptest.assert_array_equal(derived.get_grid_points()[0],
+                                  new.get_grid_points()[0])
+        nptest.assert_array_equal(derived.grid_points_for_cell(1000)[0],
+                                  new.grid_points_for_cell(1000)[0])
+        other = grids.genreg_grid(5, 5)
+        nptest.assert_array_equal(other.calc_lut(derived),
+                                  other.calc_lut(new))
+
+    # large subsets are searched in the kdTree of the original grid
+    assert derived.kdTree is not None
+    derived = grid.with_subset(np.arange(0, 5000, 2))
+    derived.find_nearest_gpi(0, 0)
+    assert derived.kdTree is None
+    assert derived._root_grid()._full_kdtree() is grid.kdTree
+
+    regular = grids.genreg_grid(10, 10)
+    derived = regular.with_subset(np.arange(0, regular.n_gpi, 3))
+    new = grids.BasicGrid(regular.arrlon, regular.arrlat,
+                          subset=np.arange(0, regular.n_gpi, 3))
+    nptest.assert_array_equal(
+        derived.find_nearest_gpi(query_lons, query_lats)[0],
+        new.find_nearest_gpi(query_lons, query_lats)[0])
+
+
+def test_find_nearest_index_masked():
+    """
+    Test the nearest neighbour search that skips masked points.
+    """
+    lons = np.arange(10, dtype=float)
+    nn = NN.findGeoNN(lons, np.zeros(10), GeodeticDatum("WGS84"))
+    mask = np.zeros(10, dtype=bool)
+    mask[[2, 7]] = True
+
+    dist, ind = nn.find_nearest_index_masked([0.1, 6.4], [0, 0], mask)
+    nptest.assert_array_equal(ind, [2, 7])
+
+    with pytest.warns(UserWarning):
+        dist, ind = nn.find_nearest_index_masked([0.1, 6.4], [0, 0], mask,
+                                                 k=3, max_dist=600000)
+    nptest.assert_array_equal(ind, [[2, 10, 10], [7, 2, 10]])
+    assert np.isinf(dist[0, 1:]).all() and np.isinf(dist[1, 2])
+
+    # the kdTree of a small mask is kept for queries with the same mask
+    lons = np.arange(100, dtype=float)
+    nn = NN.findGeoNN(lons, np.zeros(100), GeodeticDatum("WGS84"))
+    mask = np.zeros(100, dtype=bool)
+    mask[[20, 70, 90]] = True
+    dist, ind = nn.find_nearest_index_masked([0.1, 66.4], [0, 0], mask)
+    nptest.assert_array_equal(ind, [20, 70])
+    subtree = nn._masked_subtree[1]
+    nn.find_nearest_index_masked([3.], [0], mask.copy())
+    assert nn._masked_subtree[1] is subtree
+    mask[20] = False
+    dist, ind = nn.find_nearest_index_masked([0.1], [0], mask)
+    nptest.assert_array_equal(ind, [70])
+    assert nn._masked_subtree[1] is not subtree
+
+
+def test_find_nearest_gpi_mask():
+    """
+    Test nearest neighbour search among the points of a mask or gpi set,
+    and in subgrids that use the kdTree of their grid.
+    """
+    rng = np.random.RandomState(0)
+    lons, lats = rng.uniform(-180, 180, 5000), rng.uniform(-90, 90, 5000)
+    gpis = np.arange(5000) * 2 + 10
+    grid = grids.CellGrid(lons, lats, lonlat2cell(lons, lats), gpis=gpis,
+                          subset=np.arange(0, 5000, 2))
+    query_lons = rng.uniform(-180, 180, 50)
+    query_lats = rng.uniform(-90, 90, 50)
+
+    for fraction in (0.5, 0.01):
+        mask = rng.uniform(size=2500) < fraction
+        should = grids.BasicGrid(lons, lats, gpis=gpis,
+                                 subset=np.arange(0, 5000, 2)[mask])
+        should_gpis, should_dist = should.find_k_nearest_gpi(
+            query_lons, query_lats, k=2)
+        for query_mask in (mask, grid.activegpis[mask]):
+            result_gpis, result_dist = grid.find_k_nearest_gpi(
+                query_lons, query_lats, k=2, mask=query_mask)
+            nptest.assert_array_equal(result_gpis, should_gpis)
+            nptest.assert_allclose(result_dist, should_dist)
+
+    gpi, dist = grid.find_nearest_gpi(0, 0, mask=[10, 14])
+    assert gpi == grid.find_nearest_gpi(0, 0, mask=grid.activegpis < 16)[0]
+    with pytest.raises(ValueError):
+        grid.find_nearest_gpi(0, 0, mask=np.ones(10, dtype=bool))
+
+    subgrid = grid.subgrid_from_cells(grid.get_cells()[::2])
+    should = grids.CellGrid(subgrid.arrlon, subgrid.arrlat, subgrid.arrcell,
+                            subgrid.gpis)
+    nptest.assert_array_equal(
+        subgrid.find_nearest_gpi(query_lons, query_lats)[0],
+        should.find_nearest_gpi(query_lons, query_lats)[0])
+    assert subgrid.kdTree is None
+    assert subgrid._root_grid() is grid
+
+    basic = grids.BasicGrid(lons, lats, gpis=gpis)
+    for parent in (basic, grids.genreg_grid(1, 1)):
+        sub = parent.subgrid_from_gpis(parent.gpis[::7])
+        assert sub.kdTree is None
+        should = grids.BasicGrid(sub.arrlon, sub.arrlat, sub.gpis)
+        nptest.assert_array_equal(
+            sub.find_nearest_gpi(query_lons, query_lats)[0],
+            should.find_nearest_gpi(query_lons, query_lats)[0])
+
+    regular = grids.genreg_grid(1, 1)
+    mask = rng.uniform(size=regular.n_gpi) < 0.5
+    should = grids.BasicGrid(regular.arrlon, regular.arrlat,
+                             subset=np.flatnonzero(mask))
+    nptest.assert_array_equal(
+        regular.find_nearest_gpi(query_lons, query_lats, mask=mask)[0],
+        should.find_nearest_gpi(query_lons, query_lats)[0])
+
+
+def test_unpickle_old_state():
+    """
+    Test that grids pickled by older versions, which stored the active
+    arrays and lacked the attributes added since, can be used.
+    """
+    import pyproj
+
+    lon, lat = np.meshgrid(np.arange(-175., 180, 10), np.arange(85., -90, -10))
+    lon, lat = lon.ravel(), lat.ravel()
+    cells = lonlat2cell(lon, lat)
+    subset = np.arange(0, lon.size, 2)
+    old_geodatum = GeodeticDatum.__new__(GeodeticDatum)
+    old_geodatum.__setstate__({"geod": pyproj.Geod(ellps="WGS84"),
+                               "name": "WGS84"})
+    state = {"arrlon": lon, "arrlat": lat, "gpis": np.arange(lon.size),
+             "activearrlon": lon, "activearrlat": lat,
+             "activegpis": np.arange(lon.size), "allpoints": True,
+             "gpidirect": True, "issplit": False, "kdTree": None,
+             "kd_tree_name": "pykdtree", "geodatum": old_geodatum,
+             "lon2d": lon.reshape(18, 36), "lat2d": lat.reshape(18, 36),
+             "n_gpi": lon.size, "shape": (18, 36), "subset": None}
+    query_lon, query_lat = np.array([3.3, -120.1]), np.array([-40.2, 12.])
+
+    grid = BasicGrid.__new__(BasicGrid)
+    grid.__setstate__(pickle.loads(pickle.dumps(state)))
+    assert grid._regular_nn is not None
+    should = BasicGrid(lon, lat, shape=(18, 36))
+    nptest.assert_array_equal(grid.find_nearest_gpi(query_lon, query_lat)[0],
+                              should.find_nearest_gpi(query_lon, query_lat)[0])
+    nptest.assert_allclose(grid.geodatum.GeocentricLat(45.),
+                           should.geodatum.GeocentricLat(45.))
+
+    state.update({"arrcell": cells, "activearrcell": cells, "gpi_lut": None,
+                  "subset": subset, "allpoints": False,
+                  "activearrlon": lon[subset], "activearrlat": lat[subset],
+                  "activegpis": subset, "shape": (lon.size,)})
+    del state["lon2d"], state["lat2d"]
+    grid = grids.CellGrid.__new__(grids.CellGrid)
+    grid.__setstate__(pickle.loads(pickle.dumps(state)))
+    should = grids.CellGrid(lon, lat, cells, subset=subset)
+    nptest.assert_array_equal(grid.find_nearest_gpi(query_lon, query_lat)[0],
+                              should.find_nearest_gpi(query_lon, query_lat)[0])
+    nptest.assert_array_equal(grid.grid_points_for_cell(cells[0])[0],
+                              should.grid_points_for_cell(cells[0])[0])
+
+
+def test_boolean_subset():
+    """
+    Test that a subset can be given as boolean mask of all points.
+    """
+    grid = grids.genreg_grid(10, 10)
+    mask = grid.arrlat > 40
+    for subgrid in (grids.BasicGrid(grid.arrlon, grid.arrlat, subset=mask),
+                    grids.CellGrid(grid.arrlon, grid.arrlat,
+                                   lonlat2cell(grid.arrlon, grid.arrlat),
+                                   subset=mask),
+                    grids.BasicGrid(grid.arrlon,
+                                    grid.arrlat).with_subset(mask)):
+        nptest.assert_array_equal(subgrid.subset, np.flatnonzero(mask))
+        nptest.assert_array_equal(subgrid.activearrlat, grid.arrlat[mask])
+        gpi, _ = subgrid.find_nearest_gpi(0, 0)
+        assert subgrid.arrlat[gpi] > 40
+        lut = grid.calc_lut(subgrid)
+        assert np.all(subgrid.arrlat[lut] > 40)
+
+
+def test_add_remove_subset():
+    """
+    Test changing the subset of a grid in place.
+    """
+    grid = grids.genreg_grid(1, 1).to_cell_grid()
+    grid.find_nearest_gpi(0, 0)
+
+    removed = grid.get_bbox_grid_points(lonmin=-10, lonmax=10)
+    grid.remove_from_subset(removed)
+    assert grid.n_gpi - len(grid.subset) == 180 * 20
+    gpi, _ = grid.find_nearest_gpi(0.1, 0.1)
+    assert grid.gpi2lonlat(gpi) == (10.5, 0.5)
+    assert grid.get_bbox_grid_points(-1, 1, -1, 1).size == 0
+    assert gpi in grid.grid_points_for_cell(grid.gpi2cell(gpi))[0]
+
+    grid.add_to_subset(removed[:3])
+    assert grid.find_nearest_gpi(*grid.gpi2lonlat(removed[1]))[0] == removed[1]
+    nptest.assert_array_equal(grid.subset, np.sort(grid.subset))
+
+    regular = grids.RegularGrid(np.arange(-179.5, 180),
+                                np.arange(89.5, -90, -1))
+    regular.add_to_subset([0])
+    with pytest.raises(GridDefinitionError):
+        regular.remove_from_subset([0])
+
+
 def test_reorder_to_cellsize():
     """
     Test reordering to different cellsize
@@ -682,6 +1382,7 @@ class Test_ShpGrid(unittest.TestCase):
         poly.AddGeometry(ring)
 
         self.shp = poly
+
     def test_shpgrid(self):
         '''
         Check if gridpoints fall in polygon.
@@ -713,3 +1414,56 @@ def test_BasicGrid_transform_lon():
     # case 3: no warning and no transform
     grid = BasicGrid(lon_pos, lat, transform_lon=False)
     assert np.all(grid.arrlon == lon_pos)
+
+
+def test_query_session():
+    """
+    Query sessions return the results of find_nearest_gpi, written to
+    their own or to passed arrays.
+    """
+    rng = np.random.default_rng(0)
+    lon = rng.uniform(-180, 180, 300)
+    lat = rng.uniform(-90, 90, 300)
+    reg = grids.genreg_grid(1, 1)
+    for grid in [reg, reg.to_cell_grid().subgrid_from_cells([1, 2, 500]),
+                 reg.with_subset(np.arange(0, reg.n_gpi, 3))]:
+        for max_dist in [np.inf, 50000]:
+            session = grid.query_session(500, max_dist=max_dist)
+            gpi, dist = session.find_nearest_gpi(lon, lat)
+            expected_gpi, expected_dist = grid.find_nearest_gpi(
+                lon, lat, max_dist=max_dist)
+            nptest.assert_array_equal(gpi, expected_gpi)
+            nptest.assert_array_equal(dist, expected_dist)
+            assert np.shares_memory(gpi, session.gpi)
+
+            gpi_out = np.empty(10, dtype=np.int64)
+            dist_out = np.empty(10)
+            gpi, dist = session.find_nearest_gpi(lon[:10], lat[:10],
+                                                 gpi=gpi_out, dist=dist_out)
+            assert gpi is gpi_out and dist is dist_out
+            nptest.assert_array_equal(gpi, expected_gpi[:10])
+            nptest.assert_array_equal(dist, expected_dist[:10])
+
+    with pytest.raises(ValueError):
+        session.find_nearest_gpi(np.zeros(501), np.zeros(501))
+
+
+def test_import_defers_optional_dependencies():
+    """
+    Importing pygeogrids and creating a grid does not import the optional
+    dependencies, they take several times longer to import than
+    pygeogrids itself.
+    """
+    heavy = ["osgeo", "netCDF4", "h5py", "pandas", "scipy", "pykdtree",
+             "pyproj", "numpy.testing", "importlib.metadata"]
+    code = (
+        "import sys\n"
+        "import pygeogrids, pygeogrids.netcdf, pygeogrids.shapefile\n"
+        "grid = pygeogrids.genreg_grid(1, 1).to_cell_grid()\n"
+        "grid.gpi2lonlat(grid.gpis[:10])\n"
+        f"print([m for m in {heavy!r} if m in sys.modules])\n"
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.run([sys.executable, "-c", code], env=env,
+                            capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == "[]"
@@ -0,0 +1,107 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Testing the timers and counters of grid operations.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from pygeogrids import instrumentation
+from pygeogrids.grids import BasicGrid, genreg_grid
+from pygeogrids.netcdf import load_grid, save_grid
+
+
+@pytest.fixture(autouse=True)
+def no_recording():
+    previous = instrumentation.is_enabled()
+    instrumentation.disable()
+    instrumentation.reset()
+    yield
+    instrumentation.reset()
+    if previous:
+        instrumentation.enable()
+
+
+def test_disabled_records_nothing():
+    grid = genreg_grid(10, 10)
+    grid.find_k_nearest_gpi(0, 0, k=2)
+    assert instrumentation.snapshot() == {"timers": {}, "counters": {}}
+
+
+def test_recording(tmp_path):
+    rng = np.random.RandomState(0)
+    grid = BasicGrid(rng.uniform(-180, 180, 1000), rng.uniform(-90, 90, 1000))
+    other = genreg_grid(5, 5)
+
+    with instrumentation.recording():
+        grid.calc_lut(other)
+        grid.find_k_nearest_gpi([0, 1], [0, 1], k=2)
+        save_grid(os.path.join(tmp_path, "grid.nc"), grid)
+        load_grid(os.path.join(tmp_path, "grid.nc"))
+    assert not instrumentation.is_enabled()
+
+    values = instrumentation.snapshot()
+    timers = values["timers"]
+    assert timers["grids.BasicGrid.calc_lut"]["count"] == 1
+    assert timers["nearest_neighbor.findGeoNN._build_kdtree"]["count"] == 1
+    assert timers["nearest_neighbor.findGeoNN.find_nearest_index"][
+        "count"] == 1
+    assert timers["nearest_neighbor.findRegularNN.find_nearest_index"][
+        "count"] == 1
+    assert timers["geodetic_datum.GeodeticDatum.toECEF"]["count"] >= 2
+    assert timers["netcdf.save_lonlat"]["count"] == 1
+    assert timers["netcdf.load_grid"]["count"] == 1
+    for timer in timers.values():
+        assert 0 <= timer["max"] <= timer["total"]
+
+    assert values["counters"] == {"nearest_neighbor.query_points": 1002,
+                                  "nearest_neighbor.kdtree_points": 1000}
+
+
+def test_callbacks():
+    recorded = []
+
+    def callback(kind, name, value):
+        recorded.append((kind, name, value))
+
+    grid = genreg_grid(10, 10)
+    instrumentation.add_callback(callback)
+    try:
+        grid.find_nearest_gpi(0, 0)
+        assert recorded == []
+        with instrumentation.recording():
+            grid.find_nearest_gpi([0, 1, 2], [0, 1, 2])
+    finally:
+        instrumentation.remove_callback(callback)
+
+    assert recorded[0] == ("counter", "nearest_neighbor.query_points", 3)
+    assert recorded[-1][:2] == (
+        "timer", "nearest_neighbor.findRegularNN.find_nearest_index")
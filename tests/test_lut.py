@@ -0,0 +1,116 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Testing the lookup table store.
+"""
+
+import os
+
+import numpy as np
+import numpy.testing as nptest
+import pytest
+
+from pygeogrids.grids import BasicGrid, genreg_grid
+from pygeogrids.lut import LutStore, grid_fingerprint
+
+
+@pytest.fixture
+def grids():
+    lons = np.random.RandomState(0).uniform(-180, 180, 2000)
+    lats = np.random.RandomState(1).uniform(-90, 90, 2000)
+    return BasicGrid(lons, lats, subset=np.arange(0, 2000, 3)), \
+        genreg_grid(2, 2)
+
+
+def test_grid_fingerprint(grids):
+    grid, other = grids
+    assert grid_fingerprint(grid) == grid_fingerprint(
+        BasicGrid(grid.arrlon.copy(), grid.arrlat.copy(), subset=grid.subset))
+    assert grid_fingerprint(grid) != grid_fingerprint(
+        BasicGrid(grid.arrlon, grid.arrlat))
+    assert grid_fingerprint(other) != grid_fingerprint(genreg_grid(2, 2.5))
+
+
+@pytest.mark.parametrize("format", ["npy", "nc"])
+def test_lut_store(tmp_path, grids, format):
+    grid, other = grids
+    store = LutStore(str(tmp_path), format=format)
+
+    lut = store.get(grid, other, max_dist=100e3)
+    assert lut.dtype == np.int32
+    nptest.assert_array_equal(lut, grid.calc_lut(other, max_dist=100e3))
+    assert len(os.listdir(tmp_path)) == 1
+
+    # stored luts are loaded, different arguments give a different lut
+    nptest.assert_array_equal(store.get(grid, other, max_dist=100e3), lut)
+    store.get(grid, other)
+    assert len(os.listdir(tmp_path)) == 2
+
+    store.clear()
+    assert len(os.listdir(tmp_path)) == 0
+
+
+def test_lut_store_eviction(tmp_path, grids):
+    grid, other = grids
+    store = LutStore(str(tmp_path))
+    store.get(other, grid)
+    size = os.path.getsize(os.path.join(tmp_path, os.listdir(tmp_path)[0]))
+
+    store = LutStore(str(tmp_path), max_size=int(2.5 * size))
+    for max_dist in [1e5, 2e5, 3e5]:
+        store.get(other, grid, max_dist=max_dist)
+    assert len(os.listdir(tmp_path)) == 2
+    assert os.path.exists(os.path.join(
+        tmp_path, store.key(other, grid, 3e5) + ".npy"))
+
+
+def test_lut_store_files_removed_concurrently(tmp_path, grids, monkeypatch):
+    grid, other = grids
+    store = LutStore(str(tmp_path), max_size=1)
+    lut = store.get(other, grid)
+
+    # files removed by another process between listing and using them
+    files = store._files
+    vanished = os.path.join(tmp_path, "vanished.npy")
+    monkeypatch.setattr(store, "_files", lambda: files() + [vanished])
+    store._evict()
+    store.clear()
+
+    def utime(filename):
+        os.remove(filename)
+        raise FileNotFoundError(filename)
+
+    store = LutStore(str(tmp_path))
+    store.get(other, grid)
+    monkeypatch.setattr(os, "utime", utime)
+    nptest.assert_array_equal(store.get(other, grid), lut)
+    assert len(os.listdir(tmp_path)) == 0
+    monkeypatch.undo()
+
+    # a file that is gone is computed again
+    nptest.assert_array_equal(store.get(other, grid), lut)
@@ -27,6 +27,7 @@
 
 
 import unittest
+import pytest
 import numpy as np
 import numpy.testing as nptest
 from netCDF4 import Dataset
@@ -54,10 +55,10 @@ class Test(unittest.TestCase):
                                                 subset=self.subset,
                                                 shape=(180, 360))
         self.basic_generated = grids.genreg_grid(1, 1)
-        self.basic_irregular = grids.BasicGrid(np.random.random(360 * 180) * 360 - 180,
-                                               np.random.random(
-                                                   360 * 180) * 180 - 90,
-                                               subset=self.subset)
+        self.basic_irregular = grids.BasicGrid(
+            np.random.random(360 * 180) * 360 - 180,
+            np.random.random(360 * 180) * 180 - 90,
+            subset=self.subset)
         self.cellgrid = grids.CellGrid(self.lons, self.lats, self.cells,
                                        subset=self.subset)
 
@@ -85,7 +86,8 @@ class Test(unittest.TestCase):
             nptest.assert_array_equal(self.lons, nc_data.variables['lon'][:])
             nptest.assert_array_equal(self.cells, nc_data.variables['cell'][:])
             nptest.assert_array_equal(
-                self.subset, np.where(nc_data.variables['subset_flag'][:] == 1)[0])
+                self.subset,
+                np.where(nc_data.variables['subset_flag'][:] == 1)[0])
             assert nc_data.test == 'test_attribute'
 
     def test_save_basicgrid_generated(self):
@@ -103,8 +105,9 @@ class Test(unittest.TestCase):
             # the stored one.
             stored_subset = np.where(nc_data.variables['subset_flag'][
                                      :].flatten() == 1)[0]
-            nptest.assert_array_equal(sorted(self.basic.gpis[self.subset]),
-                                      sorted(nc_data.variables['gpi'][:].flatten()[stored_subset]))
+            nptest.assert_array_equal(
+                sorted(self.basic.gpis[self.subset]),
+                sorted(nc_data.variables['gpi'][:].flatten()[stored_subset]))
             assert nc_data.test == 'test_attribute'
             assert nc_data.shape[0] == 180
             assert nc_data.shape[1] == 360
@@ -119,8 +122,9 @@ class Test(unittest.TestCase):
                 self.basic_irregular.arrlat, nc_data.variables['lat'][:])
             nptest.assert_array_equal(
                 self.basic_irregular.arrlon, nc_data.variables['lon'][:])
-            nptest.assert_array_equal(self.subset,
-                                      np.where(nc_data.variables['subset_flag'][:] == 1)[0])
+            nptest.assert_array_equal(
+                self.subset,
+                np.where(nc_data.variables['subset_flag'][:] == 1)[0])
             assert nc_data.test == 'test_attribute'
             assert nc_data.shape == 64800
 
@@ -134,7 +138,8 @@ class Test(unittest.TestCase):
             nptest.assert_array_equal(self.lons, nc_data.variables['lon'][:])
             nptest.assert_array_equal(self.cells, nc_data.variables['cell'][:])
             nptest.assert_array_equal(
-                self.subset, np.where(nc_data.variables['subset_flag'][:] == 1)[0])
+                self.subset,
+                np.where(nc_data.variables['subset_flag'][:] == 1)[0])
             assert nc_data.test == 'test_attribute'
 
     def test_save_load_basicgrid(self):
@@ -172,6 +177,31 @@ class Test(unittest.TestCase):
         loaded_grid = grid_nc.load_grid(self.testfile)
         assert self.cellgrid_shape == loaded_grid
 
+    def test_load_lazy_cells_subset(self):
+        grid_nc.save_grid(self.testfile,
+                          self.cellgrid_shape)
+        cells = np.unique(self.cells[self.subset])[:5]
+
+        loaded_grid = grid_nc.load_grid(self.testfile, lazy=True)
+        assert self.cellgrid_shape == loaded_grid
+
+        loaded_grid = grid_nc.load_grid(self.testfile, cells=cells)
+        should = self.cellgrid_shape.subgrid_from_cells(cells)
+        nptest.assert_array_equal(np.sort(loaded_grid.activegpis),
+                                  np.sort(should.activegpis))
+        assert loaded_grid.shape == (loaded_grid.n_gpi,)
+        assert loaded_grid.n_gpi == np.isin(self.cells, cells).sum()
+        lon, lat = loaded_grid.gpi2lonlat(loaded_grid.activegpis)
+        nptest.assert_array_equal(
+            lon, self.cellgrid_shape.gpi2lonlat(loaded_grid.activegpis)[0])
+        nptest.assert_array_equal(
+            lat, self.cellgrid_shape.gpi2lonlat(loaded_grid.activegpis)[1])
+
+        loaded_grid = grid_nc.load_grid(self.testfile, only_subset=True)
+        assert loaded_grid.subset is None
+        nptest.assert_array_equal(np.sort(loaded_grid.gpis),
+                                  np.sort(self.cellgrid_shape.activegpis))
+
 
 def test_store_load_regular_2D_grid_custom_gpis():
     """
@@ -207,6 +237,71 @@ def test_store_load_regular_2D_grid():
     assert grid == grid_loaded
 
 
+def test_load_grid_lazy_regular():
+    """
+    Test that a lazily loaded 2D grid is kept in axis form.
+    """
+    grid = grids.genreg_grid(2, 2)
+    testfile = tempfile.NamedTemporaryFile().name
+    grid_nc.save_grid(testfile, grid)
+    grid_loaded = grid_nc.load_grid(testfile, lazy=True)
+    assert isinstance(grid_loaded, grids.RegularGrid)
+    assert grid == grid_loaded
+
+    # keywords that only BasicGrid accepts
+    grid_loaded = grid_nc.load_grid(testfile, lazy=True, compact=True)
+    assert not isinstance(grid_loaded, grids.RegularGrid)
+    assert grid_loaded.compact
+    assert grid == grid_loaded
+
+
+@pytest.mark.skipif(not grid_nc.h5py_installed, reason="h5py not installed")
+def test_load_grid_lazy_mmap():
+    """
+    Test that uncompressed variables are memory-mapped.
+    """
+    lons = np.random.random(1000) * 360
+    lats = np.random.random(1000) * 180 - 90
+    testfile = tempfile.NamedTemporaryFile().name
+    grid_nc.save_lonlat(testfile, lons, lats, GeodeticDatum("WGS84"),
+                        arrcell=grids.lonlat2cell(lons, lats))
+    grid = grid_nc.load_grid(testfile, transform_lon=True)
+    grid_loaded = grid_nc.load_grid(testfile, lazy=True, transform_lon=True)
+    assert isinstance(grid_loaded.arrlat, np.memmap)
+    assert grid == grid_loaded
+    # the file is not changed by the transformation of the longitudes
+    with Dataset(testfile) as ncfile:
+        ncfile.set_auto_mask(False)
+        assert np.any(ncfile.variables["lon"][:] > 180)
+
+
+@pytest.mark.skipif(not grid_nc.h5py_installed, reason="h5py not installed")
+def test_load_grid_lazy_packed():
+    """
+    Test that packed and filled variables are not memory-mapped but
+    unpacked like in the eager loading.
+    """
+    lons = np.linspace(-170, 170, 100)
+    lats = np.linspace(-80, 80, 100)
+    testfile = tempfile.NamedTemporaryFile().name
+    with Dataset(testfile, "w", format="NETCDF4") as ncfile:
+        ncfile.createDimension("gp", lons.size)
+        var = ncfile.createVariable("gpi", "i4", ("gp",))
+        var[:] = np.arange(lons.size)
+        var = ncfile.createVariable("lon", "i2", ("gp",))
+        var.scale_factor = 0.01
+        var[:] = lons
+        var = ncfile.createVariable("lat", "f8", ("gp",), fill_value=-999.)
+        var[:] = lats
+
+    grid = grid_nc.load_grid(testfile)
+    grid_loaded = grid_nc.load_grid(testfile, lazy=True)
+    assert not isinstance(grid_loaded.arrlon, np.memmap)
+    assert not isinstance(grid_loaded.arrlat, np.memmap)
+    nptest.assert_allclose(grid_loaded.arrlon, lons, atol=0.01)
+    assert grid == grid_loaded
+
+
 def test_sort_lon_lat_for_netcdf_transposed():
     """
     Test the sorting of an array for netcdf storage
@@ -247,4 +342,3 @@ def test_sort_lon_lat_for_netcdf():
 
 if __name__ == "__main__":
     unittest.main()
-
@@ -0,0 +1,76 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Testing the vectorized point in polygon tests.
+"""
+
+import numpy as np
+import numpy.testing as nptest
+
+from pygeogrids.polygon import points_in_polygons
+
+
+def square(x0, y0, size):
+    return np.array([[x0, y0], [x0, y0 + size], [x0 + size, y0 + size],
+                     [x0 + size, y0], [x0, y0]], dtype=float)
+
+
+def test_points_in_polygon_with_hole():
+    polygons = [[square(0, 0, 10), square(4, 4, 2)]]
+    x = np.array([1, 5, 4, 10, 11, 3, 0])
+    y = np.array([1, 5, 5, 3, 5, 9.5, 10])
+
+    inside, ambiguous = points_in_polygons(x, y, polygons)
+
+    nptest.assert_array_equal(inside, [1, 0, 0, 0, 0, 1, 0])
+    nptest.assert_array_equal(ambiguous, [0, 0, 1, 1, 0, 0, 1])
+
+
+def test_points_in_multipolygon():
+    polygons = [[square(0, 0, 2)], [square(5, 5, 2)], [square(2, 0, 2)]]
+    x = np.array([1, 6, 3, 4.5, 2])
+    y = np.array([1, 6, 1, 1, 1])
+
+    inside, ambiguous = points_in_polygons(x, y, polygons)
+
+    nptest.assert_array_equal(inside, [1, 1, 1, 0, 0])
+    # the shared edge of two polygons is ambiguous
+    nptest.assert_array_equal(ambiguous, [0, 0, 0, 0, 1])
+
+
+def test_points_in_circle_polygon():
+    angle = np.linspace(0, 2 * np.pi, 721)
+    ring = np.column_stack([10 * np.cos(angle), 10 * np.sin(angle)])
+    x, y = np.meshgrid(np.arange(-12, 12, 0.37), np.arange(-12, 12, 0.41))
+    r = np.hypot(x, y).flatten()
+
+    inside, ambiguous = points_in_polygons(x.flatten(), y.flatten(), [[ring]])
+
+    assert np.all(inside[r < 9.99])
+    assert not np.any(inside[r > 10])
+    assert not np.any(ambiguous)
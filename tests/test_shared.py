@@ -0,0 +1,85 @@
+# Copyright (c) 2022, TU Wien, Department of Geodesy and Geoinformation
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of TU Wien, Department of Geodesy and Geoinformation
+#      nor the names of its contributors may be used to endorse or promote
+#      products derived from this software without specific prior written
+#      permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL TU WIEN, DEPARTMENT OF GEODESY AND
+# GEOINFORMATION BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Testing grids in shared memory.
+"""
+
+import multiprocessing
+
+import numpy as np
+import numpy.testing as nptest
+import pytest
+
+from pygeogrids.grids import CellGrid, genreg_grid, lonlat2cell
+from pygeogrids.shared import SharedGrid, attach_grid
+
+
+def nearest_gpis(args):
+    name, lon, lat = args
+    grid = attach_grid(name)
+    return grid.find_nearest_gpi(lon, lat)[0], grid.activegpis.flags.writeable
+
+
+@pytest.fixture
+def cellgrid():
+    lons = np.random.RandomState(0).uniform(-180, 180, 2000)
+    lats = np.random.RandomState(1).uniform(-90, 90, 2000)
+    return CellGrid(lons, lats, lonlat2cell(lons, lats),
+                    gpis=np.arange(2000) + 100)
+
+
+@pytest.mark.parametrize("kdtree", [False, True])
+def test_shared_grid(cellgrid, kdtree):
+    with SharedGrid(cellgrid, kdtree=kdtree) as shared:
+        grid = attach_grid(shared.name)
+        assert grid == cellgrid
+        assert not grid.arrlon.flags.writeable
+        assert (grid.kdTree is not None) == kdtree
+        nptest.assert_array_equal(grid.arrcell, cellgrid.arrcell)
+        nptest.assert_array_equal(grid.find_k_nearest_gpi(10.3, 45.2, k=3),
+                                  cellgrid.find_k_nearest_gpi(10.3, 45.2,
+                                                              k=3))
+        del grid
+
+        lons, lats = [10.3, -100.2, 45.], [45.2, -30.8, 0.]
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(2) as pool:
+            results = pool.map(nearest_gpis, [(shared.name, lon, lat)
+                                              for lon, lat in zip(lons, lats)])
+        nptest.assert_array_equal([r[0] for r in results],
+                                  cellgrid.find_nearest_gpi(lons, lats)[0])
+        assert not any(r[1] for r in results)
+
+
+def test_shared_regular_grid():
+    grid = genreg_grid(2, 2)
+    with SharedGrid(grid) as shared:
+        assert attach_grid(shared.name) == grid
+
+    with pytest.raises(FileNotFoundError):
+        attach_grid(shared.name)